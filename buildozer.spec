@@ -15,6 +15,9 @@ source.dir = iron_tracker
 # (list) Source files to include (let empty to include all the files)
 source.include_exts = py,png,jpg,kv,atlas,db
 
+# (list) Source directories to exclude
+source.exclude_dirs = tests
+
 # (str) Application versioning (method 1)
 version = 1.0
 
@@ -0,0 +1,423 @@
+"""Insights computed from a single consistent snapshot of the readings.
+
+The engine has no Kivy dependency, so it can be timed headlessly:
+    python -m analytics.insights iron_tracker.db --repeat 1000
+"""
+import argparse
+import time
+from dataclasses import dataclass, field
+from datetime import date, timedelta
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from analytics.tracing import traced
+from analytics.trend import MIN_TREND_POINTS, TrendFit, TrendModel
+from database.derived import DEFAULT_UNIT, DERIVED_BY_TYPE, test_type_unit
+from database.forecasts import Forecast, TrendState, forecast
+from database.quantiles import QuantileSummary
+from database.reading_store import EPOCH_ORDINAL, reading_timestamp
+from database.reference_ranges import DEFAULT_TEST_TYPE, LEVEL_CLASS_CODES, LEVEL_CLASSES
+from database.running_stats import RunningStats
+from database.tags import TagComparison
+
+
+# Readings older than this are left out of trend analysis
+TREND_WINDOW_DAYS = 90
+# Standard deviations (μg/dL) separating low, moderate and high variability
+VARIABILITY_LIMITS = (10, 20)
+# Days after which a new test is suggested
+RETEST_DAYS = 30
+# Most used tags compared before and after their first use
+TAG_COMPARISON_LIMIT = 3
+
+LOW_RECOMMENDATIONS = [
+    "🍖 Increase iron-rich foods: red meat, poultry, fish",
+    "🥬 Include iron-rich vegetables: spinach, lentils, beans",
+    "🍊 Combine with Vitamin C sources to enhance absorption",
+    "☕ Avoid tea and coffee with meals (they reduce absorption)",
+    "💊 Consider iron supplements (consult your doctor first)",
+    "👨‍⚕️ Schedule follow-up with healthcare provider",
+]
+
+HIGH_RECOMMENDATIONS = [
+    "🥗 Reduce iron-rich foods temporarily",
+    "🫖 Drink tea with meals to reduce iron absorption",
+    "🥛 Increase calcium-rich foods (they inhibit iron absorption)",
+    "🚫 Avoid iron supplements unless prescribed",
+    "👨‍⚕️ Consult doctor - high iron can indicate health issues",
+    "💧 Stay well hydrated",
+]
+
+NORMAL_RECOMMENDATIONS = [
+    "✅ Maintain your current diet and lifestyle",
+    "🏃‍♂️ Continue regular exercise",
+    "📊 Keep monitoring your iron levels regularly",
+    "🥗 Maintain balanced diet with variety of nutrients",
+    "💧 Stay well hydrated",
+]
+
+GENERAL_RECOMMENDATIONS = [
+    "",
+    "General Health Tips:",
+    "📱 Track your readings regularly in this app",
+    "📝 Note any symptoms or changes you experience",
+    "🏥 Bring your iron tracking data to doctor visits",
+    "📚 Stay informed about iron and health",
+]
+
+RETEST_RECOMMENDATION = "⏰ Consider getting a new iron level test soon"
+
+
+@dataclass
+class InsightsSnapshot:
+    """Everything the insights need, read once so all cards agree with each other."""
+
+    today: date
+    profile: Dict
+    test_type: str  # the latest reading's; everything below is of this type only
+    normal_min: float
+    normal_max: float
+    latest_level: Optional[float]
+    latest_timestamp: Optional[float]
+    latest_class: Optional[str]
+    timestamps: np.ndarray  # readings in the trend window, oldest first
+    levels: np.ndarray
+    class_codes: np.ndarray  # indexes into LEVEL_CLASSES, classified at write time
+    trend_fit: Optional[TrendFit] = None
+    anomalies: List[Dict] = field(default_factory=list)  # flagged readings in the window
+    forecast_state: Optional[TrendState] = None
+    overall: RunningStats = field(default_factory=RunningStats)  # all readings ever
+    distribution: Optional[QuantileSummary] = None  # quantiles of all readings ever
+    # Window-function metrics in the trend window
+    window_metrics: List[Dict] = field(default_factory=list)
+    # Levels before and after each of the most used tags
+    tag_comparisons: List[TagComparison] = field(default_factory=list)
+
+
+@dataclass
+class ReadingChange:
+    """How the latest reading relates to earlier ones of the same test type."""
+
+    delta: Optional[float]  # change from the previous reading
+    days_since_previous: Optional[float]
+    rolling_mean: float  # over the trailing window_metrics.ROLLING_WINDOW_DAYS
+    rolling_count: int
+    median_interval_days: Optional[float]  # typical spacing of tests in the trend window
+
+
+@dataclass
+class TrendSummary:
+    """Statistics over the readings in the trend window."""
+
+    direction: str  # "increasing", "decreasing" or "stable"
+    fit: Optional[TrendFit]  # slopes per month with confidence intervals
+    count: int
+    mean: float
+    std: float
+    min: float
+    max: float
+    variability: str  # "low", "moderate" or "high"
+    low_count: int
+    normal_count: int
+    high_count: int
+
+
+@dataclass
+class InsightsResult:
+    """Computed insights, ready to be rendered."""
+
+    profile: Dict
+    test_type: str
+    normal_min: float
+    normal_max: float
+    latest_level: Optional[float] = None
+    latest_date: Optional[date] = None
+    days_since_latest: Optional[int] = None
+    status: Optional[str] = None  # "low", "normal" or "high"
+    trend: Optional[TrendSummary] = None
+    anomalies: List[Dict] = field(default_factory=list)
+    forecast: Optional[Forecast] = None
+    overall: RunningStats = field(default_factory=RunningStats)
+    distribution: Optional[QuantileSummary] = None
+    change: Optional[ReadingChange] = None
+    tag_comparisons: List[TagComparison] = field(default_factory=list)
+    recommendations: List[str] = field(default_factory=list)
+
+    @property
+    def unit(self) -> str:
+        return test_type_unit(self.test_type)
+
+
+class InsightsEngine:
+    """Computes status, trend, distribution and recommendations for the Insights screen.
+
+    Each run reads the profile once and copies the trend window out of the
+    shared reading store, then computes everything from that snapshot. Only
+    readings of the latest reading's test type are used, since levels of
+    different test types are not comparable. The trend slopes come from a
+    TrendModel per test type that is kept up to date as readings are added
+    and deleted, rather than refitted on every run.
+    """
+
+    def __init__(self, db_manager, window_days: int = TREND_WINDOW_DAYS):
+        self.db_manager = db_manager
+        self.window_days = window_days
+        self.trend_models: Dict[str, TrendModel] = {}
+        db_manager.add_change_listener(self.on_reading_change)
+
+    def on_reading_change(self, event, reading):
+        """Fold an added or deleted reading into its test type's cached trend model."""
+        if event == "patient":
+            self.trend_models.clear()
+            return
+        if event not in ("add", "delete"):
+            return
+        test_type = reading.get('test_type') or DEFAULT_TEST_TYPE
+        model = self.trend_models.get(test_type)
+        if model is None:
+            return
+        timestamp = reading_timestamp(reading['reading_date'], reading['reading_time'])
+        if event == "add":
+            model.add(timestamp, reading['iron_level'])
+        elif not model.remove(timestamp, reading['iron_level']) and timestamp >= model.cutoff:
+            # The reading had been dropped to bound the model; rebuild on next use
+            del self.trend_models[test_type]
+
+    def get_trend_model(self, test_type: str) -> TrendModel:
+        """Get a test type's cached trend model, building it from the reading store if needed."""
+        model = self.trend_models.get(test_type)
+        if model is None:
+            store = self.db_manager.get_reading_store()
+            positions = store.type_positions(test_type)
+            model = TrendModel(window_days=self.window_days)
+            model.extend(store.timestamps[positions], store.levels[positions])
+            self.trend_models[test_type] = model
+        return model
+
+    @traced("insights.snapshot")
+    def snapshot(self, today: date = None) -> InsightsSnapshot:
+        """Read the profile and the latest reading's test type in the trend window in one go.
+
+        Every query runs in one read transaction, so a write committed
+        meanwhile by another connection cannot leave the cards disagreeing.
+        """
+        today = today or date.today()
+        window_start_date = today - timedelta(days=self.window_days)
+        store = self.db_manager.get_reading_store()
+        window_start = reading_timestamp(window_start_date)
+
+        with self.db_manager.read_transaction():
+            profile = self.db_manager.get_user_profile()
+            latest_level = latest_timestamp = latest_class = forecast_state = None
+            window_metrics = []
+            tag_comparisons = []
+            test_type = DEFAULT_TEST_TYPE
+            if len(store):
+                # Derived readings repeat the latest native ones in another unit
+                latest = len(store) - 1
+                while latest > 0 and store.test_types[store.type_codes[latest]] in DERIVED_BY_TYPE:
+                    latest -= 1
+                latest_level = float(store.levels[latest])
+                latest_timestamp = float(store.timestamps[latest])
+                latest_class = LEVEL_CLASSES[store.class_codes[latest]]
+                test_type = store.test_types[store.type_codes[latest]]
+                forecast_state = self.db_manager.get_forecast_state(test_type)
+                window_metrics = self.db_manager.get_reading_metrics(window_start_date, today, test_type)
+                tag_comparisons = [
+                    comparison
+                    for comparison in self.db_manager.get_tag_comparisons(test_type, TAG_COMPARISON_LIMIT)
+                    if comparison.difference is not None
+                ]
+            normal_min, normal_max = self.db_manager.get_normal_range(test_type, profile)
+            anomalies = self.db_manager.get_anomalies(window_start_date, today, test_type)
+            overall = self.db_manager.get_running_stats(test_type)
+            distribution = QuantileSummary.from_digest(
+                self.db_manager.get_quantile_sketch(test_type=test_type)
+            )
+
+        # Positions (a copying index) of the test type's readings in the trend window
+        window = store.type_positions(test_type, store.between(window_start, reading_timestamp(today) + 1))
+        trend_model = self.get_trend_model(test_type)
+        trend_model.advance(window_start)
+
+        return InsightsSnapshot(
+            today=today,
+            profile=profile,
+            test_type=test_type,
+            normal_min=normal_min,
+            normal_max=normal_max,
+            latest_level=latest_level,
+            latest_timestamp=latest_timestamp,
+            latest_class=latest_class,
+            timestamps=store.timestamps[window],
+            levels=store.levels[window],
+            class_codes=store.class_codes[window],
+            trend_fit=trend_model.fit(),
+            anomalies=anomalies,
+            forecast_state=forecast_state,
+            overall=overall,
+            distribution=distribution,
+            window_metrics=window_metrics,
+            tag_comparisons=tag_comparisons,
+        )
+
+    @traced("insights.compute")
+    def compute(self, snapshot: InsightsSnapshot) -> InsightsResult:
+        """Compute all insights from a snapshot."""
+        result = InsightsResult(
+            profile=snapshot.profile,
+            test_type=snapshot.test_type,
+            normal_min=snapshot.normal_min,
+            normal_max=snapshot.normal_max,
+            anomalies=snapshot.anomalies,
+            overall=snapshot.overall,
+            distribution=snapshot.distribution,
+            tag_comparisons=snapshot.tag_comparisons,
+        )
+        result.trend = self.compute_trend(snapshot)
+
+        if snapshot.latest_level is None:
+            return result
+
+        result.latest_level = snapshot.latest_level
+        result.latest_date = date.fromordinal(EPOCH_ORDINAL + int(snapshot.latest_timestamp // 1))
+        result.days_since_latest = (snapshot.today - result.latest_date).days
+        result.status = snapshot.latest_class
+        result.change = self.compute_change(snapshot.window_metrics)
+        if snapshot.forecast_state is not None:
+            result.forecast = forecast(snapshot.forecast_state, snapshot.normal_min, snapshot.normal_max)
+        result.recommendations = self.recommendations(result.status, result.days_since_latest,
+                                                      result.forecast, snapshot.today, result.unit)
+        return result
+
+    def compute_trend(self, snapshot: InsightsSnapshot) -> Optional[TrendSummary]:
+        """Summarize the trend window, or None if it has too few readings."""
+        levels = snapshot.levels
+        if len(levels) < MIN_TREND_POINTS:
+            return None
+
+        # Readings all at the same moment have no slope
+        fit = snapshot.trend_fit
+        direction = fit.direction if fit is not None else "stable"
+
+        std = float(np.std(levels, ddof=1))
+        if std < VARIABILITY_LIMITS[0]:
+            variability = "low"
+        elif std < VARIABILITY_LIMITS[1]:
+            variability = "moderate"
+        else:
+            variability = "high"
+
+        # Each reading was classified against its own test type's range
+        class_counts = np.bincount(snapshot.class_codes, minlength=len(LEVEL_CLASSES))
+        low_count = int(class_counts[LEVEL_CLASS_CODES["low"]])
+        high_count = int(class_counts[LEVEL_CLASS_CODES["high"]])
+
+        return TrendSummary(
+            direction=direction,
+            fit=fit,
+            count=len(levels),
+            mean=float(levels.mean()),
+            std=std,
+            min=float(levels.min()),
+            max=float(levels.max()),
+            variability=variability,
+            low_count=low_count,
+            normal_count=len(levels) - low_count - high_count,
+            high_count=high_count,
+        )
+
+    def compute_change(self, window_metrics: List[Dict]) -> Optional[ReadingChange]:
+        """Summarize the latest reading's window metrics, or None if it is outside the window."""
+        if not window_metrics:
+            return None
+        latest = window_metrics[-1]
+        intervals = [m['days_since_previous'] for m in window_metrics
+                     if m['days_since_previous'] is not None]
+        return ReadingChange(
+            delta=latest['delta'],
+            days_since_previous=latest['days_since_previous'],
+            rolling_mean=latest['rolling_mean'],
+            rolling_count=latest['rolling_count'],
+            median_interval_days=float(np.median(intervals)) if intervals else None,
+        )
+
+    def recommendations(self, status: str, days_since_latest: int,
+                        forecast: Optional[Forecast] = None, today: date = None,
+                        unit: str = DEFAULT_UNIT) -> List[str]:
+        """Recommendations for the latest reading's status and forecast."""
+        if status == "low":
+            recommendations = list(LOW_RECOMMENDATIONS)
+        elif status == "high":
+            recommendations = list(HIGH_RECOMMENDATIONS)
+        else:
+            recommendations = list(NORMAL_RECOMMENDATIONS)
+
+        crossing = forecast.crossing if forecast is not None else None
+        if crossing is not None and (today is None or crossing.on_date >= today):
+            when = crossing.on_date.strftime("%b %d, %Y")
+            leaving = (crossing.bound == "min") == (forecast.slope_per_day < 0)
+            if leaving:
+                direction = "fall below" if crossing.bound == "min" else "rise above"
+                recommendations.append(
+                    f"⚠️ At the current trend your level may {direction} "
+                    f"{crossing.value:g} {unit} around {when}; consider retesting before then"
+                )
+            else:
+                recommendations.append(
+                    f"📈 At the current trend your level should return to the normal range around {when}"
+                )
+
+        recommendations.extend(GENERAL_RECOMMENDATIONS)
+        if days_since_latest > RETEST_DAYS:
+            recommendations.append(RETEST_RECOMMENDATION)
+        return recommendations
+
+    def run(self, today: date = None) -> InsightsResult:
+        """Take a snapshot and compute insights from it."""
+        return self.compute(self.snapshot(today))
+
+
+def benchmark(db_path: str, repeat: int = 100) -> Dict:
+    """Time InsightsEngine.run against a database, after the store is loaded."""
+    from database.db_manager import DatabaseManager
+
+    db_manager = DatabaseManager(db_path)
+    db_manager.init_db()
+    try:
+        engine = InsightsEngine(db_manager)
+        started = time.perf_counter()
+        db_manager.get_reading_store()
+        load_seconds = time.perf_counter() - started
+
+        timings = np.empty(repeat)
+        for i in range(repeat):
+            started = time.perf_counter()
+            engine.run()
+            timings[i] = time.perf_counter() - started
+        return {
+            'readings': len(db_manager.get_reading_store()),
+            'load_seconds': load_seconds,
+            'median_seconds': float(np.median(timings)),
+            'p95_seconds': float(np.percentile(timings, 95)),
+        }
+    finally:
+        db_manager.close()
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Benchmark the insights engine.")
+    parser.add_argument("db_path", help="SQLite database to read")
+    parser.add_argument("--repeat", type=int, default=100, help="number of timed runs")
+    args = parser.parse_args(argv)
+
+    result = benchmark(args.db_path, args.repeat)
+    print(f"{result['readings']} readings, store loaded in {result['load_seconds'] * 1000:.1f} ms")
+    print(f"run: median {result['median_seconds'] * 1000:.3f} ms, "
+          f"p95 {result['p95_seconds'] * 1000:.3f} ms")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
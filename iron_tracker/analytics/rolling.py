@@ -0,0 +1,247 @@
+import math
+from typing import Tuple
+
+import numpy as np
+
+from database.reading_store import series_timestamps
+
+
+# Largest exponent used when rescaling decay weights, well below float64 overflow
+_MAX_EXPONENT = 600.0
+
+
+class RollingOverlay:
+    """Rolling statistics over an irregularly sampled reading series.
+
+    Keeps three overlays in sync with the series:
+    - a time-weighted moving average over the trailing window_days, treating the
+      signal as piecewise linear between readings
+    - an exponentially weighted moving average whose weights decay with elapsed
+      time (half-life in days) rather than with the number of readings
+    - the exponentially weighted standard deviation, for ±k·σ bands around the EWMA
+
+    extend() computes a batch with NumPy; append() folds in a single later reading
+    in amortized O(1) by carrying the decayed sums and a sliding window pointer.
+    """
+
+    def __init__(self, window_days: float = 30.0, halflife_days: float = 14.0, k: float = 2.0):
+        self.window_days = window_days
+        self.tau = halflife_days / math.log(2)
+        self.k = k
+
+        self._size = 0
+        self._times = np.empty(0)
+        self._levels = np.empty(0)
+        self._area = np.empty(0)  # cumulative trapezoid integral of the levels
+        self._twma = np.empty(0)
+        self._ewma = np.empty(0)
+        self._ewstd = np.empty(0)
+
+        # Decayed sums of weights, levels and squared levels at the last timestamp
+        self._weight = 0.0
+        self._weighted_sum = 0.0
+        self._weighted_sq_sum = 0.0
+        # Index of the last reading at or before the start of the trailing window
+        self._window_index = 0
+
+    @classmethod
+    def from_series(cls, series, **kwargs) -> "RollingOverlay":
+        """Build an overlay from chronological (reading_date, reading_time, iron_level) rows."""
+        overlay = cls(**kwargs)
+        if series:
+            dates, times, levels = zip(*series)
+            overlay.extend(series_timestamps(dates, times), levels)
+        return overlay
+
+    def __len__(self) -> int:
+        return self._size
+
+    @property
+    def times(self) -> np.ndarray:
+        return self._times[:self._size]
+
+    @property
+    def levels(self) -> np.ndarray:
+        return self._levels[:self._size]
+
+    @property
+    def twma(self) -> np.ndarray:
+        return self._twma[:self._size]
+
+    @property
+    def ewma(self) -> np.ndarray:
+        return self._ewma[:self._size]
+
+    @property
+    def ewstd(self) -> np.ndarray:
+        return self._ewstd[:self._size]
+
+    @property
+    def upper_band(self) -> np.ndarray:
+        return self.ewma + self.k * self.ewstd
+
+    @property
+    def lower_band(self) -> np.ndarray:
+        return self.ewma - self.k * self.ewstd
+
+    @property
+    def last_time(self) -> float:
+        return float(self._times[self._size - 1]) if self._size else -math.inf
+
+    def clear(self) -> None:
+        """Drop all readings and cached statistics."""
+        self.__init__(self.window_days, self.tau * math.log(2), self.k)
+
+    def _reserve(self, capacity: int) -> None:
+        """Grow the backing arrays geometrically so appends stay amortized O(1)."""
+        if capacity <= len(self._times):
+            return
+        new_capacity = max(capacity, 2 * len(self._times), 64)
+        for name in ("_times", "_levels", "_area", "_twma", "_ewma", "_ewstd"):
+            old = getattr(self, name)
+            grown = np.empty(new_capacity)
+            grown[:self._size] = old[:self._size]
+            setattr(self, name, grown)
+
+    def extend(self, timestamps, levels) -> None:
+        """Add a batch of readings, sorted by time and not earlier than the last one."""
+        timestamps = np.asarray(timestamps, dtype=np.float64)
+        levels = np.asarray(levels, dtype=np.float64)
+        count = len(timestamps)
+        if count == 0:
+            return
+        if timestamps[0] < self.last_time or np.any(np.diff(timestamps) < 0):
+            raise ValueError("Readings must be appended in chronological order")
+
+        start = self._size
+        end = start + count
+        self._reserve(end)
+        self._times[start:end] = timestamps
+        self._levels[start:end] = levels
+
+        # Cumulative trapezoid integral, continuing from the previous reading
+        times = self._times[max(start - 1, 0):end]
+        values = self._levels[max(start - 1, 0):end]
+        segments = np.diff(times) * (values[1:] + values[:-1]) / 2.0
+        offset = self._area[start - 1] if start else 0.0
+        if start:
+            self._area[start:end] = offset + np.cumsum(segments)
+        else:
+            self._area[0] = 0.0
+            self._area[1:end] = np.cumsum(segments)
+
+        self._twma[start:end] = self._window_average(start, end)
+        self._extend_ewma(start, end)
+        self._size = end
+        self._window_index = self._find_window_index(self._times[end - 1] - self.window_days)
+
+    def append(self, timestamp: float, level: float) -> None:
+        """Add one reading that is not earlier than the last one."""
+        if timestamp < self.last_time:
+            raise ValueError("Readings must be appended in chronological order")
+
+        index = self._size
+        self._reserve(index + 1)
+        self._times[index] = timestamp
+        self._levels[index] = level
+        if index:
+            previous_time = self._times[index - 1]
+            self._area[index] = self._area[index - 1] + \
+                (timestamp - previous_time) * (level + self._levels[index - 1]) / 2.0
+            decay = math.exp(-(timestamp - previous_time) / self.tau)
+        else:
+            self._area[index] = 0.0
+            decay = 0.0
+        self._size = index + 1
+
+        # Slide the window pointer forward; it never moves back, so this is amortized O(1)
+        window_start = timestamp - self.window_days
+        while self._window_index + 1 < index and self._times[self._window_index + 1] <= window_start:
+            self._window_index += 1
+        self._twma[index] = self._window_average_at(index, self._window_index)
+
+        self._weight = self._weight * decay + 1.0
+        self._weighted_sum = self._weighted_sum * decay + level
+        self._weighted_sq_sum = self._weighted_sq_sum * decay + level * level
+        self._ewma[index], self._ewstd[index] = self._current_ew_stats()
+
+    def window(self, start: float, end: float) -> slice:
+        """Return the slice of readings with timestamps in [start, end]."""
+        times = self.times
+        return slice(int(np.searchsorted(times, start, "left")),
+                     int(np.searchsorted(times, end, "right")))
+
+    def _find_window_index(self, window_start: float) -> int:
+        """Index of the last reading at or before window_start (0 if none)."""
+        return max(int(np.searchsorted(self._times[:self._size], window_start, "right")) - 1, 0)
+
+    def _area_at(self, t, index, limit: int):
+        """Integral from the first reading to time t, where t lies at or after reading index.
+
+        Only the first limit readings are considered valid.
+        """
+        t0 = self._times[index]
+        x0 = self._levels[index]
+        following = np.minimum(index + 1, limit - 1)
+        t1 = self._times[following]
+        x1 = self._levels[following]
+        has_next = t1 > t0
+        slope = np.where(has_next, (x1 - x0) / np.where(has_next, t1 - t0, 1.0), 0.0)
+        xt = x0 + slope * (t - t0)
+        return self._area[index] + (t - t0) * (x0 + xt) / 2.0
+
+    def _window_average(self, start: int, end: int) -> np.ndarray:
+        """Vectorized time-weighted average over the trailing window for readings start..end."""
+        times = self._times[:end]
+        targets = times[start:end]
+        window_start = np.maximum(targets - self.window_days, times[0])
+        start_index = np.maximum(np.searchsorted(times, window_start, "right") - 1, 0)
+        covered = targets - window_start
+        area = self._area[start:end] - self._area_at(window_start, start_index, end)
+        return np.where(covered > 0, area / np.where(covered > 0, covered, 1.0),
+                        self._levels[start:end])
+
+    def _window_average_at(self, index: int, start_index: int) -> float:
+        """Time-weighted average over the trailing window ending at reading index."""
+        target = self._times[index]
+        window_start = max(target - self.window_days, self._times[0])
+        covered = target - window_start
+        if covered <= 0:
+            return float(self._levels[index])
+        area = self._area[index] - self._area_at(window_start, start_index, index + 1)
+        return float(area / covered)
+
+    def _extend_ewma(self, start: int, end: int) -> None:
+        """Vectorized time-decayed EWMA, processed in blocks that keep exp() finite."""
+        position = start
+        while position < end:
+            reference = self._times[position]
+            block_end = position + int(np.searchsorted(
+                self._times[position:end], reference + _MAX_EXPONENT * self.tau, "right"))
+            times = self._times[position:block_end]
+            levels = self._levels[position:block_end]
+
+            # Carry the running sums into this block, decayed to its first timestamp
+            previous_time = self._times[position - 1] if position else reference
+            carry = math.exp(-(reference - previous_time) / self.tau) if position else 0.0
+            growth = np.exp((times - reference) / self.tau)
+            decay = 1.0 / growth
+            weight = decay * (self._weight * carry + np.cumsum(growth))
+            weighted_sum = decay * (self._weighted_sum * carry + np.cumsum(growth * levels))
+            weighted_sq_sum = decay * (self._weighted_sq_sum * carry + np.cumsum(growth * levels * levels))
+
+            mean = weighted_sum / weight
+            variance = np.maximum(weighted_sq_sum / weight - mean * mean, 0.0)
+            self._ewma[position:block_end] = mean
+            self._ewstd[position:block_end] = np.sqrt(variance)
+
+            self._weight = float(weight[-1])
+            self._weighted_sum = float(weighted_sum[-1])
+            self._weighted_sq_sum = float(weighted_sq_sum[-1])
+            position = block_end
+
+    def _current_ew_stats(self) -> Tuple[float, float]:
+        """Mean and standard deviation from the current decayed sums."""
+        mean = self._weighted_sum / self._weight
+        variance = max(self._weighted_sq_sum / self._weight - mean * mean, 0.0)
+        return mean, math.sqrt(variance)
@@ -0,0 +1,188 @@
+"""Timing spans for the app's hot paths, kept in fixed-size ring buffers.
+
+Wrap a block in a span, or decorate a method, to record how long it takes:
+    with span("charts.build.trend"):
+        ...
+
+    @traced("history.refresh")
+    def refresh_data(self, force=False):
+        ...
+
+Each span name keeps its last TRACE_BUFFER_SIZE durations, so memory stays
+fixed however long the app runs, and summaries give p50/p95/p99 over that
+window. Recording takes a lock and a few array writes, cheap enough to
+leave on in release builds. dump() writes the summaries and raw samples to
+a JSON file that can be attached to a field report.
+"""
+import functools
+import json
+import platform
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass
+from typing import Callable, Dict, List, Optional
+
+import numpy as np
+
+
+# Durations kept per span name
+TRACE_BUFFER_SIZE = 256
+# Version of the dump() file layout
+TRACE_FORMAT_VERSION = 1
+
+
+class RingBuffer:
+    """The last capacity values written, oldest overwritten first."""
+
+    def __init__(self, capacity: int = TRACE_BUFFER_SIZE):
+        self.values = np.empty(capacity)
+        self.total = 0  # values ever written, including overwritten ones
+
+    @property
+    def capacity(self) -> int:
+        return len(self.values)
+
+    def __len__(self) -> int:
+        return min(self.total, self.capacity)
+
+    def append(self, value: float) -> None:
+        self.values[self.total % self.capacity] = value
+        self.total += 1
+
+    def last(self) -> Optional[float]:
+        return float(self.values[(self.total - 1) % self.capacity]) if self.total else None
+
+    def ordered(self) -> np.ndarray:
+        """The kept values, oldest first."""
+        if self.total <= self.capacity:
+            return self.values[:self.total].copy()
+        start = self.total % self.capacity
+        return np.concatenate([self.values[start:], self.values[:start]])
+
+
+@dataclass
+class SpanSummary:
+    """Duration percentiles of a span over its buffered samples, in milliseconds."""
+
+    name: str
+    count: int
+    samples: int
+    p50_ms: float
+    p95_ms: float
+    p99_ms: float
+    max_ms: float
+    last_ms: float
+
+    def __str__(self) -> str:
+        return (f"{self.name}: p50 {self.p50_ms:.1f} / p95 {self.p95_ms:.1f} / "
+                f"p99 {self.p99_ms:.1f} ms (n={self.count})")
+
+
+class Tracer:
+    """Records span durations by name; safe to use from worker threads."""
+
+    def __init__(self, capacity: int = TRACE_BUFFER_SIZE):
+        self.capacity = capacity
+        self.enabled = True
+        self.buffers: Dict[str, RingBuffer] = {}
+        self.started_at = time.time()
+        self._lock = threading.Lock()
+
+    def record(self, name: str, seconds: float) -> None:
+        if not self.enabled:
+            return
+        with self._lock:
+            buffer = self.buffers.get(name)
+            if buffer is None:
+                buffer = self.buffers[name] = RingBuffer(self.capacity)
+            buffer.append(seconds * 1000)
+
+    @contextmanager
+    def span(self, name: str):
+        """Time the enclosed block, including when it raises."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - started)
+
+    def traced(self, name: str = None) -> Callable:
+        """Decorator timing every call of a function, named after it by default."""
+        def decorator(function: Callable) -> Callable:
+            span_name = name or function.__qualname__
+
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                with self.span(span_name):
+                    return function(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def summaries(self) -> List[SpanSummary]:
+        """Summaries of every span recorded so far, by name."""
+        with self._lock:
+            snapshot = {name: (buffer.ordered(), buffer.total, buffer.last())
+                        for name, buffer in self.buffers.items()}
+        summaries = []
+        for name in sorted(snapshot):
+            samples, count, last = snapshot[name]
+            p50, p95, p99 = np.percentile(samples, [50, 95, 99])
+            summaries.append(SpanSummary(
+                name=name,
+                count=count,
+                samples=len(samples),
+                p50_ms=float(p50),
+                p95_ms=float(p95),
+                p99_ms=float(p99),
+                max_ms=float(samples.max()),
+                last_ms=last,
+            ))
+        return summaries
+
+    def to_dict(self, include_samples: bool = True) -> Dict:
+        """Summaries, and optionally the buffered samples oldest first, as plain JSON types."""
+        with self._lock:
+            samples = {name: [round(value, 3) for value in buffer.ordered()]
+                       for name, buffer in self.buffers.items()}
+        report = {
+            'version': TRACE_FORMAT_VERSION,
+            'started_at': self.started_at,
+            'dumped_at': time.time(),
+            'capacity': self.capacity,
+            'platform': {
+                'system': platform.system(),
+                'release': platform.release(),
+                'machine': platform.machine(),
+                'python': sys.version.split()[0],
+            },
+            'spans': [asdict(summary) for summary in self.summaries()],
+        }
+        if include_samples:
+            report['samples_ms'] = samples
+        return report
+
+    def dump(self, path: str, include_samples: bool = True) -> None:
+        """Write to_dict() to a JSON file."""
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(self.to_dict(include_samples), f, indent=2)
+
+    def reset(self) -> None:
+        with self._lock:
+            self.buffers.clear()
+            self.started_at = time.time()
+
+
+# Shared by the screens, the chart prefetch worker and the debug overlay
+TRACER = Tracer()
+
+
+def span(name: str):
+    """TRACER.span(name)."""
+    return TRACER.span(name)
+
+
+def traced(name: str = None) -> Callable:
+    """TRACER.traced(name)."""
+    return TRACER.traced(name)
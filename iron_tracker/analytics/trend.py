@@ -0,0 +1,293 @@
+"""Trend slopes over irregularly spaced readings.
+
+Slopes are fitted against the actual reading timestamps (float days) and
+reported in μg/dL per month, with confidence intervals from ordinary least
+squares and from the Theil–Sen estimator, which is robust to outliers.
+"""
+import math
+from dataclasses import dataclass
+from statistics import NormalDist
+from typing import Optional
+
+import numpy as np
+
+from database.rollups import BUCKET_DAYS
+
+
+MONTH_DAYS = BUCKET_DAYS["month"]
+# Fewest readings for which a slope is reported
+MIN_TREND_POINTS = 3
+
+
+@dataclass
+class SlopeEstimate:
+    """A slope in μg/dL per month with its confidence interval."""
+
+    slope: float
+    lower: float
+    upper: float
+    count: int
+
+    @property
+    def direction(self) -> str:
+        """"increasing" or "decreasing" when the interval excludes zero, else "stable"."""
+        if self.lower > 0:
+            return "increasing"
+        if self.upper < 0:
+            return "decreasing"
+        return "stable"
+
+
+@dataclass
+class TrendFit:
+    """OLS and Theil–Sen slope estimates over the same readings."""
+
+    ols: SlopeEstimate
+    theil_sen: SlopeEstimate
+
+    @property
+    def direction(self) -> str:
+        return self.theil_sen.direction
+
+
+def t_quantile(p: float, df: int) -> float:
+    """Quantile of Student's t distribution.
+
+    Exact for one and two degrees of freedom, Cornish–Fisher expansion of the
+    normal quantile otherwise (error below 1e-3 from three degrees of freedom).
+    """
+    if df == 1:
+        return math.tan(math.pi * (p - 0.5))
+    if df == 2:
+        return (2 * p - 1) / math.sqrt(2 * p * (1 - p))
+    z = NormalDist().inv_cdf(p)
+    g1 = (z ** 3 + z) / 4
+    g2 = (5 * z ** 5 + 16 * z ** 3 + 3 * z) / 96
+    g3 = (3 * z ** 7 + 19 * z ** 5 + 17 * z ** 3 - 15 * z) / 384
+    g4 = (79 * z ** 9 + 776 * z ** 7 + 1482 * z ** 5 - 1920 * z ** 3 - 945 * z) / 92160
+    return z + g1 / df + g2 / df ** 2 + g3 / df ** 3 + g4 / df ** 4
+
+
+class RegressionStats:
+    """Running means and co-moments of (time, level), updatable in both directions.
+
+    Uses Welford-style centered updates rather than raw sums of squares, so
+    timestamps around 20000 days do not cancel out.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.mean_t = 0.0
+        self.mean_y = 0.0
+        self.s_tt = 0.0
+        self.s_ty = 0.0
+        self.s_yy = 0.0
+
+    def add(self, t: float, y: float) -> None:
+        self.count += 1
+        dt = t - self.mean_t
+        dy = y - self.mean_y
+        self.mean_t += dt / self.count
+        self.mean_y += dy / self.count
+        self.s_tt += dt * (t - self.mean_t)
+        self.s_ty += dt * (y - self.mean_y)
+        self.s_yy += dy * (y - self.mean_y)
+
+    def remove(self, t: float, y: float) -> None:
+        if self.count <= 1:
+            self.__init__()
+            return
+        mean_t = (self.count * self.mean_t - t) / (self.count - 1)
+        mean_y = (self.count * self.mean_y - y) / (self.count - 1)
+        self.s_tt -= (t - mean_t) * (t - self.mean_t)
+        self.s_ty -= (t - mean_t) * (y - self.mean_y)
+        self.s_yy -= (y - mean_y) * (y - self.mean_y)
+        self.count -= 1
+        self.mean_t = mean_t
+        self.mean_y = mean_y
+
+    @classmethod
+    def from_arrays(cls, timestamps: np.ndarray, levels: np.ndarray) -> "RegressionStats":
+        """Compute the statistics of a batch of readings in one vectorized pass."""
+        stats = cls()
+        if not len(timestamps):
+            return stats
+        stats.count = len(timestamps)
+        stats.mean_t = float(timestamps.mean())
+        stats.mean_y = float(levels.mean())
+        dt = timestamps - stats.mean_t
+        dy = levels - stats.mean_y
+        stats.s_tt = float(dt @ dt)
+        stats.s_ty = float(dt @ dy)
+        stats.s_yy = float(dy @ dy)
+        return stats
+
+    def slope(self, confidence: float = 0.95) -> Optional[SlopeEstimate]:
+        """OLS slope per month with a t-based confidence interval."""
+        if self.count < MIN_TREND_POINTS or self.s_tt <= 0:
+            return None
+        slope = float(self.s_ty / self.s_tt)
+        residual = max(self.s_yy - slope * self.s_ty, 0.0)
+        se = math.sqrt(residual / (self.count - 2) / self.s_tt)
+        half_width = t_quantile((1 + confidence) / 2, self.count - 2) * se
+        return SlopeEstimate(
+            slope * MONTH_DAYS, (slope - half_width) * MONTH_DAYS,
+            (slope + half_width) * MONTH_DAYS, self.count
+        )
+
+
+def pairwise_slopes(timestamps, levels) -> np.ndarray:
+    """Slopes between every pair of readings with distinct timestamps."""
+    timestamps = np.asarray(timestamps, dtype=np.float64)
+    levels = np.asarray(levels, dtype=np.float64)
+    i, j = np.triu_indices(len(timestamps), k=1)
+    dt = timestamps[j] - timestamps[i]
+    keep = dt != 0
+    return (levels[j][keep] - levels[i][keep]) / dt[keep]
+
+
+def theil_sen_from_sorted(slopes: np.ndarray, count: int,
+                          confidence: float = 0.95) -> Optional[SlopeEstimate]:
+    """Theil–Sen slope per month from sorted pairwise slopes of count readings.
+
+    The interval is Sen's distribution-free one, based on the variance of
+    Kendall's S (ties ignored).
+    """
+    pairs = len(slopes)
+    if count < MIN_TREND_POINTS or pairs == 0:
+        return None
+    z = NormalDist().inv_cdf((1 + confidence) / 2)
+    c = z * math.sqrt(count * (count - 1) * (2 * count + 5) / 18)
+    # The bounds are the M1-th and (M2 + 1)-th smallest slopes, counting from
+    # one, with M1 = (N - C) / 2 and M2 = (N + C) / 2: zero-based M1 - 1 and
+    # M2, rounded outwards so the interval is never narrower than Sen's
+    lower_rank = int(math.floor((pairs - c) / 2)) - 1
+    upper_rank = int(math.ceil((pairs + c) / 2))
+    lower = slopes[max(lower_rank, 0)]
+    upper = slopes[min(upper_rank, pairs - 1)]
+    return SlopeEstimate(
+        float(np.median(slopes)) * MONTH_DAYS, float(lower) * MONTH_DAYS,
+        float(upper) * MONTH_DAYS, count
+    )
+
+
+def fit_trend(timestamps, levels, confidence: float = 0.95) -> Optional[TrendFit]:
+    """Fit both estimators to a batch of readings in one vectorized pass."""
+    timestamps = np.asarray(timestamps, dtype=np.float64)
+    levels = np.asarray(levels, dtype=np.float64)
+    if len(timestamps) < MIN_TREND_POINTS:
+        return None
+
+    ols = RegressionStats.from_arrays(timestamps, levels).slope(confidence)
+    theil_sen = theil_sen_from_sorted(np.sort(pairwise_slopes(timestamps, levels)),
+                                      len(timestamps), confidence)
+    if ols is None or theil_sen is None:
+        return None
+    return TrendFit(ols, theil_sen)
+
+
+class TrendModel:
+    """Incrementally maintained trend over a sliding time window.
+
+    Keeps the regression co-moments and the sorted pairwise slopes of the
+    readings in the window. Adding or removing a reading costs O(n) for its
+    n pairs instead of refitting from scratch; at most max_points readings are
+    kept so the slope list stays bounded.
+    """
+
+    def __init__(self, window_days: float = 90, max_points: int = 400, confidence: float = 0.95):
+        self.window_days = window_days
+        self.max_points = max_points
+        self.confidence = confidence
+        self.cutoff = -math.inf
+        self.clear()
+
+    def clear(self) -> None:
+        self.timestamps = np.empty(0)
+        self.levels = np.empty(0)
+        self.slopes = np.empty(0)
+        self.stats = RegressionStats()
+
+    def __len__(self) -> int:
+        return len(self.timestamps)
+
+    def extend(self, timestamps, levels) -> None:
+        """Add a batch of readings, vectorized when the model is empty."""
+        timestamps = np.asarray(timestamps, dtype=np.float64)
+        levels = np.asarray(levels, dtype=np.float64)
+        if len(self):
+            for t, y in zip(timestamps, levels):
+                self.add(t, y)
+            return
+        if not len(timestamps):
+            return
+
+        self.advance(timestamps.max() - self.window_days)
+        order = np.argsort(timestamps, kind="stable")
+        order = order[timestamps[order] >= self.cutoff][-self.max_points:]
+        self.timestamps = timestamps[order]
+        self.levels = levels[order]
+        self.slopes = np.sort(pairwise_slopes(self.timestamps, self.levels))
+        self.stats = RegressionStats.from_arrays(self.timestamps, self.levels)
+
+    def add(self, t: float, y: float) -> None:
+        """Add one reading, dropping readings that fall out of the window."""
+        self.advance(t - self.window_days)
+        if t < self.cutoff:
+            return
+
+        dt = t - self.timestamps
+        keep = dt != 0
+        new_slopes = np.sort((y - self.levels[keep]) / dt[keep])
+        self.slopes = np.insert(self.slopes, np.searchsorted(self.slopes, new_slopes), new_slopes)
+        self.timestamps = np.append(self.timestamps, t)
+        self.levels = np.append(self.levels, y)
+        self.stats.add(t, y)
+
+        while len(self.timestamps) > self.max_points:
+            oldest = int(np.argmin(self.timestamps))
+            self._remove_at(oldest)
+
+    def remove(self, t: float, y: float) -> bool:
+        """Remove a reading (e.g. after a delete). Returns False if it was not in the window."""
+        matches = np.flatnonzero((self.timestamps == t) & (self.levels == y))
+        if not len(matches):
+            return False
+        self._remove_at(int(matches[0]))
+        return True
+
+    def advance(self, cutoff: float) -> None:
+        """Drop readings older than cutoff; the cutoff never moves backwards."""
+        if cutoff <= self.cutoff:
+            return
+        self.cutoff = cutoff
+        for index in sorted(np.flatnonzero(self.timestamps < cutoff), reverse=True):
+            self._remove_at(int(index))
+
+    def fit(self) -> Optional[TrendFit]:
+        """Current OLS and Theil–Sen estimates, or None with too few readings."""
+        ols = self.stats.slope(self.confidence)
+        theil_sen = theil_sen_from_sorted(self.slopes, len(self), self.confidence)
+        if ols is None or theil_sen is None:
+            return None
+        return TrendFit(ols, theil_sen)
+
+    def _remove_at(self, index: int) -> None:
+        t = self.timestamps[index]
+        y = self.levels[index]
+        self.timestamps = np.delete(self.timestamps, index)
+        self.levels = np.delete(self.levels, index)
+        self.stats.remove(t, y)
+
+        dt = t - self.timestamps
+        keep = dt != 0
+        old_slopes = np.sort((y - self.levels[keep]) / dt[keep])
+        # Equal slopes sit next to each other, so offset repeated values by their rank
+        ranks = np.arange(len(old_slopes)) - np.searchsorted(old_slopes, old_slopes)
+        positions = np.searchsorted(self.slopes, old_slopes) + ranks
+        if len(positions) and (positions[-1] >= len(self.slopes)
+                               or not np.array_equal(self.slopes[positions], old_slopes)):
+            # Rounding made a slope differ from when it was inserted; rebuild the list
+            self.slopes = np.sort(pairwise_slopes(self.timestamps, self.levels))
+            return
+        self.slopes = np.delete(self.slopes, positions)
@@ -0,0 +1,362 @@
+from datetime import date
+
+import matplotlib.dates as mdates
+import numpy as np
+from matplotlib.figure import Figure
+
+from database.derived import test_type_unit
+from database.quantiles import QuantileSummary
+from database.reading_store import reading_timestamp
+from database.rollups import bucket_end, choose_resolution
+from database.window_metrics import ROLLING_WINDOW_DAYS
+
+
+# Maximum number of buckets drawn for the visible part of the trend chart
+TREND_MAX_POINTS = 400
+
+CHART_TYPES = ("trend", "histogram", "monthly")
+
+
+class NoChartData(Exception):
+    """Raised when there is not enough data to draw a chart."""
+
+    DEFAULT_MESSAGE = "No data available for charts.\nAdd some iron level readings first."
+
+    def __init__(self, message: str = DEFAULT_MESSAGE):
+        super().__init__(message)
+        self.message = message
+
+
+def get_normal_range(db_manager, test_type: str = None):
+    """Get the (min, max) normal range of a test type (default: Serum Iron) for the user's sex and age."""
+    if test_type is None:
+        return db_manager.get_normal_range()
+    return db_manager.get_normal_range(test_type)
+
+
+def level_label(test_type: str = None) -> str:
+    """Axis label for the levels of one test type, or of all readings."""
+    if test_type is None:
+        return 'Iron Level (μg/dL)'
+    return f'{test_type} ({test_type_unit(test_type)})'
+
+
+
+def new_figure():
+    """Create a figure and axes without going through pyplot, so it works headless."""
+    fig = Figure(figsize=(10, 6))
+    fig.patch.set_facecolor('#FAFAFA')
+    ax = fig.subplots()
+    return fig, ax
+
+
+class TrendChart:
+    """Trend line figure that draws rollups for whatever date range is visible.
+
+    With a test_type only that type's readings are drawn; otherwise all of them.
+    A single test type without a rolling overlay gets a rolling average from
+    the SQL window metrics instead.
+    """
+
+    def __init__(self, db_manager, overlay=None, test_type: str = None):
+        self.db_manager = db_manager
+        self.overlay = overlay
+        self.test_type = test_type
+
+        first_date, last_date = db_manager.get_reading_date_bounds(test_type)
+        if first_date is None:
+            raise NoChartData()
+
+        normal_min, normal_max = get_normal_range(db_manager, test_type)
+        unit = test_type_unit(test_type)
+
+        # Create the plot
+        self.figure, ax = new_figure()
+        self.axes = ax
+
+        # Mean line; data is filled in per viewport by load_viewport
+        self.line, = ax.plot([], [], marker='o', linewidth=2, markersize=6,
+                             color='#F44336', alpha=0.8, label=test_type or 'Iron Levels')
+        self.band = None
+
+        # Readings flagged by the anomaly detector
+        self.anomaly_markers, = ax.plot([], [], linestyle='none', marker='X', markersize=9,
+                                        color='#B71C1C', label='Anomaly')
+
+        # Rolling-statistics overlays
+        self.overlay_lines = None
+        self.overlay_band = None
+        if overlay is not None:
+            twma_line, = ax.plot([], [], linewidth=1.5, color='#3F51B5',
+                                 label=f'{overlay.window_days:.0f}-day Moving Avg')
+            ewma_line, = ax.plot([], [], linewidth=1.5, color='#009688', linestyle='--',
+                                 label='EWMA')
+            self.overlay_lines = (twma_line, ewma_line)
+            # Proxy artist so the band gets a legend entry
+            ax.fill_between([], [], [], color='#009688', alpha=0.12,
+                            label=f'EWMA ±{overlay.k:g}σ')
+        self.rolling_line = None
+        if overlay is None and test_type is not None:
+            self.rolling_line, = ax.plot([], [], linewidth=1.5, color='#3F51B5',
+                                         label=f'{ROLLING_WINDOW_DAYS}-day Rolling Avg')
+
+        # Add normal range bands
+        ax.axhspan(normal_min, normal_max, alpha=0.2, color='green',
+                   label=f'Normal Range ({normal_min}-{normal_max} {unit})')
+        ax.axhline(y=normal_min, color='green', linestyle='--', alpha=0.5)
+        ax.axhline(y=normal_max, color='green', linestyle='--', alpha=0.5)
+
+        # Formatting
+        ax.set_xlabel('Date', fontsize=12)
+        ax.set_ylabel(level_label(test_type), fontsize=12)
+        ax.set_title(f'{test_type or "Iron Level"} Trend Over Time', fontsize=14, fontweight='bold')
+        ax.grid(True, alpha=0.3)
+        ax.legend(loc='upper left')
+
+        # Date ticks adapt to the zoom level
+        locator = mdates.AutoDateLocator()
+        ax.xaxis.set_major_locator(locator)
+        ax.xaxis.set_major_formatter(mdates.ConciseDateFormatter(locator))
+
+        # Full history plus a day of margin on each side
+        self.extent = (mdates.date2num(first_date) - 1, mdates.date2num(last_date) + 1)
+        ax.set_xlim(*self.extent)
+
+        # Fix the y-axis to the overall range so it stays put while zooming
+        overall = db_manager.get_rollups("quarter", first_date, last_date, test_type)
+        low = min(min(r['min_level'] for r in overall), normal_min)
+        high = max(max(r['max_level'] for r in overall), normal_max)
+        ax.set_ylim(low - 10, high + 10)
+
+        self.figure.tight_layout()
+        self.loaded = None
+        self.load_viewport()
+
+    def load_viewport(self) -> bool:
+        """Load rollups covering the visible range at a resolution that fits it.
+
+        Returns True if the plotted data changed.
+        """
+        left, right = self.axes.get_xlim()
+        visible_start = mdates.num2date(left).date()
+        visible_end = mdates.num2date(right).date()
+        resolution = choose_resolution(visible_start, visible_end, TREND_MAX_POINTS)
+
+        # Only query again when the resolution changes or the view leaves the loaded range
+        loaded = self.loaded
+        if loaded is not None and loaded[0] == resolution and left >= loaded[1] and right <= loaded[2]:
+            return False
+
+        span = right - left
+        load_left = max(left - span, self.extent[0])
+        load_right = min(right + span, self.extent[1])
+        rollups = self.db_manager.get_rollups(
+            resolution,
+            mdates.num2date(load_left).date(),
+            mdates.num2date(load_right).date(),
+            self.test_type
+        )
+        self.draw_rollups(rollups, resolution)
+        self.draw_anomalies(
+            self.db_manager.get_anomalies(mdates.num2date(load_left).date(),
+                                          mdates.num2date(load_right).date(),
+                                          self.test_type)
+        )
+        if self.overlay_lines is not None:
+            self.draw_overlay(load_left, load_right)
+        if self.rolling_line is not None:
+            metrics = self.db_manager.get_reading_metrics(
+                mdates.num2date(load_left).date(), mdates.num2date(load_right).date(), self.test_type
+            )
+            self.rolling_line.set_data([m['timestamp'] for m in metrics],
+                                       [m['rolling_mean'] for m in metrics])
+        self.loaded = (resolution, load_left, load_right)
+        return True
+
+    def draw_rollups(self, rollups, resolution):
+        """Replace the plotted mean line and min/max band with the given rollups."""
+        x_values = np.empty(len(rollups))
+        means = np.empty(len(rollups))
+        lows = np.empty(len(rollups))
+        highs = np.empty(len(rollups))
+
+        for i, rollup in enumerate(rollups):
+            start = date.fromisoformat(rollup['bucket_start'])
+            # Plot daily buckets on the day itself and coarser buckets at their midpoint
+            if resolution == "day":
+                x_values[i] = mdates.date2num(start)
+            else:
+                end = bucket_end(start, resolution)
+                x_values[i] = (mdates.date2num(start) + mdates.date2num(end)) / 2
+            means[i] = rollup['mean_level']
+            lows[i] = rollup['min_level']
+            highs[i] = rollup['max_level']
+
+        self.line.set_data(x_values, means)
+        self.line.set_markersize(6 if len(rollups) <= 60 else 3)
+
+        if self.band is not None:
+            self.band.remove()
+        self.band = self.axes.fill_between(
+            x_values, lows, highs, color='#F44336', alpha=0.15, linewidth=0
+        )
+
+    def draw_anomalies(self, anomalies):
+        """Mark flagged readings at their exact time and level."""
+        self.anomaly_markers.set_data(
+            [reading_timestamp(a['reading_date'], a['reading_time']) for a in anomalies],
+            [a['iron_level'] for a in anomalies]
+        )
+    
+    def draw_overlay(self, start, end):
+        """Plot the rolling overlays between two date numbers, thinned to fit the view."""
+        overlay = self.overlay
+        window = overlay.window(start, end)
+        step = max(1, (window.stop - window.start) // (2 * TREND_MAX_POINTS))
+        visible = slice(window.start, window.stop, step)
+
+        times = overlay.times[visible]
+        twma_line, ewma_line = self.overlay_lines
+        twma_line.set_data(times, overlay.twma[visible])
+        ewma_line.set_data(times, overlay.ewma[visible])
+
+        if self.overlay_band is not None:
+            self.overlay_band.remove()
+        self.overlay_band = self.axes.fill_between(
+            times, overlay.lower_band[visible], overlay.upper_band[visible],
+            color='#009688', alpha=0.12, linewidth=0
+        )
+
+
+def build_histogram_figure(db_manager, test_type: str = None) -> Figure:
+    """Create a histogram showing distribution of iron levels.
+
+    Bin heights come from the merged quantile sketch, so the chart costs
+    the same for ten readings or ten thousand.
+    """
+    digest = db_manager.get_quantile_sketch(test_type=test_type)
+    if not len(digest):
+        raise NoChartData()
+
+    normal_min, normal_max = get_normal_range(db_manager, test_type)
+    unit = test_type_unit(test_type)
+    summary = QuantileSummary.from_digest(digest)
+    count = summary.count
+
+    # Create the plot
+    fig, ax = new_figure()
+
+    # Estimate histogram counts from the sketch's CDF
+    n_bins = min(15, count // 2 + 1) if count > 10 else 5
+    low, high = digest.min, digest.max
+    if high <= low:
+        low, high = low - 0.5, high + 0.5
+    bins = np.linspace(low, high, n_bins + 1)
+    counts = count * np.diff(digest.cdf(bins))
+    patches = ax.bar(bins[:-1], counts, width=np.diff(bins), align='edge', alpha=0.7,
+                     color='#2196F3', edgecolor='black')
+
+    # Color bars based on normal range
+    for i, patch in enumerate(patches):
+        bin_center = (bins[i] + bins[i+1]) / 2
+        if bin_center < normal_min:
+            patch.set_facecolor('#F44336')  # Red for low
+        elif bin_center > normal_max:
+            patch.set_facecolor('#FF9800')  # Orange for high
+        else:
+            patch.set_facecolor('#4CAF50')  # Green for normal
+
+    # Add normal range indicators
+    ax.axvline(x=normal_min, color='green', linestyle='--', alpha=0.7,
+               label=f'Normal Range ({normal_min}-{normal_max} {unit})')
+    ax.axvline(x=normal_max, color='green', linestyle='--', alpha=0.7)
+
+    # Median and interquartile range
+    ax.axvspan(summary.q1, summary.q3, color='#607D8B', alpha=0.15, label='Interquartile Range')
+    ax.axvline(x=summary.median, color='#37474F', linewidth=2,
+               label=f'Median ({summary.median:.1f} {unit})')
+
+    # Formatting
+    ax.set_xlabel(level_label(test_type), fontsize=12)
+    ax.set_ylabel('Frequency', fontsize=12)
+    ax.set_title(f'Distribution of {test_type or "Iron Levels"}', fontsize=14, fontweight='bold')
+    ax.grid(True, alpha=0.3, axis='y')
+    ax.legend()
+
+    # Add statistics text from the running accumulators and the sketch
+    stats = db_manager.get_running_stats(test_type)
+    ax.text(0.02, 0.98,
+            f'Mean: {stats.mean:.1f} {unit}\nStd Dev: {stats.std():.1f} {unit}\n'
+            f'Median: {summary.median:.1f} {unit}\nIQR: {summary.q1:.1f}–{summary.q3:.1f} {unit}\n'
+            f'P5–P95: {summary.p5:.1f}–{summary.p95:.1f} {unit}',
+            transform=ax.transAxes, verticalalignment='top',
+            bbox=dict(boxstyle='round', facecolor='white', alpha=0.8))
+
+    # Adjust layout
+    fig.tight_layout()
+    return fig
+
+
+def build_monthly_figure(db_manager, test_type: str = None) -> Figure:
+    """Create a chart showing monthly average iron levels."""
+    monthly_data = db_manager.get_period_aggregates("month", test_type=test_type)
+    if not monthly_data:
+        raise NoChartData()
+
+    months = [date.fromisoformat(row['period_start']) for row in monthly_data]
+    averages = [row['mean'] for row in monthly_data]
+
+    if len(months) < 2:
+        raise NoChartData("Need at least 2 months of data for monthly chart")
+
+    normal_min, normal_max = get_normal_range(db_manager, test_type)
+    unit = test_type_unit(test_type)
+
+    # Create the plot
+    fig, ax = new_figure()
+
+    # Plot monthly averages
+    bars = ax.bar(months, averages, alpha=0.7, color='#9C27B0',
+                  edgecolor='black', linewidth=1)
+
+    # Color bars based on normal range
+    for i, avg in enumerate(averages):
+        if avg < normal_min:
+            bars[i].set_facecolor('#F44336')  # Red for low
+        elif avg > normal_max:
+            bars[i].set_facecolor('#FF9800')  # Orange for high
+        else:
+            bars[i].set_facecolor('#4CAF50')  # Green for normal
+
+    # Add normal range indicators
+    ax.axhspan(normal_min, normal_max, alpha=0.2, color='green',
+               label=f'Normal Range ({normal_min}-{normal_max} {unit})')
+    ax.axhline(y=normal_min, color='green', linestyle='--', alpha=0.5)
+    ax.axhline(y=normal_max, color='green', linestyle='--', alpha=0.5)
+
+    # Formatting
+    ax.set_xlabel('Month', fontsize=12)
+    ax.set_ylabel(f'Average {level_label(test_type)}', fontsize=12)
+    ax.set_title(f'Monthly Average {test_type or "Iron Levels"}', fontsize=14, fontweight='bold')
+    ax.grid(True, alpha=0.3, axis='y')
+    ax.legend()
+
+    # Format dates on x-axis
+    ax.xaxis.set_major_formatter(mdates.DateFormatter('%b %Y'))
+    for label in ax.xaxis.get_majorticklabels():
+        label.set_rotation(45)
+
+    # Adjust layout
+    fig.tight_layout()
+    return fig
+
+
+def build_figure(db_manager, chart_type: str, overlay=None, test_type: str = None) -> Figure:
+    """Build a complete, static figure for any chart type, optionally for one test type."""
+    if chart_type == "trend":
+        return TrendChart(db_manager, overlay, test_type).figure
+    if chart_type == "histogram":
+        return build_histogram_figure(db_manager, test_type)
+    if chart_type == "monthly":
+        return build_monthly_figure(db_manager, test_type)
+    raise ValueError(f"Unknown chart type: {chart_type}")
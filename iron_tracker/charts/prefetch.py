@@ -0,0 +1,110 @@
+import threading
+import time
+from typing import Callable, Dict, Iterable, Optional
+
+from database.db_manager import DatabaseManager
+
+
+class ChartPrefetcher:
+    """Builds charts that are not on screen in a background thread while the app is idle.
+
+    The worker opens its own read-only database connection, so it never
+    contends with the UI thread for the shared one or touches the schema. It
+    only starts a build once no interaction has been reported for idle_delay
+    seconds, and checks again between charts, so scrolling or tapping pauses
+    prefetching. Results are tagged with the data
+    version they were built from and dropped once the data changes.
+    """
+
+    def __init__(self, db_path: str, builder: Callable, idle_delay: float = 0.5):
+        self.db_path = db_path
+        self.builder = builder
+        self.idle_delay = idle_delay
+
+        self.version = 0
+        self.pending = []
+        self.results: Dict[str, object] = {}
+        self.last_interaction = 0.0
+
+        self._condition = threading.Condition()
+        self._worker = None
+        self._stopped = False
+
+    def request(self, chart_types: Iterable[str]) -> None:
+        """Queue chart types for prefetching, skipping ones that are already built or queued."""
+        with self._condition:
+            for chart_type in chart_types:
+                if chart_type not in self.results and chart_type not in self.pending:
+                    self.pending.append(chart_type)
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._run, name="chart-prefetch", daemon=True)
+                self._worker.start()
+            self._condition.notify()
+
+    def take(self, chart_type: str) -> Optional[object]:
+        """Get a prefetched chart built from current data, or None if there is none yet."""
+        with self._condition:
+            return self.results.pop(chart_type, None)
+
+    def invalidate(self) -> None:
+        """Drop prefetched charts after the underlying data changed."""
+        with self._condition:
+            self.version += 1
+            self.results.clear()
+
+    def notify_interaction(self, *args) -> None:
+        """Record user activity so the worker backs off."""
+        self.last_interaction = time.monotonic()
+
+    def stop(self) -> None:
+        """Stop the worker thread."""
+        with self._condition:
+            self._stopped = True
+            self._condition.notify()
+
+    def _wait_for_idle(self) -> bool:
+        """Block until no interaction happened for idle_delay seconds. Returns False when stopped."""
+        with self._condition:
+            while not self._stopped:
+                remaining = self.last_interaction + self.idle_delay - time.monotonic()
+                if remaining <= 0:
+                    return True
+                self._condition.wait(remaining)
+        return False
+
+    def _run(self) -> None:
+        # The UI thread's connection owns the schema; this one only reads
+        db_manager = DatabaseManager(self.db_path)
+        db_manager.init_db(read_only=True)
+        try:
+            while True:
+                with self._condition:
+                    while not self.pending and not self._stopped:
+                        self._condition.wait()
+                    if self._stopped:
+                        return
+
+                if not self._wait_for_idle():
+                    return
+
+                with self._condition:
+                    if not self.pending:
+                        continue
+                    chart_type = self.pending.pop(0)
+                    version = self.version
+
+                try:
+                    result = self.builder(db_manager, chart_type)
+                except Exception as e:
+                    # Build errors surface when the chart is actually shown
+                    print(f"Error prefetching {chart_type} chart: {e}")
+                    continue
+
+                with self._condition:
+                    if version == self.version:
+                        self.results[chart_type] = result
+                    elif chart_type not in self.pending:
+                        # Data changed while building; try again with fresh data
+                        self.pending.append(chart_type)
+        finally:
+            db_manager.close()
@@ -0,0 +1,384 @@
+"""Cohort analytics across many iron tracker databases.
+
+Usage:
+    python cohort.py devices/ --jobs 8
+    python cohort.py a.db b.db --test-type Ferritin --json cohort.json
+
+Arguments may be database files or directories, which are searched for
+*.db files. Each database is opened read-only in a worker process and
+reduced to a CohortPartial: per test type, running statistics of all
+readings and of each person's latest reading, t-digests of the latest
+levels and of trend slopes, and counts of latest level classes and trend
+directions. Partials merge exactly (sketches approximately), so the parent
+folds each one in as it arrives and only a few jobs per worker are in
+flight; memory stays proportional to the number of test types, not of
+databases or readings.
+"""
+import argparse
+import json
+import os
+import sqlite3
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from dataclasses import dataclass, field
+from itertools import groupby
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+import numpy as np
+
+from analytics.trend import RegressionStats
+from database.patients import DEFAULT_PATIENT_ID, has_column
+from database.quantiles import QuantileSummary, TDigest
+from database.reference_ranges import (
+    DEFAULT_REFERENCE_RANGES, LEVEL_CLASSES, ReferenceRangeIndex, classify_level, resolve_range
+)
+from database.running_stats import RunningStats
+from database.window_metrics import TIMESTAMP_SQL
+
+
+# Each person's trend slope is fitted to their readings in this many days
+# up to their latest reading
+TREND_WINDOW_DAYS = 365
+TREND_DIRECTIONS = ("increasing", "stable", "decreasing")
+# Jobs submitted ahead per worker process; bounds the futures held at once
+PENDING_PER_WORKER = 4
+
+
+def level_stats(levels: np.ndarray) -> RunningStats:
+    """Welford accumulator of a batch of levels."""
+    if not len(levels):
+        return RunningStats()
+    mean = float(levels.mean())
+    deviations = levels - mean
+    return RunningStats(len(levels), mean, float(deviations @ deviations),
+                        float(levels.min()), float(levels.max()))
+
+
+@dataclass
+class TestTypeAggregate:
+    """Mergeable cohort aggregates of one test type."""
+
+    people: int = 0
+    readings: RunningStats = field(default_factory=RunningStats)
+    latest: RunningStats = field(default_factory=RunningStats)
+    latest_digest: TDigest = field(default_factory=TDigest)
+    level_classes: Dict[str, int] = field(default_factory=lambda: dict.fromkeys(LEVEL_CLASSES, 0))
+    slopes: RunningStats = field(default_factory=RunningStats)
+    slope_digest: TDigest = field(default_factory=TDigest)
+    directions: Dict[str, int] = field(default_factory=lambda: dict.fromkeys(TREND_DIRECTIONS, 0))
+
+    def merge(self, other: "TestTypeAggregate") -> None:
+        """Fold in the aggregates of a disjoint set of people."""
+        self.people += other.people
+        self.readings = self.readings.merge(other.readings)
+        self.latest = self.latest.merge(other.latest)
+        self.latest_digest = self.latest_digest.merge(other.latest_digest)
+        self.slopes = self.slopes.merge(other.slopes)
+        self.slope_digest = self.slope_digest.merge(other.slope_digest)
+        for level_class, count in other.level_classes.items():
+            self.level_classes[level_class] = self.level_classes.get(level_class, 0) + count
+        for direction, count in other.directions.items():
+            self.directions[direction] = self.directions.get(direction, 0) + count
+
+    def share(self, level_class: str) -> float:
+        """Fraction of people whose latest reading has a level class."""
+        return self.level_classes.get(level_class, 0) / self.people if self.people else 0.0
+
+    @property
+    def out_of_range_share(self) -> float:
+        return self.share("low") + self.share("high")
+
+    @property
+    def latest_quantiles(self) -> Optional[QuantileSummary]:
+        return QuantileSummary.from_digest(self.latest_digest)
+
+    @property
+    def slope_quantiles(self) -> Optional[QuantileSummary]:
+        """Quantiles of the people's trend slopes, in μg/dL per month."""
+        return QuantileSummary.from_digest(self.slope_digest)
+
+    def to_dict(self) -> Dict:
+        latest = self.latest_quantiles
+        slopes = self.slope_quantiles
+        return {
+            'people': self.people,
+            'readings': self.readings.count,
+            'mean_level': self.readings.mean if self.readings.count else None,
+            'latest_mean': self.latest.mean if self.latest.count else None,
+            'latest_std': self.latest.std(ddof=1) if self.latest.count > 1 else None,
+            'latest_quantiles': vars(latest) if latest else None,
+            'level_classes': dict(self.level_classes),
+            'out_of_range_share': self.out_of_range_share,
+            'people_with_trend': self.slopes.count,
+            'slope_mean': self.slopes.mean if self.slopes.count else None,
+            'slope_quantiles': vars(slopes) if slopes else None,
+            'directions': dict(self.directions),
+        }
+
+
+@dataclass
+class CohortPartial:
+    """Aggregates of one database, or of every database merged so far."""
+
+    databases: int = 0
+    people: int = 0
+    failures: List[Tuple[str, str]] = field(default_factory=list)
+    test_types: Dict[str, TestTypeAggregate] = field(default_factory=dict)
+
+    def merge(self, other: "CohortPartial") -> None:
+        self.databases += other.databases
+        self.people += other.people
+        self.failures.extend(other.failures)
+        for test_type, aggregate in other.test_types.items():
+            if test_type in self.test_types:
+                self.test_types[test_type].merge(aggregate)
+            else:
+                self.test_types[test_type] = aggregate
+
+    def to_dict(self) -> Dict:
+        return {
+            'databases': self.databases,
+            'people': self.people,
+            'failures': [{'db_path': db_path, 'error': error} for db_path, error in self.failures],
+            'test_types': {test_type: aggregate.to_dict()
+                           for test_type, aggregate in sorted(self.test_types.items())},
+        }
+
+
+def open_read_only(db_path: str) -> sqlite3.Connection:
+    """Open an existing database without creating, migrating or locking it for writes."""
+    uri = Path(db_path).resolve().as_uri() + "?mode=ro"
+    connection = sqlite3.connect(uri, uri=True)
+    connection.row_factory = sqlite3.Row
+    return connection
+
+
+def _table_exists(cursor: sqlite3.Cursor, table: str) -> bool:
+    cursor.execute("SELECT EXISTS (SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?)",
+                   (table,))
+    return bool(cursor.fetchone()[0])
+
+
+def _profiles(cursor: sqlite3.Cursor) -> Dict[int, Dict]:
+    """Profile of each patient; databases from before patients have one for the default patient."""
+    patient_sql = "patient_id" if has_column(cursor, "user_profile", "patient_id") \
+        else str(DEFAULT_PATIENT_ID)
+    # Without the column, resolve_range infers the override from the range
+    override_sql = ", range_override" if has_column(cursor, "user_profile", "range_override") else ""
+    cursor.execute(f"""
+        SELECT {patient_sql} AS patient_id, age, gender, normal_range_min, normal_range_max
+               {override_sql}
+        FROM user_profile
+        ORDER BY id
+    """)
+    return {row['patient_id']: dict(row) for row in cursor.fetchall()}
+
+
+def _range_index(cursor: sqlite3.Cursor) -> ReferenceRangeIndex:
+    if _table_exists(cursor, "reference_ranges"):
+        cursor.execute("""
+            SELECT test_type, sex, age_min, age_max, normal_min, normal_max
+            FROM reference_ranges
+        """)
+        return ReferenceRangeIndex(tuple(row) for row in cursor.fetchall())
+    return ReferenceRangeIndex(DEFAULT_REFERENCE_RANGES)
+
+
+def _classify(level: float, test_type: str, profile: Optional[Dict],
+              index: ReferenceRangeIndex) -> str:
+    """Class of a reading that was stored without one, as DatabaseManager would compute it."""
+    return classify_level(level, *resolve_range(index, test_type, profile))
+
+
+def _aggregate_type(series: List[Tuple[np.ndarray, np.ndarray, str]]) -> TestTypeAggregate:
+    """Aggregate each person's (timestamps, levels, latest class) for one test type."""
+    aggregate = TestTypeAggregate(people=len(series))
+    latest_levels = []
+    slopes = []
+    for timestamps, levels, latest_class in series:
+        aggregate.readings = aggregate.readings.merge(level_stats(levels))
+        latest_levels.append(levels[-1])
+        aggregate.level_classes[latest_class] = aggregate.level_classes.get(latest_class, 0) + 1
+
+        recent = timestamps >= timestamps[-1] - TREND_WINDOW_DAYS
+        estimate = RegressionStats.from_arrays(timestamps[recent], levels[recent]).slope()
+        if estimate is not None:
+            slopes.append(estimate.slope)
+            aggregate.directions[estimate.direction] += 1
+
+    latest_levels = np.asarray(latest_levels, dtype=np.float64)
+    slopes = np.asarray(slopes, dtype=np.float64)
+    aggregate.latest = level_stats(latest_levels)
+    aggregate.latest_digest.extend(latest_levels)
+    aggregate.slopes = level_stats(slopes)
+    aggregate.slope_digest.extend(slopes)
+    return aggregate
+
+
+def scan_database(db_path: str, test_type: str = None) -> CohortPartial:
+    """Reduce one database to its cohort aggregates, optionally for one test type only.
+
+    Readings are streamed in (patient, test type, time) order, so only one
+    person's series of one test type is held in memory at a time.
+    """
+    partial = CohortPartial(databases=1)
+    connection = None
+    try:
+        if not os.path.exists(db_path):
+            raise FileNotFoundError(f"no such database: {db_path}")
+        connection = open_read_only(db_path)
+        cursor = connection.cursor()
+        if not _table_exists(cursor, "iron_readings"):
+            raise RuntimeError("not an iron tracker database")
+
+        profiles = _profiles(cursor) if _table_exists(cursor, "user_profile") else {}
+        index = _range_index(cursor)
+        patient_sql = "patient_id" if has_column(cursor, "iron_readings", "patient_id") \
+            else str(DEFAULT_PATIENT_ID)
+        class_sql = "level_class" if has_column(cursor, "iron_readings", "level_class") else "NULL"
+
+        cursor.execute(f"""
+            SELECT {patient_sql} AS patient_id, test_type, iron_level,
+                   {class_sql} AS level_class, {TIMESTAMP_SQL} AS timestamp
+            FROM iron_readings
+            WHERE :test_type IS NULL OR test_type = :test_type
+            ORDER BY patient_id, test_type, reading_date, reading_time, id
+        """, {'test_type': test_type})
+
+        by_type: Dict[str, List] = {}
+        people = set()
+        for (patient_id, reading_type), rows in groupby(
+            cursor, key=lambda row: (row['patient_id'], row['test_type'])
+        ):
+            rows = list(rows)
+            latest = rows[-1]
+            latest_class = latest['level_class'] or _classify(
+                latest['iron_level'], reading_type, profiles.get(patient_id), index
+            )
+            by_type.setdefault(reading_type, []).append((
+                np.array([row['timestamp'] for row in rows], dtype=np.float64),
+                np.array([row['iron_level'] for row in rows], dtype=np.float64),
+                latest_class,
+            ))
+            people.add(patient_id)
+
+        partial.people = len(people)
+        partial.test_types = {reading_type: _aggregate_type(series)
+                              for reading_type, series in by_type.items()}
+    except (sqlite3.Error, OSError, RuntimeError) as e:
+        partial.failures.append((db_path, str(e)))
+    finally:
+        if connection is not None:
+            connection.close()
+    return partial
+
+
+def find_databases(paths: Iterable[str]) -> Iterator[str]:
+    """Yield the given database files and the *.db files under any given directories, lazily."""
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                for name in sorted(files):
+                    if name.endswith(".db"):
+                        yield os.path.join(root, name)
+        else:
+            yield path
+
+
+def run_cohort(db_paths: Iterable[str], max_workers: int = None, test_type: str = None,
+               on_result=None) -> CohortPartial:
+    """Scan many databases across a pool of worker processes and merge their aggregates.
+
+    db_paths may be a lazy iterable; at most PENDING_PER_WORKER jobs per
+    worker are submitted ahead, and each partial is merged and dropped as
+    soon as it arrives. on_result, if given, is called with each database
+    path and its partial.
+    """
+    max_workers = max_workers or os.cpu_count() or 1
+    db_paths = iter(db_paths)
+    cohort = CohortPartial()
+
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        pending = {}
+
+        def submit_next() -> None:
+            db_path = next(db_paths, None)
+            if db_path is not None:
+                pending[executor.submit(scan_database, db_path, test_type)] = db_path
+
+        for _ in range(max_workers * PENDING_PER_WORKER):
+            submit_next()
+
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                db_path = pending.pop(future)
+                try:
+                    partial = future.result()
+                except Exception as e:
+                    # The worker process itself failed, e.g. it was killed
+                    partial = CohortPartial(databases=1, failures=[(db_path, str(e))])
+                cohort.merge(partial)
+                if on_result is not None:
+                    on_result(db_path, partial)
+                submit_next()
+
+    return cohort
+
+
+def print_cohort(cohort: CohortPartial) -> None:
+    """Print one block of cohort statistics per test type."""
+    for test_type, aggregate in sorted(cohort.test_types.items()):
+        latest = aggregate.latest_quantiles
+        slopes = aggregate.slope_quantiles
+        print(f"\n{test_type}: {aggregate.people} people, {aggregate.readings.count} readings")
+        if latest:
+            print(f"  Latest level:  median {latest.median:.1f}, IQR {latest.q1:.1f}-{latest.q3:.1f}, "
+                  f"P5-P95 {latest.p5:.1f}-{latest.p95:.1f}")
+        print(f"  Out of range:  {aggregate.out_of_range_share:.1%} "
+              f"(low {aggregate.share('low'):.1%}, high {aggregate.share('high'):.1%})")
+        if slopes:
+            trending = aggregate.slopes.count
+            print(f"  Trend/month:   median {slopes.median:+.2f}, IQR {slopes.q1:+.2f} to {slopes.q3:+.2f} "
+                  f"over {trending} people; "
+                  + ", ".join(f"{aggregate.directions[direction]} {direction}"
+                              for direction in TREND_DIRECTIONS))
+        else:
+            print("  Trend/month:   too few readings")
+
+
+def main(argv: Sequence[str] = None) -> int:
+    parser = argparse.ArgumentParser(description="Cohort statistics across iron tracker databases.")
+    parser.add_argument("paths", nargs="+", help="iron_tracker.db files or directories of them")
+    parser.add_argument("-j", "--jobs", type=int, default=None,
+                        help="worker processes (default: number of CPUs)")
+    parser.add_argument("--test-type", default=None, help="only aggregate this test type")
+    parser.add_argument("--json", default=None, help="also write the cohort statistics to this file")
+    parser.add_argument("-v", "--verbose", action="store_true", help="print each database as it finishes")
+    args = parser.parse_args(argv)
+
+    def print_partial(db_path: str, partial: CohortPartial) -> None:
+        if partial.failures:
+            print(f"FAILED  {db_path}: {partial.failures[0][1]}")
+        elif args.verbose:
+            print(f"ok      {db_path}: {partial.people} people")
+
+    started = time.perf_counter()
+    cohort = run_cohort(find_databases(args.paths), args.jobs, args.test_type, print_partial)
+
+    print(f"Scanned {cohort.databases - len(cohort.failures)}/{cohort.databases} database(s), "
+          f"{cohort.people} people in {time.perf_counter() - started:.2f}s")
+    print_cohort(cohort)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(cohort.to_dict(), f, indent=2)
+    return 1 if cohort.failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
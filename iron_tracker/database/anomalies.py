@@ -0,0 +1,251 @@
+import math
+import sqlite3
+from dataclasses import astuple, dataclass
+from typing import Dict, List, Optional
+
+from database.derived import native_sql
+from database.patients import drop_unscoped
+from database.reading_store import reading_timestamp
+
+
+# Anomaly flag bits stored per reading
+ANOMALY_OUTLIER = 1      # outside the EWMA control limits
+ANOMALY_SHIFT_UP = 2     # CUSUM detected a sustained upward shift
+ANOMALY_SHIFT_DOWN = 4   # CUSUM detected a sustained downward shift
+
+ANOMALY_LABELS = (
+    (ANOMALY_OUTLIER, "Outlier"),
+    (ANOMALY_SHIFT_UP, "Shift up"),
+    (ANOMALY_SHIFT_DOWN, "Shift down"),
+)
+
+# EWMA smoothing factor, control limit width (in standard deviations) and
+# number of readings seen before anything is flagged
+EWMA_ALPHA = 0.2
+CONTROL_LIMIT = 3.0
+WARMUP_READINGS = 5
+# CUSUM allowance and decision threshold, in standard deviations
+CUSUM_K = 0.5
+CUSUM_H = 5.0
+# Floor on the standard deviation (μg/dL) so a flat start does not flag everything
+MIN_STD = 1.0
+
+
+def anomaly_label(flags: int) -> str:
+    """Human-readable description of a set of anomaly flags."""
+    return ", ".join(label for bit, label in ANOMALY_LABELS if flags & bit)
+
+
+@dataclass
+class DetectorState:
+    """Online EWMA + CUSUM state for one test type."""
+
+    reading_count: int = 0
+    last_timestamp: float = -math.inf
+    ewma: float = 0.0
+    ewvar: float = 0.0
+    cusum_pos: float = 0.0
+    cusum_neg: float = 0.0
+
+    def update(self, timestamp: float, level: float):
+        """Fold in the next reading in time order and return (flags, score).
+
+        The score is the reading's deviation from the EWMA before the update,
+        in standard deviations.
+        """
+        flags = 0
+        score = 0.0
+        if self.reading_count == 0:
+            self.ewma = level
+        else:
+            std = max(math.sqrt(self.ewvar), MIN_STD)
+            score = (level - self.ewma) / std
+            if self.reading_count >= WARMUP_READINGS:
+                if abs(score) > CONTROL_LIMIT:
+                    flags |= ANOMALY_OUTLIER
+                # Clip so a single outlier cannot trigger a shift on its own
+                clipped = min(max(score, -CONTROL_LIMIT), CONTROL_LIMIT)
+                self.cusum_pos = max(0.0, self.cusum_pos + clipped - CUSUM_K)
+                self.cusum_neg = max(0.0, self.cusum_neg - clipped - CUSUM_K)
+                if self.cusum_pos > CUSUM_H:
+                    flags |= ANOMALY_SHIFT_UP
+                    self.cusum_pos = self.cusum_neg = 0.0
+                elif self.cusum_neg > CUSUM_H:
+                    flags |= ANOMALY_SHIFT_DOWN
+                    self.cusum_pos = self.cusum_neg = 0.0
+
+            diff = level - self.ewma
+            increment = EWMA_ALPHA * diff
+            self.ewma += increment
+            self.ewvar = (1 - EWMA_ALPHA) * (self.ewvar + diff * increment)
+
+        self.reading_count += 1
+        self.last_timestamp = timestamp
+        return flags, score
+
+
+class AnomalyDetector:
+    """Flags unusual readings as they are inserted, per patient and test type.
+
+    Each patient's test type has an EWMA control chart for single outliers and a CUSUM
+    for sustained shifts. Detector state is persisted, so an insert in time
+    order costs one state update. Inserts out of time order and deletes
+    replay the affected test type. Only flagged readings get a row in
+    reading_anomalies, which keeps lookups cheap.
+    """
+
+    def __init__(self, connection: sqlite3.Connection):
+        self.connection = connection
+
+    def create_tables(self) -> None:
+        """Create the anomaly tables and backfill them from existing readings."""
+        cursor = self.connection.cursor()
+        drop_unscoped(cursor, "reading_anomalies")
+        drop_unscoped(cursor, "anomaly_detectors")
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS reading_anomalies (
+                reading_id INTEGER PRIMARY KEY,
+                patient_id INTEGER NOT NULL,
+                test_type TEXT NOT NULL,
+                flags INTEGER NOT NULL,
+                score REAL NOT NULL
+            )
+        """)
+        cursor.execute("""
+            CREATE INDEX IF NOT EXISTS idx_anomalies_patient_type
+            ON reading_anomalies (patient_id, test_type)
+        """)
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS anomaly_detectors (
+                patient_id INTEGER NOT NULL,
+                test_type TEXT NOT NULL,
+                reading_count INTEGER NOT NULL,
+                last_timestamp REAL NOT NULL,
+                ewma REAL NOT NULL,
+                ewvar REAL NOT NULL,
+                cusum_pos REAL NOT NULL,
+                cusum_neg REAL NOT NULL,
+                PRIMARY KEY (patient_id, test_type)
+            ) WITHOUT ROWID
+        """)
+
+        cursor.execute("SELECT EXISTS (SELECT 1 FROM anomaly_detectors)")
+        has_state = cursor.fetchone()[0]
+        cursor.execute("SELECT EXISTS (SELECT 1 FROM iron_readings)")
+        has_readings = cursor.fetchone()[0]
+        if has_readings and not has_state:
+            self.rebuild_all()
+
+    def load_state(self, patient_id: int, test_type: str) -> DetectorState:
+        cursor = self.connection.cursor()
+        cursor.execute("""
+            SELECT reading_count, last_timestamp, ewma, ewvar, cusum_pos, cusum_neg
+            FROM anomaly_detectors WHERE patient_id = ? AND test_type = ?
+        """, (patient_id, test_type))
+        row = cursor.fetchone()
+        return DetectorState(*row) if row else DetectorState()
+
+    def save_state(self, patient_id: int, test_type: str, state: DetectorState) -> None:
+        self.connection.execute("""
+            INSERT OR REPLACE INTO anomaly_detectors (patient_id, test_type, reading_count,
+                                                      last_timestamp, ewma, ewvar,
+                                                      cusum_pos, cusum_neg)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        """, (patient_id, test_type, *astuple(state)))
+
+    def add(self, patient_id: int, reading_id: int, reading_date, reading_time: str,
+            iron_level: float, test_type: str) -> int:
+        """Run the detector on a reading that was just inserted and return its flags."""
+        timestamp = reading_timestamp(reading_date, reading_time)
+        state = self.load_state(patient_id, test_type)
+        if timestamp < state.last_timestamp:
+            # Later readings were scored without this one; replay the test type
+            self.rebuild(patient_id, test_type)
+            return self.flags(reading_id)
+
+        flags, score = state.update(timestamp, iron_level)
+        if flags:
+            self.connection.execute("""
+                INSERT OR REPLACE INTO reading_anomalies (reading_id, patient_id, test_type,
+                                                          flags, score)
+                VALUES (?, ?, ?, ?, ?)
+            """, (reading_id, patient_id, test_type, flags, score))
+        self.save_state(patient_id, test_type, state)
+        return flags
+
+    def flags(self, reading_id: int) -> int:
+        cursor = self.connection.cursor()
+        cursor.execute("SELECT flags FROM reading_anomalies WHERE reading_id = ?", (reading_id,))
+        row = cursor.fetchone()
+        return row[0] if row else 0
+
+    def rebuild(self, patient_id: int, test_type: str) -> None:
+        """Replay the detector over all of a patient's readings of one test type, e.g. after a delete."""
+        cursor = self.connection.cursor()
+        cursor.execute("DELETE FROM reading_anomalies WHERE patient_id = ? AND test_type = ?",
+                       (patient_id, test_type))
+        cursor.execute("""
+            SELECT id, reading_date, reading_time, iron_level FROM iron_readings
+            WHERE patient_id = ? AND test_type = ?
+            ORDER BY reading_date, reading_time, id
+        """, (patient_id, test_type))
+
+        state = DetectorState()
+        anomalies = []
+        for reading_id, reading_date, reading_time, iron_level in cursor.fetchall():
+            flags, score = state.update(reading_timestamp(reading_date, reading_time), iron_level)
+            if flags:
+                anomalies.append((reading_id, patient_id, test_type, flags, score))
+
+        cursor.executemany("""
+            INSERT INTO reading_anomalies (reading_id, patient_id, test_type, flags, score)
+            VALUES (?, ?, ?, ?, ?)
+        """, anomalies)
+        if state.reading_count:
+            self.save_state(patient_id, test_type, state)
+        else:
+            cursor.execute("DELETE FROM anomaly_detectors WHERE patient_id = ? AND test_type = ?",
+                           (patient_id, test_type))
+
+    def rebuild_all(self) -> None:
+        """Replay the detector for every patient and test type."""
+        cursor = self.connection.cursor()
+        cursor.execute("DELETE FROM reading_anomalies")
+        cursor.execute("DELETE FROM anomaly_detectors")
+        cursor.execute("SELECT DISTINCT patient_id, test_type FROM iron_readings")
+        for patient_id, test_type in cursor.fetchall():
+            self.rebuild(patient_id, test_type)
+
+    def all_flags(self, patient_id: int) -> Dict[int, int]:
+        """Flags of every flagged reading of a patient, keyed by reading id."""
+        cursor = self.connection.cursor()
+        cursor.execute("SELECT reading_id, flags FROM reading_anomalies WHERE patient_id = ?",
+                       (patient_id,))
+        return {reading_id: flags for reading_id, flags in cursor.fetchall()}
+
+    def query(self, patient_id: int, start_date=None, end_date=None,
+              test_type: Optional[str] = None) -> List[Dict]:
+        """Flagged readings in a date range, oldest first."""
+        clauses = ["a.patient_id = ?"]
+        params = [patient_id]
+        if start_date is not None:
+            clauses.append("r.reading_date >= ?")
+            params.append(str(start_date))
+        if end_date is not None:
+            clauses.append("r.reading_date <= ?")
+            params.append(str(end_date))
+        if test_type is not None:
+            clauses.append("a.test_type = ?")
+            params.append(test_type)
+        else:
+            clauses.append(native_sql("a.test_type"))
+        cursor = self.connection.cursor()
+        cursor.execute(f"""
+            SELECT r.id, r.reading_date, r.reading_time, r.iron_level, r.test_type,
+                   a.flags, a.score
+            FROM reading_anomalies a
+            JOIN iron_readings r ON r.id = a.reading_id
+            WHERE {' AND '.join(clauses)}
+            ORDER BY r.reading_date, r.reading_time
+        """, params)
+        return [dict(row) for row in cursor.fetchall()]
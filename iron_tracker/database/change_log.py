@@ -0,0 +1,210 @@
+import sqlite3
+from typing import Dict, List, Tuple
+
+from database.derived import native_sql
+from database.patients import has_column
+
+
+# Reading fields sent to sync peers; the unit, level class and everything
+# derived from a reading are recomputed by the receiver
+SYNC_FIELDS = ("reading_date", "reading_time", "iron_level", "notes", "test_type", "source_id")
+# Fields where empty and missing (e.g. from an older peer) are the same
+OPTIONAL_SYNC_FIELDS = ("notes", "source_id")
+
+# Random 128-bit id, as 32 hex digits, for readings written without one
+NEW_SYNC_ID_SQL = "lower(hex(randomblob(16)))"
+
+
+def same_reading(row, reading: Dict) -> bool:
+    """Whether a stored row already has a synced reading's fields."""
+    return all(
+        (row[name] or "") == (reading.get(name) or "") if name in OPTIONAL_SYNC_FIELDS
+        else row[name] == reading.get(name)
+        for name in SYNC_FIELDS
+    )
+
+
+class ChangeLog:
+    """Sequence-numbered log of reading changes, kept by triggers on iron_readings.
+
+    Every insert, edit and delete of a native reading logs its sync_id under a
+    new, ever-increasing seq, replacing the reading's previous entry. The
+    log holds at most one row per reading ever written, and a peer that
+    last saw seq N needs exactly the entries after N: an indexed range scan
+    whose cost follows the number of changes, not the size of the history.
+    Derived readings are not logged, since each side computes its own.
+
+    An entry written by applying a peer's change records that peer as its
+    origin, so it is not sent back to it; a later local edit logs the
+    reading again without one. sync_peers records, per patient and peer,
+    the last local seq the peer acknowledged, the last peer seq applied here
+    and the random client_id this database goes by at the peer.
+    """
+
+    def __init__(self, connection: sqlite3.Connection):
+        self.connection = connection
+
+    def create_tables(self) -> None:
+        """Create the log and its triggers, logging existing readings on first use."""
+        cursor = self.connection.cursor()
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS change_log (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                sync_id TEXT NOT NULL UNIQUE,
+                patient_id INTEGER NOT NULL,
+                op TEXT NOT NULL CHECK(op IN ('upsert', 'delete')),
+                changed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                origin TEXT
+            )
+        """)
+        if not has_column(cursor, "change_log", "origin"):
+            cursor.execute("ALTER TABLE change_log ADD COLUMN origin TEXT")
+        cursor.execute("""
+            CREATE INDEX IF NOT EXISTS idx_change_log_patient_seq
+            ON change_log (patient_id, seq)
+        """)
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS sync_peers (
+                patient_id INTEGER NOT NULL,
+                peer TEXT NOT NULL,
+                pushed_seq INTEGER NOT NULL DEFAULT 0,
+                pulled_seq INTEGER NOT NULL DEFAULT 0,
+                synced_at TIMESTAMP,
+                client_id TEXT,
+                PRIMARY KEY (patient_id, peer)
+            ) WITHOUT ROWID
+        """)
+        if not has_column(cursor, "sync_peers", "client_id"):
+            cursor.execute("ALTER TABLE sync_peers ADD COLUMN client_id TEXT")
+
+        # Readings written before the log existed are logged once, oldest first
+        cursor.execute(f"""
+            UPDATE iron_readings SET sync_id = {NEW_SYNC_ID_SQL}
+            WHERE sync_id IS NULL AND {self._native_sql("iron_readings")}
+        """)
+        cursor.execute("SELECT EXISTS (SELECT 1 FROM change_log)")
+        if not cursor.fetchone()[0]:
+            cursor.execute(f"""
+                INSERT INTO change_log (sync_id, patient_id, op)
+                SELECT sync_id, patient_id, 'upsert' FROM iron_readings
+                WHERE {self._native_sql("iron_readings")}
+                ORDER BY id
+            """)
+
+        # Recreated on every open, so the list of derived test types stays current
+        for trigger in ("change_log_insert", "change_log_update", "change_log_delete"):
+            cursor.execute(f"DROP TRIGGER IF EXISTS {trigger}")
+        cursor.execute(f"""
+            CREATE TRIGGER change_log_insert AFTER INSERT ON iron_readings
+            WHEN {self._native_sql("NEW")}
+            BEGIN
+                UPDATE iron_readings SET sync_id = {NEW_SYNC_ID_SQL}
+                WHERE id = NEW.id AND sync_id IS NULL;
+                DELETE FROM change_log
+                WHERE sync_id = (SELECT sync_id FROM iron_readings WHERE id = NEW.id);
+                INSERT INTO change_log (sync_id, patient_id, op)
+                SELECT sync_id, patient_id, 'upsert' FROM iron_readings WHERE id = NEW.id;
+            END
+        """)
+        cursor.execute(f"""
+            CREATE TRIGGER change_log_update
+            AFTER UPDATE OF patient_id, reading_date, reading_time, iron_level, notes, test_type,
+                            source_id
+            ON iron_readings
+            WHEN NEW.sync_id IS NOT NULL AND {self._native_sql("NEW")}
+            BEGIN
+                DELETE FROM change_log WHERE sync_id = NEW.sync_id;
+                INSERT INTO change_log (sync_id, patient_id, op)
+                VALUES (NEW.sync_id, NEW.patient_id, 'upsert');
+            END
+        """)
+        cursor.execute(f"""
+            CREATE TRIGGER change_log_delete AFTER DELETE ON iron_readings
+            WHEN OLD.sync_id IS NOT NULL AND {self._native_sql("OLD")}
+            BEGIN
+                DELETE FROM change_log WHERE sync_id = OLD.sync_id;
+                INSERT INTO change_log (sync_id, patient_id, op)
+                VALUES (OLD.sync_id, OLD.patient_id, 'delete');
+            END
+        """)
+
+    @staticmethod
+    def _native_sql(row: str) -> str:
+        """Condition that a row is a native reading, not a derived one."""
+        return native_sql(f"{row}.test_type")
+
+    def last_seq(self, patient_id: int) -> int:
+        cursor = self.connection.cursor()
+        cursor.execute("SELECT MAX(seq) FROM change_log WHERE patient_id = ?", (patient_id,))
+        return cursor.fetchone()[0] or 0
+
+    def changes_since(self, patient_id: int, seq: int, limit: int) -> List[Dict]:
+        """A patient's changes after seq, oldest first, with the current fields of upserted readings.
+
+        Each change carries its origin, the peer it was received from or None.
+        """
+        cursor = self.connection.cursor()
+        cursor.execute(f"""
+            SELECT c.seq, c.op, c.sync_id, c.origin, {", ".join(f"r.{name}" for name in SYNC_FIELDS)}
+            FROM change_log c
+            LEFT JOIN iron_readings r ON r.sync_id = c.sync_id
+            WHERE c.patient_id = ? AND c.seq > ?
+            ORDER BY c.seq
+            LIMIT ?
+        """, (patient_id, seq, limit))
+        changes = []
+        for row in cursor.fetchall():
+            reading = None
+            if row['op'] == "upsert":
+                reading = {name: row[name] for name in SYNC_FIELDS}
+            changes.append({'seq': row['seq'], 'op': row['op'], 'sync_id': row['sync_id'],
+                            'reading': reading, 'origin': row['origin']})
+        return changes
+
+    def set_origin(self, patient_id: int, sync_ids: List[str], origin: str) -> None:
+        """Record that the logged changes of these readings were received from a peer."""
+        self.connection.executemany("""
+            UPDATE change_log SET origin = ? WHERE patient_id = ? AND sync_id = ?
+        """, [(origin, patient_id, sync_id) for sync_id in sync_ids])
+
+    def peer_state(self, patient_id: int, peer: str) -> Tuple[int, int]:
+        """(pushed_seq, pulled_seq) of a patient's sync with a peer; (0, 0) before the first sync."""
+        cursor = self.connection.cursor()
+        cursor.execute("""
+            SELECT pushed_seq, pulled_seq FROM sync_peers WHERE patient_id = ? AND peer = ?
+        """, (patient_id, peer))
+        row = cursor.fetchone()
+        return (row[0], row[1]) if row else (0, 0)
+
+    def client_id(self, patient_id: int, peer: str) -> str:
+        """The id a patient's sync goes by at a peer, created on first use."""
+        cursor = self.connection.cursor()
+        cursor.execute(f"""
+            INSERT INTO sync_peers (patient_id, peer, client_id)
+            VALUES (?, ?, {NEW_SYNC_ID_SQL})
+            ON CONFLICT (patient_id, peer) DO UPDATE SET
+                client_id = coalesce(client_id, excluded.client_id)
+        """, (patient_id, peer))
+        cursor.execute("SELECT client_id FROM sync_peers WHERE patient_id = ? AND peer = ?",
+                       (patient_id, peer))
+        return cursor.fetchone()[0]
+
+    def set_peer_state(self, patient_id: int, peer: str, pushed_seq: int, pulled_seq: int) -> None:
+        self.connection.execute("""
+            INSERT INTO sync_peers (patient_id, peer, pushed_seq, pulled_seq, synced_at)
+            VALUES (?, ?, ?, ?, CURRENT_TIMESTAMP)
+            ON CONFLICT (patient_id, peer) DO UPDATE SET
+                pushed_seq = excluded.pushed_seq,
+                pulled_seq = excluded.pulled_seq,
+                synced_at = excluded.synced_at
+        """, (patient_id, peer, pushed_seq, pulled_seq))
+
+    def peers(self, patient_id: int) -> List[Dict]:
+        """A patient's sync peers, most recently synced first."""
+        cursor = self.connection.cursor()
+        cursor.execute("""
+            SELECT peer, pushed_seq, pulled_seq, synced_at FROM sync_peers
+            WHERE patient_id = ?
+            ORDER BY synced_at DESC
+        """, (patient_id,))
+        return [dict(row) for row in cursor.fetchall()]
@@ -1,110 +1,633 @@
 import sqlite3
 import os
+import math
+from contextlib import contextmanager
+from dataclasses import replace
 from datetime import datetime, date
-from typing import List, Dict, Optional, Tuple
+from pathlib import Path
+from typing import Callable, Iterable, List, Dict, Optional, Tuple
+
+from database.anomalies import AnomalyDetector
+from database.change_log import ChangeLog, same_reading
+from database.derived import (
+    DERIVED_BY_TYPE, DERIVED_METRICS, NATIVE_UNITS, DerivedMetric, DerivedMetrics, native_sql,
+    test_type_unit,
+)
+from database.forecasts import ForecastModels, TrendState
+from database.patients import DEFAULT_PATIENT_ID, Patients, has_column
+from database.quantiles import QuantileSketches, TDigest
+from database.reading_filter import ReadingFilter
+from database.reading_store import ReadingStore
+from database.reference_ranges import (
+    DEFAULT_PROFILE_RANGE, DEFAULT_TEST_TYPE, ReferenceRanges, classify_level
+)
+from database.rollups import RollupPyramid
+from database.running_stats import RunningStats, RunningStatsStore
+from database.tags import ReadingTags, TagComparison
+from database.window_metrics import ROLLING_WINDOW_DAYS, WindowMetrics
+
+
+# Tables of the current schema and the columns older versions lacked; a
+# read-write init_db migrates databases that are missing any of them
+SCHEMA_COLUMNS = {
+    "patients": (),
+    "iron_readings": ("patient_id", "level_class", "sync_id", "source_id"),
+    "change_log": ("origin",),
+    "sync_peers": ("client_id",),
+    "user_profile": ("patient_id", "range_override"),
+    "reference_ranges": (),
+    "reading_rollups": ("patient_id", "m2"),
+    "reading_stats": ("patient_id",),
+    "reading_sketches": ("patient_id",),
+    "reading_anomalies": ("patient_id",),
+    "anomaly_detectors": ("patient_id",),
+    "forecast_models": ("patient_id", "noise_scale"),
+    "reading_tags": ("patient_id",),
+    "tag_keywords": (),
+    "derived_readings": ("patient_id",),
+}
+SCHEMA_INDEXES = ("idx_readings_sync_id", "idx_readings_natural_key")
 
 
 class DatabaseManager:
     """Manages SQLite database operations for iron level tracking."""
     
-    def __init__(self, db_path: str = "iron_tracker.db"):
+    def __init__(self, db_path: str = "iron_tracker.db", patient_id: int = DEFAULT_PATIENT_ID):
         self.db_path = db_path
+        self.patient_id = patient_id  # readings, profile and statistics are this patient's
         self.connection = None
+        self.patients = None
+        self.rollups = None
+        self.anomalies = None
+        self.forecasts = None
+        self.running_stats = None
+        self.sketches = None
+        self.reference_ranges = None
+        self.derived = None
+        self.window_metrics = None
+        self.tags = None
+        self.change_log = None
+        self.store = None
+        self.change_listeners = []
     
-    def init_db(self) -> None:
-        """Initialize the database and create tables if they don't exist."""
+    def init_db(self, read_only: bool = False) -> None:
+        """Initialize the database and create tables if they don't exist.
+        
+        With read_only, an existing database is opened as it is, for readers
+        on other threads: nothing is created, migrated or committed, so they
+        never contend with the writing connection.
+        """
         try:
-            self.connection = sqlite3.connect(self.db_path, check_same_thread=False)
+            if read_only:
+                uri = Path(self.db_path).resolve().as_uri() + "?mode=ro"
+                self.connection = sqlite3.connect(uri, uri=True, check_same_thread=False)
+            else:
+                self.connection = sqlite3.connect(self.db_path, check_same_thread=False)
             self.connection.row_factory = sqlite3.Row
-            self._create_tables()
+            self.patients = Patients(self.connection)
+            self.rollups = RollupPyramid(self.connection)
+            self.anomalies = AnomalyDetector(self.connection)
+            self.forecasts = ForecastModels(self.connection)
+            self.running_stats = RunningStatsStore(self.connection)
+            self.sketches = QuantileSketches(self.connection)
+            self.reference_ranges = ReferenceRanges(self.connection)
+            self.derived = DerivedMetrics(self.connection)
+            self.window_metrics = WindowMetrics(self.connection)
+            self.tags = ReadingTags(self.connection)
+            self.change_log = ChangeLog(self.connection)
+            if not read_only:
+                self._create_tables()
         except sqlite3.Error as e:
             print(f"Database initialization error: {e}")
     
+    def schema_problems(self) -> List[str]:
+        """Tables, columns and indexes of the current schema that the database lacks.
+        
+        A database opened read-only is not migrated, so readers check this
+        first rather than failing on a missing column half way through.
+        """
+        cursor = self.connection.cursor()
+        cursor.execute("SELECT type, name FROM sqlite_master WHERE type IN ('table', 'index')")
+        existing = {(row[0], row[1]) for row in cursor.fetchall()}
+        problems = []
+        for table, columns in SCHEMA_COLUMNS.items():
+            if ("table", table) not in existing:
+                problems.append(f"table {table}")
+                continue
+            problems.extend(f"column {table}.{column}" for column in columns
+                            if not has_column(cursor, table, column))
+        problems.extend(f"index {index}" for index in SCHEMA_INDEXES if ("index", index) not in existing)
+        return problems
+    
     def _create_tables(self) -> None:
         """Create database tables."""
         cursor = self.connection.cursor()
         
+        # Patients whose readings are tracked; each reading belongs to one
+        self.patients.create_tables()
+        
         # Iron readings table
-        cursor.execute("""
+        cursor.execute(f"""
             CREATE TABLE IF NOT EXISTS iron_readings (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
+                patient_id INTEGER NOT NULL DEFAULT {DEFAULT_PATIENT_ID} REFERENCES patients (id),
                 reading_date DATE NOT NULL,
                 reading_time TIME NOT NULL,
                 iron_level REAL NOT NULL,
                 unit TEXT DEFAULT 'μg/dL',
                 notes TEXT,
                 test_type TEXT DEFAULT 'Serum Iron',
+                level_class TEXT,
+                sync_id TEXT,
+                source_id TEXT NOT NULL DEFAULT '',
                 created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
             )
         """)
         
-        # User profile table for reference ranges
+        # Databases created before level classes, patients, sync ids or sources
+        # were stored lack the columns; their readings belong to the default
+        # patient and were entered by hand
+        if not has_column(cursor, "iron_readings", "level_class"):
+            cursor.execute("ALTER TABLE iron_readings ADD COLUMN level_class TEXT")
+        if not has_column(cursor, "iron_readings", "patient_id"):
+            cursor.execute(f"""
+                ALTER TABLE iron_readings ADD COLUMN
+                patient_id INTEGER NOT NULL DEFAULT {DEFAULT_PATIENT_ID} REFERENCES patients (id)
+            """)
+        if not has_column(cursor, "iron_readings", "sync_id"):
+            cursor.execute("ALTER TABLE iron_readings ADD COLUMN sync_id TEXT")
+        if not has_column(cursor, "iron_readings", "source_id"):
+            cursor.execute("ALTER TABLE iron_readings ADD COLUMN source_id TEXT NOT NULL DEFAULT ''")
+        
+        # Older versions stored every native test type as μg/dL
+        for test_type in [*NATIVE_UNITS, *DERIVED_BY_TYPE]:
+            unit = test_type_unit(test_type)
+            cursor.execute("""
+                UPDATE iron_readings SET unit = ? WHERE test_type = ? AND unit IS NOT ?
+            """, (unit, test_type, unit))
+        
+        # Every index is led by patient_id, so one patient's readings are a
+        # contiguous range; they replace the older unscoped indexes
+        for old_index in ("idx_readings_date", "idx_readings_type_date",
+                          "idx_readings_type_time", "idx_readings_class"):
+            cursor.execute(f"DROP INDEX IF EXISTS {old_index}")
+        cursor.execute("""
+            CREATE INDEX IF NOT EXISTS idx_readings_patient_date
+            ON iron_readings (patient_id, reading_date, reading_time)
+        """)
+        cursor.execute("""
+            CREATE INDEX IF NOT EXISTS idx_readings_patient_type_time
+            ON iron_readings (patient_id, test_type, reading_date, reading_time)
+        """)
+        cursor.execute("""
+            CREATE INDEX IF NOT EXISTS idx_readings_patient_class
+            ON iron_readings (patient_id, level_class, reading_date, reading_time)
+        """)
+        cursor.execute("""
+            CREATE UNIQUE INDEX IF NOT EXISTS idx_readings_sync_id
+            ON iron_readings (sync_id)
+        """)
+        
+        # Natural key: the same reading written again is a conflict, not a new
+        # row. Duplicates stored before the key existed are kept, set apart by
+        # their source_id
         cursor.execute("""
+            SELECT EXISTS (SELECT 1 FROM sqlite_master
+                           WHERE type = 'index' AND name = 'idx_readings_natural_key')
+        """)
+        if not cursor.fetchone()[0]:
+            cursor.execute("""
+                UPDATE iron_readings SET source_id = 'duplicate:' || id
+                WHERE id IN (
+                    SELECT id FROM (
+                        SELECT id, ROW_NUMBER() OVER (
+                            PARTITION BY patient_id, reading_date, reading_time, test_type,
+                                         iron_level, source_id
+                            ORDER BY id
+                        ) AS copy
+                        FROM iron_readings
+                    )
+                    WHERE copy > 1
+                )
+            """)
+            cursor.execute("""
+                CREATE UNIQUE INDEX idx_readings_natural_key
+                ON iron_readings (patient_id, reading_date, reading_time, test_type,
+                                  iron_level, source_id)
+            """)
+        
+        # Trigger-maintained log of changes for syncing with other devices
+        self.change_log.create_tables()
+        
+        # User profile table for reference ranges, one per patient
+        cursor.execute(f"""
             CREATE TABLE IF NOT EXISTS user_profile (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
+                patient_id INTEGER NOT NULL DEFAULT {DEFAULT_PATIENT_ID} REFERENCES patients (id),
                 age INTEGER,
                 gender TEXT CHECK(gender IN ('male', 'female', 'other')),
                 normal_range_min REAL DEFAULT 60,
                 normal_range_max REAL DEFAULT 170,
+                range_override INTEGER NOT NULL DEFAULT 0,
                 created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                 updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
             )
         """)
         
-        # Insert default profile if none exists
-        cursor.execute("SELECT COUNT(*) FROM user_profile")
-        if cursor.fetchone()[0] == 0:
+        if not has_column(cursor, "user_profile", "patient_id"):
+            cursor.execute(f"""
+                ALTER TABLE user_profile ADD COLUMN
+                patient_id INTEGER NOT NULL DEFAULT {DEFAULT_PATIENT_ID} REFERENCES patients (id)
+            """)
+        cursor.execute("""
+            CREATE UNIQUE INDEX IF NOT EXISTS idx_profile_patient
+            ON user_profile (patient_id)
+        """)
+        
+        # Profile ranges changed before the reference table existed classified
+        # those patients' readings, so they go on overriding it
+        overridden = []
+        if not has_column(cursor, "user_profile", "range_override"):
             cursor.execute("""
-                INSERT INTO user_profile (age, gender, normal_range_min, normal_range_max)
-                VALUES (30, 'other', 60, 170)
+                ALTER TABLE user_profile ADD COLUMN range_override INTEGER NOT NULL DEFAULT 0
             """)
+            cursor.execute("""
+                UPDATE user_profile SET range_override = 1
+                WHERE normal_range_min IS NOT ? OR normal_range_max IS NOT ?
+            """, DEFAULT_PROFILE_RANGE)
+            cursor.execute("SELECT patient_id FROM user_profile WHERE range_override = 1")
+            overridden = [patient_id for (patient_id,) in cursor.fetchall()]
+        
+        # Insert default profile if none exists
+        self._create_profile(DEFAULT_PATIENT_ID)
+        
+        # Reference ranges by test type, sex and age; classify any readings
+        # stored without a class
+        self.reference_ranges.create_tables()
+        cursor.execute("SELECT DISTINCT patient_id FROM iron_readings WHERE level_class IS NULL")
+        for patient_id in {patient_id for (patient_id,) in cursor.fetchall()} | set(overridden):
+            self._classify_readings(patient_id)
+        
+        # Level-of-detail aggregates for zoomable charts
+        self.rollups.create_tables()
+        
+        # Welford accumulators for O(1) mean, variance, min and max
+        self.running_stats.create_tables()
+        
+        # Mergeable quantile sketches for medians and percentiles
+        self.sketches.create_tables()
+        
+        # Online outlier and change-point flags
+        self.anomalies.create_tables()
+        
+        # Persisted local linear trend models for forecasting
+        self.forecasts.create_tables()
+        
+        # Tags extracted from notes
+        self.tags.create_tables()
+        
+        # Derived test types such as transferrin saturation; backfill metrics
+        # that have no derived readings yet
+        self.derived.create_tables()
+        for metric in DERIVED_METRICS:
+            cursor.execute("SELECT EXISTS (SELECT 1 FROM derived_readings WHERE test_type = ?)",
+                           (metric.test_type,))
+            if not cursor.fetchone()[0]:
+                for patient_id, reading_date in self.derived.input_dates(metric):
+                    self._refresh_derived(patient_id, metric, reading_date)
         
         self.connection.commit()
     
+    def _create_profile(self, patient_id: int) -> None:
+        """Give a patient the default profile unless they already have one."""
+        self.connection.execute("""
+            INSERT OR IGNORE INTO user_profile (patient_id, age, gender,
+                                                normal_range_min, normal_range_max)
+            VALUES (?, 30, 'other', 60, 170)
+        """, (patient_id,))
+    
     def add_reading(self, iron_level: float, reading_date: date = None, 
                    reading_time: str = None, notes: str = "", test_type: str = "Serum Iron") -> bool:
-        """Add a new iron level reading."""
+        """Add a new iron level reading for the current patient.
+        
+        A reading already stored with the same time, test type and level is
+        left as it is, so adding it again succeeds without a duplicate.
+        """
         try:
             if reading_date is None:
                 reading_date = date.today()
             if reading_time is None:
                 reading_time = datetime.now().strftime("%H:%M")
             
-            cursor = self.connection.cursor()
-            cursor.execute("""
-                INSERT INTO iron_readings (reading_date, reading_time, iron_level, notes, test_type)
-                VALUES (?, ?, ?, ?, ?)
-            """, (reading_date, reading_time, iron_level, notes, test_type))
+            reading = self._insert_reading(self.patient_id, iron_level, reading_date, reading_time,
+                                           notes, test_type)
+            if reading is None:
+                return True
+            derived_added, derived_deleted = self._update_derived(self.patient_id, reading_date,
+                                                                  test_type)
             
             self.connection.commit()
+            self._publish([reading] + derived_added, derived_deleted)
             return True
         except sqlite3.Error as e:
             print(f"Error adding reading: {e}")
+            self.connection.rollback()
             return False
     
+    def upsert_readings(self, readings: Iterable[Dict], source_id: str = "",
+                        batch_size: int = 500) -> Optional[Dict[str, int]]:
+        """Write many readings for the current patient, skipping those already stored.
+        
+        Each reading is a dict with iron_level, reading_date and reading_time,
+        and optionally notes and test_type. Readings are matched on the
+        natural key with source_id (e.g. the file they were imported from),
+        so importing the same readings again adds nothing and only updates
+        notes that changed. Every batch is committed on its own, so an
+        interrupted import is resumed by running it again.
+        
+        Returns the number of readings 'added', 'updated' and 'unchanged',
+        or None if a batch failed; the batches before it stay committed.
+        """
+        counts = {'added': 0, 'updated': 0, 'unchanged': 0}
+        batch = []
+        for reading in readings:
+            batch.append(reading)
+            if len(batch) >= batch_size:
+                if not self._upsert_batch(batch, source_id, counts):
+                    return None
+                batch = []
+        if batch and not self._upsert_batch(batch, source_id, counts):
+            return None
+        return counts
+    
+    def _upsert_batch(self, readings: List[Dict], source_id: str, counts: Dict[str, int]) -> bool:
+        """Upsert one batch of readings in a single transaction, adding to counts."""
+        try:
+            cursor = self.connection.cursor()
+            added, deleted, updated = [], [], []
+            touched = set()
+            batch_counts = dict.fromkeys(counts, 0)
+            for reading in readings:
+                iron_level = float(reading['iron_level'])
+                reading_date = str(reading['reading_date'])
+                reading_time = str(reading['reading_time'])
+                test_type = reading.get('test_type') or DEFAULT_TEST_TYPE
+                notes = reading.get('notes') or ""
+                
+                inserted = self._insert_reading(self.patient_id, iron_level, reading_date,
+                                                reading_time, notes, test_type,
+                                                source_id=source_id)
+                if inserted is not None:
+                    added.append(inserted)
+                    touched.add((reading_date, test_type))
+                    batch_counts['added'] += 1
+                    continue
+                
+                cursor.execute("""
+                    SELECT * FROM iron_readings
+                    WHERE patient_id = ? AND reading_date = ? AND reading_time = ?
+                      AND test_type = ? AND iron_level = ? AND source_id = ?
+                      AND COALESCE(notes, '') != ?
+                """, (self.patient_id, reading_date, reading_time, test_type, iron_level,
+                      source_id, notes))
+                row = cursor.fetchone()
+                if row is None:
+                    batch_counts['unchanged'] += 1
+                    continue
+                
+                cursor.execute("UPDATE iron_readings SET notes = ? WHERE id = ?", (notes, row['id']))
+                self.tags.remove(row['id'])
+                tags = self.tags.add(self.patient_id, row['id'], reading_date, notes)
+                updated.append((dict(row), dict(row, notes=notes, tags=tags)))
+                batch_counts['updated'] += 1
+            
+            for reading_date, test_type in touched:
+                derived_added, derived_deleted = self._update_derived(self.patient_id, reading_date,
+                                                                      test_type)
+                added.extend(derived_added)
+                deleted.extend(derived_deleted)
+            
+            self.connection.commit()
+            for key, count in batch_counts.items():
+                counts[key] += count
+            self._publish(added, deleted)
+            for old, new in updated:
+                if self.store is not None:
+                    self.store.remove(old['id'])
+                    self.store.add(new)
+                self._notify_change("delete", old)
+                self._notify_change("add", new)
+            return True
+        except (sqlite3.Error, KeyError, TypeError, ValueError) as e:
+            print(f"Error upserting readings: {e}")
+            self.connection.rollback()
+            return False
+    
+    def _insert_reading(self, patient_id: int, iron_level: float, reading_date,
+                        reading_time: str, notes: str, test_type: str,
+                        sync_id: str = None, source_id: str = "") -> Optional[Dict]:
+        """Insert a reading and update every derived table, without committing.
+        
+        Returns None, changing nothing, when the natural key (patient, date,
+        time, test type, level and source) is already stored. A reading
+        received from a sync peer keeps the peer's sync_id; other native
+        readings are given a new one by the change log trigger.
+        """
+        level_class = classify_level(iron_level, *self._normal_range(patient_id, test_type))
+        
+        cursor = self.connection.cursor()
+        cursor.execute("""
+            INSERT INTO iron_readings (patient_id, reading_date, reading_time, iron_level, unit,
+                                       notes, test_type, level_class, sync_id, source_id)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (patient_id, reading_date, reading_time, test_type, iron_level, source_id)
+            DO NOTHING
+        """, (patient_id, reading_date, reading_time, iron_level, test_type_unit(test_type),
+              notes, test_type, level_class, sync_id, source_id))
+        if cursor.rowcount == 0:
+            return None
+        reading_id = cursor.lastrowid
+        self.rollups.add(patient_id, reading_date, iron_level, test_type)
+        self.running_stats.add(patient_id, reading_date, iron_level, test_type)
+        self.sketches.add(patient_id, reading_date, iron_level, test_type)
+        anomaly_flags = self.anomalies.add(
+            patient_id, reading_id, reading_date, reading_time, iron_level, test_type
+        )
+        self.forecasts.add(patient_id, reading_date, reading_time, iron_level, test_type)
+        tags = self.tags.add(patient_id, reading_id, reading_date, notes)
+        
+        return {
+            'id': reading_id,
+            'patient_id': patient_id,
+            'reading_date': str(reading_date),
+            'reading_time': reading_time,
+            'iron_level': iron_level,
+            'notes': notes,
+            'test_type': test_type,
+            'source_id': source_id,
+            'level_class': level_class,
+            'anomaly_flags': anomaly_flags,
+            'tags': tags,
+        }
+    
+    def _delete_row(self, row) -> None:
+        """Delete a reading row and update every derived table, without committing."""
+        cursor = self.connection.cursor()
+        patient_id = row['patient_id']
+        cursor.execute("DELETE FROM iron_readings WHERE id = ?", (row['id'],))
+        self.derived.unlink(row['id'])
+        self.tags.remove(row['id'])
+        self.rollups.rebuild_buckets(patient_id, row['reading_date'], row['test_type'])
+        self.running_stats.remove(patient_id, row['reading_date'], row['iron_level'],
+                                  row['test_type'])
+        self.sketches.rebuild_month(patient_id, row['reading_date'], row['test_type'])
+        self.anomalies.rebuild(patient_id, row['test_type'])
+        self.forecasts.rebuild(patient_id, row['test_type'])
+    
+    def _update_derived(self, patient_id: int, reading_date,
+                        test_type: str) -> Tuple[List[Dict], List[Dict]]:
+        """Recompute a patient's derived readings that use a test type on one day.
+        
+        Returns the (added, deleted) readings; nothing is committed.
+        """
+        added, deleted = [], []
+        for metric in self.derived.affected(test_type):
+            metric_added, metric_deleted = self._refresh_derived(patient_id, metric, reading_date)
+            added.extend(metric_added)
+            deleted.extend(metric_deleted)
+        return added, deleted
+    
+    def _refresh_derived(self, patient_id: int, metric: DerivedMetric,
+                         reading_date) -> Tuple[List[Dict], List[Dict]]:
+        """Bring one metric's derived reading for a patient and day in line with its inputs."""
+        value = self.derived.compute(patient_id, metric, reading_date)
+        existing = self.derived.existing(patient_id, metric, reading_date)
+        if existing is not None and value is not None and (
+            existing['numerator_id'], existing['denominator_id'], existing['iron_level']
+        ) == (value.numerator_id, value.denominator_id, value.level):
+            return [], []
+        
+        added, deleted = [], []
+        if existing is not None:
+            cursor = self.connection.cursor()
+            cursor.execute("SELECT * FROM iron_readings WHERE id = ?", (existing['reading_id'],))
+            row = cursor.fetchone()
+            self._delete_row(row)
+            deleted.append(dict(row))
+        if value is not None:
+            reading = self._insert_reading(patient_id, value.level, value.reading_date,
+                                           value.reading_time, metric.note, metric.test_type)
+            if reading is not None:
+                self.derived.link(reading['id'], value)
+                added.append(reading)
+        return added, deleted
+    
+    def _publish(self, added: List[Dict], deleted: List[Dict]) -> None:
+        """Apply committed changes to the store and tell the listeners.
+        
+        A batch can add a derived reading and replace it again; such a
+        reading never existed outside the transaction and is left out.
+        """
+        transient = {reading['id'] for reading in added} & {reading['id'] for reading in deleted}
+        added = [reading for reading in added if reading['id'] not in transient]
+        deleted = [reading for reading in deleted if reading['id'] not in transient]
+        for reading in deleted:
+            if self.store is not None:
+                self.store.remove(reading['id'])
+            self._notify_change("delete", reading)
+        for reading in added:
+            if self.store is not None:
+                self.store.add(reading)
+            self._notify_change("add", reading)
+    
     def get_all_readings(self) -> List[Dict]:
-        """Get all iron level readings."""
+        """Get all of the current patient's iron level readings."""
         try:
             cursor = self.connection.cursor()
             cursor.execute("""
                 SELECT * FROM iron_readings 
+                WHERE patient_id = ?
                 ORDER BY reading_date DESC, reading_time DESC
-            """)
+            """, (self.patient_id,))
             rows = cursor.fetchall()
             return [dict(row) for row in rows]
         except sqlite3.Error as e:
             print(f"Error fetching readings: {e}")
             return []
     
+    def get_reading_series(self, test_type: str = None) -> List[Tuple[str, str, float]]:
+        """Get (reading_date, reading_time, iron_level) tuples in chronological order.
+        
+        Without a test type, the readings of every native test type are included.
+        """
+        try:
+            clause = f"AND {native_sql()}"
+            params = [self.patient_id]
+            if test_type is not None:
+                clause = "AND test_type = ?"
+                params.append(test_type)
+            cursor = self.connection.cursor()
+            cursor.execute(f"""
+                SELECT reading_date, reading_time, iron_level FROM iron_readings
+                WHERE patient_id = ? {clause}
+                ORDER BY reading_date ASC, reading_time ASC
+            """, params)
+            return [tuple(row) for row in cursor.fetchall()]
+        except sqlite3.Error as e:
+            print(f"Error fetching reading series: {e}")
+            return []
+    
+    @contextmanager
+    def read_transaction(self):
+        """Run the enclosed reads against one snapshot of the database.
+        
+        Opens a deferred transaction unless one is already open, so every
+        query inside sees the database as of the first one, whatever other
+        connections commit meanwhile.
+        """
+        began = not self.connection.in_transaction
+        if began:
+            self.connection.execute("BEGIN")
+        try:
+            yield
+        finally:
+            if began:
+                self.connection.commit()
+    
+    def get_reading_store(self) -> ReadingStore:
+        """Get the shared columnar copy of the current patient's readings, loading it on first use.
+        
+        The store is updated write-through by add_reading and delete_reading,
+        and reloaded in place by select_patient.
+        """
+        if self.store is None:
+            self.store = ReadingStore()
+            self._load_store()
+        return self.store
+    
+    def _load_store(self) -> None:
+        """(Re)load the store in place, so screens holding it see the new contents."""
+        try:
+            cursor = self.connection.cursor()
+            cursor.execute("""
+                SELECT id, reading_date, reading_time, iron_level, test_type, notes, level_class
+                FROM iron_readings
+                WHERE patient_id = ?
+            """, (self.patient_id,))
+            self.store.load(cursor.fetchall())
+        except sqlite3.Error as e:
+            print(f"Error loading reading store: {e}")
+    
     def get_recent_readings(self, limit: int = 10) -> List[Dict]:
         """Get the most recent iron level readings."""
         try:
             cursor = self.connection.cursor()
             cursor.execute("""
                 SELECT * FROM iron_readings 
+                WHERE patient_id = ?
                 ORDER BY reading_date DESC, reading_time DESC
                 LIMIT ?
-            """, (limit,))
+            """, (self.patient_id, limit))
             rows = cursor.fetchall()
             return [dict(row) for row in rows]
         except sqlite3.Error as e:
@@ -117,63 +640,371 @@ class DatabaseManager:
             cursor = self.connection.cursor()
             cursor.execute("""
                 SELECT * FROM iron_readings 
-                WHERE reading_date BETWEEN ? AND ?
+                WHERE patient_id = ? AND reading_date BETWEEN ? AND ?
                 ORDER BY reading_date ASC, reading_time ASC
-            """, (start_date, end_date))
+            """, (self.patient_id, start_date, end_date))
             rows = cursor.fetchall()
             return [dict(row) for row in rows]
         except sqlite3.Error as e:
             print(f"Error fetching readings by date range: {e}")
             return []
     
+    def get_filtered_readings(self, reading_filter: ReadingFilter) -> List[Dict]:
+        """Get readings matching a filter with a single indexed query."""
+        try:
+            query, params = replace(reading_filter, patient_id=self.patient_id).to_sql()
+            cursor = self.connection.cursor()
+            cursor.execute(query, params)
+            return [dict(row) for row in cursor.fetchall()]
+        except sqlite3.Error as e:
+            print(f"Error fetching filtered readings: {e}")
+            return []
+    
     def delete_reading(self, reading_id: int) -> bool:
-        """Delete a specific reading."""
+        """Delete one of the current patient's readings."""
         try:
             cursor = self.connection.cursor()
-            cursor.execute("DELETE FROM iron_readings WHERE id = ?", (reading_id,))
+            cursor.execute("SELECT * FROM iron_readings WHERE id = ? AND patient_id = ?",
+                           (reading_id, self.patient_id))
+            row = cursor.fetchone()
+            if row is None:
+                return False
+            
+            self._delete_row(row)
+            derived_added, derived_deleted = self._update_derived(
+                row['patient_id'], row['reading_date'], row['test_type']
+            )
+            
             self.connection.commit()
-            return cursor.rowcount > 0
+            self._publish(derived_added, [dict(row)] + derived_deleted)
+            return True
         except sqlite3.Error as e:
             print(f"Error deleting reading: {e}")
+            self.connection.rollback()
             return False
+
+    def get_changes_since(self, seq: int, limit: int = 500) -> List[Dict]:
+        """Get the current patient's logged changes after a sequence number, oldest first."""
+        try:
+            return self.change_log.changes_since(self.patient_id, seq, limit)
+        except sqlite3.Error as e:
+            print(f"Error fetching changes: {e}")
+            return []
+    
+    def get_last_change_seq(self) -> int:
+        """Get the sequence number of the current patient's latest logged change."""
+        try:
+            return self.change_log.last_seq(self.patient_id)
+        except sqlite3.Error as e:
+            print(f"Error fetching change sequence: {e}")
+            return 0
+    
+    def apply_changes(self, changes: List[Dict], origin: str = None) -> Optional[int]:
+        """Apply changes received from a sync peer to the current patient in one transaction.
+        
+        Readings are matched by sync_id: an upsert identical to the stored
+        reading and a delete of a missing one are skipped, so applying a
+        batch twice changes nothing. An upsert that differs replaces the
+        reading. The log entries of readings now matching the peer's get
+        origin as their origin. Returns the number of readings changed, or
+        None on error.
+        """
+        try:
+            cursor = self.connection.cursor()
+            added, deleted = [], []
+            touched = set()
+            received = []  # sync_ids whose reading is now as the peer has it
+            for change in changes:
+                cursor.execute("SELECT * FROM iron_readings WHERE sync_id = ?", (change['sync_id'],))
+                row = cursor.fetchone()
+                if row is not None and row['patient_id'] != self.patient_id:
+                    # Already synced into another patient's history
+                    continue
+                reading = change.get('reading')
+                if change['op'] == "delete" or reading is None:
+                    if row is None:
+                        received.append(change['sync_id'])
+                        continue
+                elif row is not None and same_reading(row, reading):
+                    received.append(change['sync_id'])
+                    continue
+                
+                if row is not None:
+                    self._delete_row(row)
+                    deleted.append(dict(row))
+                    touched.add((row['reading_date'], row['test_type']))
+                if change['op'] == "upsert" and reading is not None:
+                    # A reading also entered here under another sync_id is kept as it is
+                    inserted = self._insert_reading(
+                        self.patient_id, reading['iron_level'], reading['reading_date'],
+                        reading['reading_time'], reading.get('notes') or "", reading['test_type'],
+                        change['sync_id'], reading.get('source_id') or ""
+                    )
+                    if inserted is not None:
+                        added.append(inserted)
+                        touched.add((reading['reading_date'], reading['test_type']))
+                        received.append(change['sync_id'])
+                else:
+                    received.append(change['sync_id'])
+            if origin is not None:
+                self.change_log.set_origin(self.patient_id, received, origin)
+            
+            changed = len(added) + len(deleted)
+            for reading_date, test_type in touched:
+                derived_added, derived_deleted = self._update_derived(self.patient_id, reading_date,
+                                                                      test_type)
+                added.extend(derived_added)
+                deleted.extend(derived_deleted)
+            
+            self.connection.commit()
+            self._publish(added, deleted)
+            return changed
+        except (sqlite3.Error, KeyError, TypeError) as e:
+            print(f"Error applying changes: {e}")
+            self.connection.rollback()
+            return None
+    
+    def get_sync_client_id(self, peer: str) -> Optional[str]:
+        """Get the id the current patient's sync goes by at a peer, creating it on first use."""
+        try:
+            client_id = self.change_log.client_id(self.patient_id, peer)
+            self.connection.commit()
+            return client_id
+        except sqlite3.Error as e:
+            print(f"Error fetching sync client id: {e}")
+            self.connection.rollback()
+            return None
+    
+    def get_sync_state(self, peer: str) -> Tuple[int, int]:
+        """Get (pushed_seq, pulled_seq) of the current patient's sync with a peer."""
+        try:
+            return self.change_log.peer_state(self.patient_id, peer)
+        except sqlite3.Error as e:
+            print(f"Error fetching sync state: {e}")
+            return 0, 0
+    
+    def set_sync_state(self, peer: str, pushed_seq: int, pulled_seq: int) -> bool:
+        """Record how far the current patient's sync with a peer has got."""
+        try:
+            self.change_log.set_peer_state(self.patient_id, peer, pushed_seq, pulled_seq)
+            self.connection.commit()
+            return True
+        except sqlite3.Error as e:
+            print(f"Error saving sync state: {e}")
+            self.connection.rollback()
+            return False
+    
+    def get_sync_peers(self) -> List[Dict]:
+        """Get the peers the current patient has synced with, most recent first."""
+        try:
+            return self.change_log.peers(self.patient_id)
+        except sqlite3.Error as e:
+            print(f"Error fetching sync peers: {e}")
+            return []
+    
+    def get_rollups(self, resolution: str, start_date: date, end_date: date,
+                    test_type: str = None) -> List[Dict]:
+        """Get min/max/mean aggregates for a date range at the given resolution."""
+        try:
+            return self.rollups.query(self.patient_id, resolution, start_date, end_date, test_type)
+        except sqlite3.Error as e:
+            print(f"Error fetching rollups: {e}")
+            return []
+    
+    def get_period_aggregates(self, period: str = "month", start_date: date = None,
+                              end_date: date = None, test_type: str = None) -> List[Dict]:
+        """Get count, mean, min, max and standard deviation per day, week, month or quarter.
+        
+        Buckets are read from the rollup table, so the cost depends on the number
+        of buckets in the range rather than the number of readings.
+        """
+        try:
+            if start_date is None or end_date is None:
+                first_date, last_date = self.rollups.date_bounds(self.patient_id, test_type)
+                if first_date is None:
+                    return []
+                start_date = start_date or first_date
+                end_date = end_date or last_date
+            
+            aggregates = []
+            for row in self.rollups.query(self.patient_id, period, start_date, end_date, test_type):
+                aggregates.append({
+                    'period_start': row['bucket_start'],
+                    'count': row['reading_count'],
+                    'mean': row['mean_level'],
+                    'min': row['min_level'],
+                    'max': row['max_level'],
+                    'std': math.sqrt(max(row['variance'], 0.0)),
+                })
+            return aggregates
+        except sqlite3.Error as e:
+            print(f"Error getting period aggregates: {e}")
+            return []
+    
+    def get_anomalies(self, start_date: date = None, end_date: date = None,
+                      test_type: str = None) -> List[Dict]:
+        """Get readings flagged by the anomaly detector, oldest first."""
+        try:
+            return self.anomalies.query(self.patient_id, start_date, end_date, test_type)
+        except sqlite3.Error as e:
+            print(f"Error fetching anomalies: {e}")
+            return []
+    
+    def get_anomaly_flags(self) -> Dict[int, int]:
+        """Get anomaly flags keyed by reading id; unflagged readings are absent."""
+        try:
+            return self.anomalies.all_flags(self.patient_id)
+        except sqlite3.Error as e:
+            print(f"Error fetching anomaly flags: {e}")
+            return {}
+    
+    def get_running_stats(self, test_type: str = None) -> RunningStats:
+        """Get count, mean, variance, min and max over all readings in O(1)."""
+        try:
+            return self.running_stats.total(self.patient_id, test_type)
+        except sqlite3.Error as e:
+            print(f"Error fetching running statistics: {e}")
+            return RunningStats()
+    
+    def get_period_stats(self, period: str = "month", start_date: date = None,
+                         end_date: date = None, test_type: str = None) -> Dict[str, RunningStats]:
+        """Get running statistics per year or month, keyed by the period's first day."""
+        try:
+            return self.running_stats.query(self.patient_id, period, start_date, end_date, test_type)
+        except sqlite3.Error as e:
+            print(f"Error fetching period statistics: {e}")
+            return {}
+    
+    def get_quantile_sketch(self, start_date: date = None, end_date: date = None,
+                            test_type: str = None) -> TDigest:
+        """Get a t-digest of the readings in the months overlapping a date range."""
+        try:
+            return self.sketches.query(self.patient_id, start_date, end_date, test_type)
+        except sqlite3.Error as e:
+            print(f"Error fetching quantile sketch: {e}")
+            return TDigest()
+    
+    def get_forecast_state(self, test_type: str) -> Optional[TrendState]:
+        """Get the persisted trend model for a test type, or None if it has no readings."""
+        try:
+            return self.forecasts.load_state(self.patient_id, test_type)
+        except sqlite3.Error as e:
+            print(f"Error loading forecast model: {e}")
+            return None
+    
+    def get_reading_metrics(self, start_date: date = None, end_date: date = None,
+                            test_type: str = None,
+                            window_days: float = ROLLING_WINDOW_DAYS) -> List[Dict]:
+        """Get readings in a date range, oldest first, with per-test-type window metrics.
+        
+        Each row adds timestamp, rolling_mean and rolling_count over the
+        trailing window_days, delta from the previous reading of the same
+        test type and days_since_previous.
+        """
+        try:
+            return self.window_metrics.query(self.patient_id, start_date, end_date, test_type,
+                                             window_days)
+        except sqlite3.Error as e:
+            print(f"Error fetching reading metrics: {e}")
+            return []
+    
+    def get_recent_reading_metrics(self, limit: int = 10) -> List[Dict]:
+        """Get the most recent readings, newest first, with their window metrics."""
+        try:
+            return self.window_metrics.recent(self.patient_id, limit)
+        except sqlite3.Error as e:
+            print(f"Error fetching recent reading metrics: {e}")
+            return []
+    
+    def get_tags(self) -> List[Dict]:
+        """Get every tag with its reading count and first and last dates, most used first."""
+        try:
+            return self.tags.all_tags(self.patient_id)
+        except sqlite3.Error as e:
+            print(f"Error fetching tags: {e}")
+            return []
+    
+    def get_tag_comparison(self, tag: str, test_type: str = DEFAULT_TEST_TYPE,
+                           mode: str = "before_after", pivot_date: date = None) -> Optional[TagComparison]:
+        """Compare a test type's levels before and after, or with and without, a tag.
+        
+        Before/after splits at pivot_date, by default the first tagged reading.
+        Returns None if the tag has never been used and no pivot is given.
+        """
+        try:
+            return self.tags.compare(self.patient_id, tag, test_type, mode, pivot_date)
+        except sqlite3.Error as e:
+            print(f"Error comparing tag {tag}: {e}")
+            return None
+    
+    def get_tag_comparisons(self, test_type: str = DEFAULT_TEST_TYPE,
+                            limit: int = 3) -> List[TagComparison]:
+        """Compare a test type's levels before and after the first use of each of the most used tags."""
+        try:
+            return self.tags.compare_most_used(self.patient_id, test_type, limit)
+        except sqlite3.Error as e:
+            print(f"Error comparing tags: {e}")
+            return []
+    
+    def get_tag_keywords(self) -> Dict[str, str]:
+        """Get the keyword phrases recognized in notes and the tag each one adds."""
+        try:
+            return dict(self.tags.get_keywords())
+        except sqlite3.Error as e:
+            print(f"Error fetching tag keywords: {e}")
+            return {}
+    
+    def set_tag_keyword(self, keyword: str, tag: Optional[str]) -> bool:
+        """Map a keyword phrase to a tag (None removes it) and re-tag all readings."""
+        try:
+            self.tags.set_keyword(keyword, tag)
+            self.tags.rebuild_all()
+            self.connection.commit()
+            return True
+        except sqlite3.Error as e:
+            print(f"Error updating tag keywords: {e}")
+            self.connection.rollback()
+            self.tags.keywords = None
+            return False
+    
+    def get_reading_date_bounds(self, test_type: str = None) -> Tuple[Optional[date], Optional[date]]:
+        """Get the dates of the first and last readings, optionally of one test type."""
+        try:
+            return self.rollups.date_bounds(self.patient_id, test_type)
+        except sqlite3.Error as e:
+            print(f"Error fetching reading date bounds: {e}")
+            return None, None
     
     def get_statistics(self) -> Dict:
-        """Get statistical information about iron readings."""
+        """Get statistical information about the current patient's native readings."""
         try:
             cursor = self.connection.cursor()
             
-            # Basic statistics
-            cursor.execute("""
-                SELECT 
-                    COUNT(*) as total_readings,
-                    AVG(iron_level) as average_level,
-                    MIN(iron_level) as min_level,
-                    MAX(iron_level) as max_level,
-                    MIN(reading_date) as first_reading_date,
-                    MAX(reading_date) as last_reading_date
-                FROM iron_readings
-            """)
-            stats = dict(cursor.fetchone())
-            
-            # Get normal range from user profile
-            cursor.execute("SELECT normal_range_min, normal_range_max FROM user_profile LIMIT 1")
-            profile = cursor.fetchone()
-            if profile:
-                stats['normal_range_min'] = profile['normal_range_min']
-                stats['normal_range_max'] = profile['normal_range_max']
-                
-                # Count readings in different ranges
-                cursor.execute("""
-                    SELECT 
-                        SUM(CASE WHEN iron_level < ? THEN 1 ELSE 0 END) as low_readings,
-                        SUM(CASE WHEN iron_level BETWEEN ? AND ? THEN 1 ELSE 0 END) as normal_readings,
-                        SUM(CASE WHEN iron_level > ? THEN 1 ELSE 0 END) as high_readings
-                    FROM iron_readings
-                """, (profile['normal_range_min'], profile['normal_range_min'], 
-                     profile['normal_range_max'], profile['normal_range_max']))
-                
-                range_stats = dict(cursor.fetchone())
-                stats.update(range_stats)
+            # Basic statistics come from the running accumulators, not a table scan
+            total = self.running_stats.total(self.patient_id)
+            first_date, last_date = self.rollups.date_bounds(self.patient_id)
+            stats = {
+                'total_readings': total.count,
+                'average_level': total.mean if total.count else None,
+                'std_level': total.std() if total.count else None,
+                'min_level': total.min,
+                'max_level': total.max,
+                'first_reading_date': first_date.isoformat() if first_date else None,
+                'last_reading_date': last_date.isoformat() if last_date else None,
+            }
+            
+            # Normal range of the default test type, for display
+            stats['normal_range_min'], stats['normal_range_max'] = self.get_normal_range()
+            
+            # Count readings per precomputed class from the class index
+            cursor.execute(f"""
+                SELECT level_class, COUNT(*) FROM iron_readings
+                WHERE patient_id = ? AND {native_sql()}
+                GROUP BY level_class
+            """, (self.patient_id,))
+            counts = {level_class: count for level_class, count in cursor.fetchall()}
+            for level_class in ("low", "normal", "high"):
+                stats[f'{level_class}_readings'] = counts.get(level_class, 0)
             
             return stats
         except sqlite3.Error as e:
@@ -181,8 +1012,14 @@ class DatabaseManager:
             return {}
     
     def update_user_profile(self, age: int = None, gender: str = None, 
-                           normal_range_min: float = None, normal_range_max: float = None) -> bool:
-        """Update user profile information."""
+                           normal_range_min: float = None, normal_range_max: float = None,
+                           range_override: bool = None) -> bool:
+        """Update the current patient's profile.
+        
+        Setting the normal range makes it override the reference table for
+        Serum Iron unless range_override says otherwise; range_override=False
+        alone goes back to the table.
+        """
         try:
             cursor = self.connection.cursor()
             
@@ -202,12 +1039,22 @@ class DatabaseManager:
             if normal_range_max is not None:
                 updates.append("normal_range_max = ?")
                 values.append(normal_range_max)
+            if range_override is None and (normal_range_min is not None or normal_range_max is not None):
+                range_override = True
+            if range_override is not None:
+                updates.append("range_override = ?")
+                values.append(int(range_override))
             
             if updates:
                 updates.append("updated_at = CURRENT_TIMESTAMP")
-                query = f"UPDATE user_profile SET {', '.join(updates)} WHERE id = 1"
-                cursor.execute(query, values)
+                query = f"UPDATE user_profile SET {', '.join(updates)} WHERE patient_id = ?"
+                cursor.execute(query, values + [self.patient_id])
+                # Age, sex and the fallback range all feed the classification
+                self._classify_readings(self.patient_id)
                 self.connection.commit()
+                if self.store is not None:
+                    self._load_store()
+                self._notify_change("profile", {})
                 return True
             
             return False
@@ -216,16 +1063,149 @@ class DatabaseManager:
             return False
     
     def get_user_profile(self) -> Dict:
-        """Get user profile information."""
+        """Get the current patient's profile."""
         try:
-            cursor = self.connection.cursor()
-            cursor.execute("SELECT * FROM user_profile LIMIT 1")
-            row = cursor.fetchone()
-            return dict(row) if row else {}
+            return self._profile(self.patient_id)
         except sqlite3.Error as e:
             print(f"Error getting user profile: {e}")
             return {}
     
+    def _profile(self, patient_id: int) -> Dict:
+        cursor = self.connection.cursor()
+        cursor.execute("SELECT * FROM user_profile WHERE patient_id = ?", (patient_id,))
+        row = cursor.fetchone()
+        return dict(row) if row else {}
+    
+    def get_normal_range(self, test_type: str = DEFAULT_TEST_TYPE,
+                         profile: Dict = None) -> Tuple[float, float]:
+        """Get the normal range for a test type at the current patient's sex and age.
+        
+        A range set in the profile overrides the reference table for Serum
+        Iron, and test types without a reference range use the profile's range.
+        A profile already read can be passed to resolve against instead.
+        """
+        return self._normal_range(self.patient_id, test_type, profile)
+    
+    def _normal_range(self, patient_id: int, test_type: str,
+                      profile: Dict = None) -> Tuple[float, float]:
+        try:
+            if profile is None:
+                profile = self._profile(patient_id)
+            return self.reference_ranges.resolve(test_type, profile)
+        except sqlite3.Error as e:
+            print(f"Error looking up reference range: {e}")
+            return DEFAULT_PROFILE_RANGE
+    
+    def get_reference_ranges(self) -> List[Dict]:
+        """Get all reference ranges by test type, sex and age."""
+        try:
+            return self.reference_ranges.all_ranges()
+        except sqlite3.Error as e:
+            print(f"Error fetching reference ranges: {e}")
+            return []
+    
+    def set_reference_range(self, test_type: str, sex: str, age_min: float, age_max: Optional[float],
+                            normal_min: float, normal_max: float) -> bool:
+        """Add or replace a reference range and reclassify every patient's readings."""
+        try:
+            self.reference_ranges.set_range(test_type, sex, age_min, age_max, normal_min, normal_max)
+            for patient_id in self.patients.ids():
+                self._classify_readings(patient_id)
+            self.connection.commit()
+            if self.store is not None:
+                self._load_store()
+            self._notify_change("profile", {})
+            return True
+        except sqlite3.Error as e:
+            print(f"Error setting reference range: {e}")
+            self.connection.rollback()
+            return False
+    
+    def _classify_readings(self, patient_id: int) -> None:
+        """Recompute the level class of a patient's readings for their profile."""
+        self.reference_ranges.classify_all(patient_id, self._profile(patient_id))
+    
+    def get_patients(self) -> List[Dict]:
+        """Get every patient with their reading count, by name."""
+        try:
+            return self.patients.all()
+        except sqlite3.Error as e:
+            print(f"Error fetching patients: {e}")
+            return []
+    
+    def get_current_patient(self) -> Dict:
+        """Get the id, name and creation time of the selected patient."""
+        try:
+            return self.patients.get(self.patient_id) or {}
+        except sqlite3.Error as e:
+            print(f"Error fetching patient: {e}")
+            return {}
+    
+    def add_patient(self, name: str) -> Optional[int]:
+        """Add a patient with a default profile and return their id."""
+        try:
+            patient_id = self.patients.add(name)
+            self._create_profile(patient_id)
+            self.connection.commit()
+            return patient_id
+        except sqlite3.Error as e:
+            print(f"Error adding patient: {e}")
+            self.connection.rollback()
+            return None
+    
+    def rename_patient(self, patient_id: int, name: str) -> bool:
+        """Change a patient's name."""
+        try:
+            self.patients.rename(patient_id, name)
+            self.connection.commit()
+            if patient_id == self.patient_id:
+                self._notify_change("patient", {'patient_id': patient_id})
+            return True
+        except sqlite3.Error as e:
+            print(f"Error renaming patient: {e}")
+            self.connection.rollback()
+            return False
+    
+    def select_patient(self, patient_id: int) -> bool:
+        """Make another patient current.
+        
+        Every table is keyed by patient_id, so this only reloads the shared
+        store from that patient's index range and tells the listeners.
+        """
+        try:
+            if self.patients.get(patient_id) is None:
+                return False
+        except sqlite3.Error as e:
+            print(f"Error selecting patient: {e}")
+            return False
+        if patient_id == self.patient_id:
+            return True
+        
+        self.patient_id = patient_id
+        if self.store is not None:
+            self._load_store()
+        self._notify_change("patient", {'patient_id': patient_id})
+        return True
+    
+    def add_change_listener(self, listener: Callable[[str, Dict], None]) -> None:
+        """Register a callback invoked as listener(event, reading) after each change.
+        
+        Events are "add" and "delete" with the affected reading, "profile"
+        with an empty dict after the user profile or reference ranges were
+        updated and the readings reclassified, and "patient" with the
+        patient_id after another patient was selected or the current one
+        renamed.
+        """
+        self.change_listeners.append(listener)
+    
+    def _notify_change(self, event: str, reading: Dict) -> None:
+        """Let listeners update their caches after a committed change."""
+        for listener in self.change_listeners:
+            try:
+                listener(event, reading)
+            except Exception as e:
+                print(f"Error in change listener: {e}")
+    
     def close(self) -> None:
         """Close database connection."""
         if self.connection:
@@ -0,0 +1,196 @@
+import sqlite3
+from dataclasses import dataclass
+from typing import List, Optional, Tuple
+
+from database.patients import DEFAULT_PATIENT_ID, has_column
+
+
+@dataclass(frozen=True)
+class DerivedMetric:
+    """A test type computed as scale · numerator / denominator from same-day readings."""
+
+    test_type: str
+    numerator: str
+    denominator: str
+    scale: float = 1.0
+    unit: str = ""
+    range_test_type: Optional[str] = None  # native test type whose reference ranges apply
+
+    @property
+    def inputs(self) -> Tuple[str, str]:
+        return self.numerator, self.denominator
+
+    @property
+    def note(self) -> str:
+        return f"Calculated from {self.numerator} ÷ {self.denominator}"
+
+    def compute(self, numerator: float, denominator: float) -> Optional[float]:
+        if not denominator:
+            return None
+        return round(self.scale * numerator / denominator, 1)
+
+
+DERIVED_METRICS = (
+    DerivedMetric(
+        test_type="Transferrin Saturation (calculated)",
+        numerator="Serum Iron",
+        denominator="TIBC (Total Iron Binding Capacity)",
+        scale=100.0,
+        unit="%",
+        range_test_type="Transferrin Saturation",
+    ),
+)
+DERIVED_BY_TYPE = {metric.test_type: metric for metric in DERIVED_METRICS}
+
+# Unit of the iron tests (Serum Iron, TIBC, UIBC) and of any test type
+# not listed below, as stored in iron_readings.unit
+DEFAULT_UNIT = "μg/dL"
+NATIVE_UNITS = {
+    "Serum Iron": DEFAULT_UNIT,
+    "Transferrin Saturation": "%",
+    "Ferritin": "ng/mL",
+    "TIBC (Total Iron Binding Capacity)": DEFAULT_UNIT,
+    "UIBC (Unsaturated Iron Binding Capacity)": DEFAULT_UNIT,
+}
+
+
+def test_type_unit(test_type: Optional[str]) -> str:
+    """Unit a test type's levels are expressed in."""
+    metric = DERIVED_BY_TYPE.get(test_type)
+    if metric is not None:
+        return metric.unit
+    return NATIVE_UNITS.get(test_type, DEFAULT_UNIT)
+
+
+def native_sql(column: str = "test_type") -> str:
+    """SQL condition that a test type column holds a native test type, not a derived one.
+
+    Queries over all of a patient's test types use it, so derived values
+    (in other units, and computed from readings already counted) are only
+    seen when their test type is asked for.
+    """
+    derived_types = ", ".join(f"'{metric.test_type}'" for metric in DERIVED_METRICS)
+    return f"{column} NOT IN ({derived_types})"
+
+
+@dataclass
+class DerivedValue:
+    """A derived level for one patient and day, and the readings it was computed from."""
+
+    patient_id: int
+    metric: DerivedMetric
+    reading_date: str
+    reading_time: str
+    level: float
+    numerator_id: int
+    denominator_id: int
+
+
+class DerivedMetrics:
+    """Keeps derived readings such as transferrin saturation in step with their inputs.
+
+    A derived value pairs a patient's latest numerator and denominator
+    readings of the same day, each found through the (patient_id, test_type,
+    reading_date, reading_time) index.
+    DatabaseManager stores it as an ordinary row of iron_readings, so every
+    per-test-type aggregate, chart and query treats it like a native test
+    type, while queries over all test types leave it out (see native_sql);
+    the derived_readings table records which rows are derived and from what.
+    """
+
+    def __init__(self, connection: sqlite3.Connection):
+        self.connection = connection
+
+    def create_tables(self) -> None:
+        cursor = self.connection.cursor()
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS derived_readings (
+                reading_id INTEGER PRIMARY KEY,
+                patient_id INTEGER NOT NULL,
+                test_type TEXT NOT NULL,
+                reading_date DATE NOT NULL,
+                numerator_id INTEGER NOT NULL,
+                denominator_id INTEGER NOT NULL
+            )
+        """)
+        # Derived readings from before patients were added belong to the default patient
+        if not has_column(cursor, "derived_readings", "patient_id"):
+            cursor.execute(f"""
+                ALTER TABLE derived_readings
+                ADD COLUMN patient_id INTEGER NOT NULL DEFAULT {DEFAULT_PATIENT_ID}
+            """)
+        cursor.execute("DROP INDEX IF EXISTS idx_derived_type_date")
+        cursor.execute("""
+            CREATE UNIQUE INDEX IF NOT EXISTS idx_derived_patient_type_date
+            ON derived_readings (patient_id, test_type, reading_date)
+        """)
+
+    def affected(self, test_type: str) -> List[DerivedMetric]:
+        """Metrics that use readings of a test type as an input."""
+        return [metric for metric in DERIVED_METRICS if test_type in metric.inputs]
+
+    def _latest(self, patient_id: int, test_type: str, reading_date: str):
+        cursor = self.connection.cursor()
+        cursor.execute("""
+            SELECT id, reading_time, iron_level FROM iron_readings
+            WHERE patient_id = ? AND test_type = ? AND reading_date = ?
+            ORDER BY reading_time DESC, id DESC
+            LIMIT 1
+        """, (patient_id, test_type, reading_date))
+        return cursor.fetchone()
+
+    def compute(self, patient_id: int, metric: DerivedMetric, reading_date) -> Optional[DerivedValue]:
+        """Compute a metric for one patient and day, or None if an input is missing."""
+        reading_date = str(reading_date)
+        numerator = self._latest(patient_id, metric.numerator, reading_date)
+        denominator = self._latest(patient_id, metric.denominator, reading_date)
+        if numerator is None or denominator is None:
+            return None
+        level = metric.compute(numerator['iron_level'], denominator['iron_level'])
+        if level is None:
+            return None
+        return DerivedValue(
+            patient_id=patient_id,
+            metric=metric,
+            reading_date=reading_date,
+            reading_time=max(numerator['reading_time'], denominator['reading_time']),
+            level=level,
+            numerator_id=numerator['id'],
+            denominator_id=denominator['id'],
+        )
+
+    def existing(self, patient_id: int, metric: DerivedMetric, reading_date):
+        """The stored derived row for a patient, metric and day, if any."""
+        cursor = self.connection.cursor()
+        cursor.execute("""
+            SELECT d.reading_id, d.numerator_id, d.denominator_id, r.iron_level
+            FROM derived_readings d
+            JOIN iron_readings r ON r.id = d.reading_id
+            WHERE d.patient_id = ? AND d.test_type = ? AND d.reading_date = ?
+        """, (patient_id, metric.test_type, str(reading_date)))
+        return cursor.fetchone()
+
+    def link(self, reading_id: int, value: DerivedValue) -> None:
+        self.connection.execute("""
+            INSERT OR REPLACE INTO derived_readings (reading_id, patient_id, test_type,
+                                                    reading_date, numerator_id, denominator_id)
+            VALUES (?, ?, ?, ?, ?, ?)
+        """, (reading_id, value.patient_id, value.metric.test_type, value.reading_date,
+              value.numerator_id, value.denominator_id))
+
+    def unlink(self, reading_id: int) -> None:
+        self.connection.execute("DELETE FROM derived_readings WHERE reading_id = ?", (reading_id,))
+
+    def input_dates(self, metric: DerivedMetric) -> List[Tuple[int, str]]:
+        """(patient_id, reading_date) of the days that have readings of every input of a metric."""
+        cursor = self.connection.cursor()
+        cursor.execute("""
+            SELECT DISTINCT n.patient_id, n.reading_date FROM iron_readings n
+            WHERE n.test_type = ? AND EXISTS (
+                SELECT 1 FROM iron_readings d
+                WHERE d.patient_id = n.patient_id AND d.test_type = ?
+                  AND d.reading_date = n.reading_date
+            )
+            ORDER BY n.patient_id, n.reading_date
+        """, metric.inputs)
+        return [tuple(row) for row in cursor.fetchall()]
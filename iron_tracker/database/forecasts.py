@@ -0,0 +1,276 @@
+import math
+import sqlite3
+from dataclasses import astuple, dataclass
+from datetime import date
+from typing import Optional
+
+from database.derived import DERIVED_BY_TYPE
+from database.patients import drop_unscoped, has_column
+from database.reading_store import EPOCH_ORDINAL, reading_timestamp
+from database.reference_ranges import ANY_SEX, DEFAULT_REFERENCE_RANGES, DEFAULT_TEST_TYPE
+
+
+# Measurement noise of a single Serum Iron test (μg/dL, one standard deviation)
+OBSERVATION_STD = 10.0
+# Random-walk noise of the level (μg/dL per sqrt(day)) and of the slope
+# (μg/dL per day per sqrt(day))
+LEVEL_NOISE = 1.5
+SLOPE_NOISE = 0.01
+# Prior standard deviation of the slope before any trend has been seen
+INITIAL_SLOPE_STD = 1.0
+# The noise constants are in NOISE_TEST_TYPE's units; other test types scale
+# them by the width of their adult reference range relative to its range
+NOISE_TEST_TYPE = DEFAULT_TEST_TYPE
+# Smoothing factor for the typical number of days between readings
+INTERVAL_ALPHA = 0.3
+DEFAULT_INTERVAL_DAYS = 30.0
+# Crossings further out than this are not reported
+MAX_CROSSING_DAYS = 365
+# z-value for the 95% prediction interval and the slope significance test
+Z_95 = 1.96
+
+
+def _adult_range_width(test_type: str) -> Optional[float]:
+    """Width of a test type's default adult range for either sex, if it has one."""
+    for range_type, sex, age_min, age_max, normal_min, normal_max in DEFAULT_REFERENCE_RANGES:
+        if range_type == test_type and sex == ANY_SEX and age_max is None:
+            return normal_max - normal_min
+    return None
+
+
+def noise_scale(test_type: str) -> float:
+    """Factor converting the noise constants to a test type's units; 1 for unknown test types.
+
+    It comes from the default reference table rather than the editable one,
+    so stored models keep their meaning when the table changes.
+    """
+    metric = DERIVED_BY_TYPE.get(test_type)
+    if metric is not None and metric.range_test_type:
+        test_type = metric.range_test_type
+    width = _adult_range_width(test_type)
+    return width / _adult_range_width(NOISE_TEST_TYPE) if width else 1.0
+
+
+@dataclass
+class TrendState:
+    """Kalman filter state of a local linear trend: level and slope per day.
+
+    The covariance is stored as its three distinct entries. noise_scale
+    multiplies the noise constants, see noise_scale().
+    """
+
+    reading_count: int = 0
+    last_timestamp: float = 0.0
+    level: float = 0.0
+    slope: float = 0.0
+    p_level: float = 0.0
+    p_cross: float = 0.0
+    p_slope: float = 0.0
+    mean_interval: float = DEFAULT_INTERVAL_DAYS
+    noise_scale: float = 1.0
+
+    @property
+    def observation_variance(self) -> float:
+        return (OBSERVATION_STD * self.noise_scale) ** 2
+
+    def predict(self, days: float):
+        """Project the state forward; returns (level, slope, p_level, p_cross, p_slope)."""
+        days = max(days, 0.0)
+        level = self.level + self.slope * days
+        # P' = F P F^T + Q for F = [[1, days], [0, 1]], with integrated slope noise
+        q = (SLOPE_NOISE * self.noise_scale) ** 2
+        p_level = (self.p_level + 2 * days * self.p_cross + days * days * self.p_slope
+                   + (LEVEL_NOISE * self.noise_scale) ** 2 * days + q * days ** 3 / 3)
+        p_cross = self.p_cross + days * self.p_slope + q * days ** 2 / 2
+        p_slope = self.p_slope + q * days
+        return level, self.slope, p_level, p_cross, p_slope
+
+    def update(self, timestamp: float, value: float) -> None:
+        """Fold in the next reading in time order."""
+        if self.reading_count == 0:
+            self.level = value
+            self.slope = 0.0
+            self.p_level = self.observation_variance
+            self.p_cross = 0.0
+            self.p_slope = (INITIAL_SLOPE_STD * self.noise_scale) ** 2
+        else:
+            days = timestamp - self.last_timestamp
+            level, slope, p_level, p_cross, p_slope = self.predict(days)
+
+            innovation = value - level
+            variance = p_level + self.observation_variance
+            gain_level = p_level / variance
+            gain_slope = p_cross / variance
+
+            self.level = level + gain_level * innovation
+            self.slope = slope + gain_slope * innovation
+            self.p_level = (1 - gain_level) * p_level
+            self.p_cross = (1 - gain_level) * p_cross
+            self.p_slope = p_slope - gain_slope * p_cross
+
+            if days > 0:
+                self.mean_interval += INTERVAL_ALPHA * (days - self.mean_interval)
+
+        self.reading_count += 1
+        self.last_timestamp = timestamp
+
+
+class ForecastModels:
+    """Local linear trend models per patient and test type, updated as readings are inserted.
+
+    The filter state is persisted in forecast_models, so a forecast is read
+    from one row instead of refitting the series. Inserts out of time order
+    and deletes replay the affected test type.
+    """
+
+    def __init__(self, connection: sqlite3.Connection):
+        self.connection = connection
+
+    def create_tables(self) -> None:
+        """Create the model table and backfill it from existing readings."""
+        cursor = self.connection.cursor()
+        drop_unscoped(cursor, "forecast_models")
+        # Models fitted before noise scaling are refitted with their test type's
+        cursor.execute("SELECT EXISTS (SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?)",
+                       ("forecast_models",))
+        if cursor.fetchone()[0] and not has_column(cursor, "forecast_models", "noise_scale"):
+            cursor.execute("DROP TABLE forecast_models")
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS forecast_models (
+                patient_id INTEGER NOT NULL,
+                test_type TEXT NOT NULL,
+                reading_count INTEGER NOT NULL,
+                last_timestamp REAL NOT NULL,
+                level REAL NOT NULL,
+                slope REAL NOT NULL,
+                p_level REAL NOT NULL,
+                p_cross REAL NOT NULL,
+                p_slope REAL NOT NULL,
+                mean_interval REAL NOT NULL,
+                noise_scale REAL NOT NULL,
+                PRIMARY KEY (patient_id, test_type)
+            ) WITHOUT ROWID
+        """)
+
+        cursor.execute("SELECT EXISTS (SELECT 1 FROM forecast_models)")
+        has_models = cursor.fetchone()[0]
+        cursor.execute("SELECT EXISTS (SELECT 1 FROM iron_readings)")
+        has_readings = cursor.fetchone()[0]
+        if has_readings and not has_models:
+            self.rebuild_all()
+
+    def load_state(self, patient_id: int, test_type: str) -> Optional[TrendState]:
+        cursor = self.connection.cursor()
+        cursor.execute("""
+            SELECT reading_count, last_timestamp, level, slope, p_level, p_cross, p_slope,
+                   mean_interval, noise_scale
+            FROM forecast_models WHERE patient_id = ? AND test_type = ?
+        """, (patient_id, test_type))
+        row = cursor.fetchone()
+        return TrendState(*row) if row else None
+
+    def save_state(self, patient_id: int, test_type: str, state: TrendState) -> None:
+        self.connection.execute("""
+            INSERT OR REPLACE INTO forecast_models (patient_id, test_type, reading_count,
+                                                    last_timestamp, level, slope, p_level,
+                                                    p_cross, p_slope, mean_interval,
+                                                    noise_scale)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """, (patient_id, test_type, *astuple(state)))
+
+    def add(self, patient_id: int, reading_date, reading_time: str, iron_level: float,
+            test_type: str) -> None:
+        """Update the model with a reading that was just inserted."""
+        timestamp = reading_timestamp(reading_date, reading_time)
+        state = self.load_state(patient_id, test_type) or TrendState(noise_scale=noise_scale(test_type))
+        if state.reading_count and timestamp < state.last_timestamp:
+            self.rebuild(patient_id, test_type)
+            return
+        state.update(timestamp, iron_level)
+        self.save_state(patient_id, test_type, state)
+
+    def rebuild(self, patient_id: int, test_type: str) -> None:
+        """Refit one patient's test type from its readings, e.g. after a delete."""
+        cursor = self.connection.cursor()
+        cursor.execute("""
+            SELECT reading_date, reading_time, iron_level FROM iron_readings
+            WHERE patient_id = ? AND test_type = ?
+            ORDER BY reading_date, reading_time, id
+        """, (patient_id, test_type))
+
+        state = TrendState(noise_scale=noise_scale(test_type))
+        for reading_date, reading_time, iron_level in cursor.fetchall():
+            state.update(reading_timestamp(reading_date, reading_time), iron_level)
+
+        if state.reading_count:
+            self.save_state(patient_id, test_type, state)
+        else:
+            cursor.execute("DELETE FROM forecast_models WHERE patient_id = ? AND test_type = ?",
+                           (patient_id, test_type))
+
+    def rebuild_all(self) -> None:
+        """Refit every patient's test types."""
+        cursor = self.connection.cursor()
+        cursor.execute("DELETE FROM forecast_models")
+        cursor.execute("SELECT DISTINCT patient_id, test_type FROM iron_readings")
+        for patient_id, test_type in cursor.fetchall():
+            self.rebuild(patient_id, test_type)
+
+
+@dataclass
+class Crossing:
+    """Projected time at which the level trend crosses a normal range bound."""
+
+    bound: str  # "min" or "max"
+    value: float
+    days: float  # from the last reading
+    on_date: date
+
+
+@dataclass
+class Forecast:
+    """Predicted next reading with a 95% interval, and any expected range crossing."""
+
+    value: float
+    lower: float
+    upper: float
+    on_date: date
+    slope_per_day: float
+    crossing: Optional[Crossing] = None
+
+
+def timestamp_date(timestamp: float) -> date:
+    return date.fromordinal(EPOCH_ORDINAL + int(timestamp // 1))
+
+
+def forecast(state: TrendState, normal_min: float, normal_max: float,
+             days: float = None) -> Forecast:
+    """Forecast the reading expected days after the last one (default: the usual interval)."""
+    if days is None:
+        days = state.mean_interval
+    level, slope, p_level, _, p_slope = state.predict(days)
+    std = math.sqrt(max(p_level, 0.0) + state.observation_variance)
+
+    result = Forecast(
+        value=level,
+        lower=level - Z_95 * std,
+        upper=level + Z_95 * std,
+        on_date=timestamp_date(state.last_timestamp + days),
+        slope_per_day=slope,
+    )
+
+    # Only extrapolate a trend that is clearly different from flat
+    if abs(state.slope) <= Z_95 * math.sqrt(max(state.p_slope, 0.0)):
+        return result
+    if state.slope > 0 and state.level < normal_max:
+        bound, value = ("min", normal_min) if state.level < normal_min else ("max", normal_max)
+    elif state.slope < 0 and state.level > normal_min:
+        bound, value = ("max", normal_max) if state.level > normal_max else ("min", normal_min)
+    else:
+        return result
+
+    crossing_days = (value - state.level) / state.slope
+    if crossing_days <= MAX_CROSSING_DAYS:
+        result.crossing = Crossing(bound, value, crossing_days,
+                                   timestamp_date(state.last_timestamp + crossing_days))
+    return result
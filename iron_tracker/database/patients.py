@@ -0,0 +1,83 @@
+import sqlite3
+from typing import Dict, List, Optional
+
+
+# Patient that owns readings written before patients were added, and the
+# one selected when the app starts
+DEFAULT_PATIENT_ID = 1
+DEFAULT_PATIENT_NAME = "Me"
+
+
+def has_column(cursor: sqlite3.Cursor, table: str, column: str) -> bool:
+    cursor.execute(f"PRAGMA table_info({table})")
+    return column in [row[1] for row in cursor.fetchall()]
+
+
+def drop_unscoped(cursor: sqlite3.Cursor, table: str) -> None:
+    """Drop a derived table built before readings had a patient.
+
+    Its key has no patient_id, so it is recreated and backfilled from the
+    readings instead of migrated.
+    """
+    cursor.execute("SELECT EXISTS (SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?)",
+                   (table,))
+    if cursor.fetchone()[0] and not has_column(cursor, table, "patient_id"):
+        cursor.execute(f"DROP TABLE {table}")
+
+
+class Patients:
+    """The people whose readings a database holds.
+
+    Every reading and every derived table is keyed by patient_id, with
+    indexes led by it, so one patient's data is a contiguous index range and
+    switching patients needs no separate database file.
+    """
+
+    def __init__(self, connection: sqlite3.Connection):
+        self.connection = connection
+
+    def create_tables(self) -> None:
+        """Create the patients table with the default patient."""
+        cursor = self.connection.cursor()
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS patients (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                name TEXT NOT NULL,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+        cursor.execute("SELECT EXISTS (SELECT 1 FROM patients WHERE id = ?)", (DEFAULT_PATIENT_ID,))
+        if not cursor.fetchone()[0]:
+            cursor.execute("INSERT INTO patients (id, name) VALUES (?, ?)",
+                           (DEFAULT_PATIENT_ID, DEFAULT_PATIENT_NAME))
+
+    def add(self, name: str) -> int:
+        cursor = self.connection.cursor()
+        cursor.execute("INSERT INTO patients (name) VALUES (?)", (name.strip(),))
+        return cursor.lastrowid
+
+    def rename(self, patient_id: int, name: str) -> None:
+        self.connection.execute("UPDATE patients SET name = ? WHERE id = ?",
+                                (name.strip(), patient_id))
+
+    def get(self, patient_id: int) -> Optional[Dict]:
+        cursor = self.connection.cursor()
+        cursor.execute("SELECT id, name, created_at FROM patients WHERE id = ?", (patient_id,))
+        row = cursor.fetchone()
+        return dict(row) if row else None
+
+    def all(self) -> List[Dict]:
+        """Every patient with their reading count, by name."""
+        cursor = self.connection.cursor()
+        cursor.execute("""
+            SELECT p.id, p.name, p.created_at,
+                   (SELECT COUNT(*) FROM iron_readings r WHERE r.patient_id = p.id) AS reading_count
+            FROM patients p
+            ORDER BY p.name COLLATE NOCASE, p.id
+        """)
+        return [dict(row) for row in cursor.fetchall()]
+
+    def ids(self) -> List[int]:
+        cursor = self.connection.cursor()
+        cursor.execute("SELECT id FROM patients ORDER BY id")
+        return [row[0] for row in cursor.fetchall()]
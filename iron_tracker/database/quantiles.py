@@ -0,0 +1,277 @@
+import math
+import sqlite3
+from dataclasses import dataclass
+from typing import Iterable, Optional
+
+import numpy as np
+
+from database.derived import native_sql
+from database.patients import drop_unscoped
+from database.rollups import as_date, bucket_end
+
+
+# Larger compression keeps more centroids (about compression / 2) and gives
+# more accurate quantiles
+DEFAULT_COMPRESSION = 200
+
+
+class TDigest:
+    """Mergeable quantile sketch (merging t-digest with the k1 scale function).
+
+    Centroids are clustered so each spans at most one unit of
+    k(q) = compression / (2π) · asin(2q − 1). That keeps them tiny near the
+    tails, which stay accurate for P5/P95, and coarser around the median.
+    Digests of disjoint data can be merged, e.g. months into a year or
+    several patients into a cohort.
+    """
+
+    def __init__(self, compression: float = DEFAULT_COMPRESSION):
+        self.compression = compression
+        self.means = np.empty(0)
+        self.weights = np.empty(0)
+        self.min = math.inf
+        self.max = -math.inf
+
+    @property
+    def count(self) -> float:
+        return float(self.weights.sum())
+
+    def __len__(self) -> int:
+        return len(self.means)
+
+    def add(self, value: float) -> None:
+        self.extend([value])
+
+    def extend(self, values: Iterable[float]) -> None:
+        """Add a batch of values and recompress."""
+        values = np.asarray(values, dtype=np.float64)
+        if not len(values):
+            return
+        self.min = min(self.min, float(values.min()))
+        self.max = max(self.max, float(values.max()))
+        self._compress(np.concatenate([self.means, values]),
+                       np.concatenate([self.weights, np.ones(len(values))]))
+
+    def merge(self, other: "TDigest") -> "TDigest":
+        """Return a new digest of the union of both inputs."""
+        merged = TDigest(max(self.compression, other.compression))
+        merged.min = min(self.min, other.min)
+        merged.max = max(self.max, other.max)
+        merged._compress(np.concatenate([self.means, other.means]),
+                         np.concatenate([self.weights, other.weights]))
+        return merged
+
+    @classmethod
+    def merge_all(cls, digests) -> "TDigest":
+        """Merge many digests with a single compression pass."""
+        digests = [digest for digest in digests if len(digest)]
+        merged = cls(max((digest.compression for digest in digests), default=DEFAULT_COMPRESSION))
+        if digests:
+            merged.min = min(digest.min for digest in digests)
+            merged.max = max(digest.max for digest in digests)
+            merged._compress(np.concatenate([digest.means for digest in digests]),
+                             np.concatenate([digest.weights for digest in digests]))
+        return merged
+
+    def _compress(self, means: np.ndarray, weights: np.ndarray) -> None:
+        if not len(means):
+            self.means, self.weights = means, weights
+            return
+        order = np.argsort(means, kind="stable")
+        means = means[order]
+        weights = weights[order]
+
+        total = weights.sum()
+        q_mid = (np.cumsum(weights) - weights / 2) / total
+        k = self.compression / (2 * math.pi) * np.arcsin(np.clip(2 * q_mid - 1, -1, 1))
+        group = np.floor(k)
+        starts = np.flatnonzero(np.r_[True, group[1:] != group[:-1]])
+
+        self.weights = np.add.reduceat(weights, starts)
+        self.means = np.add.reduceat(weights * means, starts) / self.weights
+
+    def _knots(self):
+        """Interpolation points: (value, cumulative fraction) at each centroid center and the extremes."""
+        total = self.weights.sum()
+        q_mid = (np.cumsum(self.weights) - self.weights / 2) / total
+        xs = np.concatenate([[self.min], self.means, [self.max]])
+        qs = np.concatenate([[0.0], q_mid, [1.0]])
+        return xs, qs
+
+    def quantile(self, q):
+        """Estimated value at quantile(s) q in [0, 1]; None when empty."""
+        if not len(self.means):
+            return None
+        xs, qs = self._knots()
+        return np.interp(q, qs, xs)
+
+    def cdf(self, x):
+        """Estimated fraction of values at or below x."""
+        if not len(self.means):
+            return np.zeros_like(np.asarray(x, dtype=np.float64))
+        xs, qs = self._knots()
+        return np.interp(x, xs, qs)
+
+    def to_bytes(self) -> bytes:
+        return np.stack([self.means, self.weights]).astype("<f8").tobytes()
+
+    @classmethod
+    def from_bytes(cls, data: bytes, level_min: float, level_max: float,
+                   compression: float = DEFAULT_COMPRESSION) -> "TDigest":
+        digest = cls(compression)
+        centroids = np.frombuffer(data, dtype="<f8").reshape(2, -1)
+        digest.means = centroids[0].copy()
+        digest.weights = centroids[1].copy()
+        digest.min = level_min
+        digest.max = level_max
+        return digest
+
+
+@dataclass
+class QuantileSummary:
+    """Median, quartiles and the 5th/95th percentiles read from a digest."""
+
+    count: int
+    p5: float
+    q1: float
+    median: float
+    q3: float
+    p95: float
+
+    @property
+    def iqr(self) -> float:
+        return self.q3 - self.q1
+
+    @classmethod
+    def from_digest(cls, digest: TDigest) -> Optional["QuantileSummary"]:
+        if not len(digest):
+            return None
+        p5, q1, median, q3, p95 = (float(v) for v in digest.quantile([0.05, 0.25, 0.5, 0.75, 0.95]))
+        return cls(int(round(digest.count)), p5, q1, median, q3, p95)
+
+
+class QuantileSketches:
+    """Persisted t-digests per patient, test type and month.
+
+    An insert adds the level to its month's digest. A delete rebuilds that
+    month from its readings, since a t-digest cannot forget a value.
+    Queries merge the monthly digests in range, which costs time
+    proportional to the number of months, not readings.
+    """
+
+    def __init__(self, connection: sqlite3.Connection):
+        self.connection = connection
+
+    def create_tables(self) -> None:
+        """Create the sketch table and backfill it from existing readings."""
+        cursor = self.connection.cursor()
+        drop_unscoped(cursor, "reading_sketches")
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS reading_sketches (
+                patient_id INTEGER NOT NULL,
+                month_start TEXT NOT NULL,
+                test_type TEXT NOT NULL,
+                reading_count INTEGER NOT NULL,
+                level_min REAL NOT NULL,
+                level_max REAL NOT NULL,
+                centroids BLOB NOT NULL,
+                PRIMARY KEY (patient_id, month_start, test_type)
+            ) WITHOUT ROWID
+        """)
+
+        cursor.execute("SELECT EXISTS (SELECT 1 FROM reading_sketches)")
+        has_sketches = cursor.fetchone()[0]
+        cursor.execute("SELECT EXISTS (SELECT 1 FROM iron_readings)")
+        has_readings = cursor.fetchone()[0]
+        if has_readings and not has_sketches:
+            self.rebuild_all()
+
+    def load(self, patient_id: int, month_start: str, test_type: str) -> TDigest:
+        cursor = self.connection.cursor()
+        cursor.execute("""
+            SELECT level_min, level_max, centroids FROM reading_sketches
+            WHERE patient_id = ? AND month_start = ? AND test_type = ?
+        """, (patient_id, month_start, test_type))
+        row = cursor.fetchone()
+        if row is None:
+            return TDigest()
+        return TDigest.from_bytes(row[2], row[0], row[1])
+
+    def save(self, patient_id: int, month_start: str, test_type: str, digest: TDigest) -> None:
+        if not len(digest):
+            self.connection.execute("""
+                DELETE FROM reading_sketches
+                WHERE patient_id = ? AND month_start = ? AND test_type = ?
+            """, (patient_id, month_start, test_type))
+            return
+        self.connection.execute("""
+            INSERT OR REPLACE INTO reading_sketches (patient_id, month_start, test_type,
+                                                     reading_count, level_min, level_max,
+                                                     centroids)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        """, (patient_id, month_start, test_type, int(round(digest.count)), digest.min, digest.max,
+              digest.to_bytes()))
+
+    def add(self, patient_id: int, reading_date, iron_level: float, test_type: str) -> None:
+        """Add a new reading to its month's digest."""
+        month_start = as_date(reading_date).replace(day=1).isoformat()
+        digest = self.load(patient_id, month_start, test_type)
+        digest.add(iron_level)
+        self.save(patient_id, month_start, test_type, digest)
+
+    def rebuild_month(self, patient_id: int, reading_date, test_type: str) -> None:
+        """Rebuild the digest of the month containing a date, e.g. after a delete."""
+        start = as_date(reading_date).replace(day=1)
+        cursor = self.connection.cursor()
+        cursor.execute("""
+            SELECT iron_level FROM iron_readings
+            WHERE patient_id = ? AND test_type = ? AND reading_date >= ? AND reading_date < ?
+        """, (patient_id, test_type, start.isoformat(), bucket_end(start, "month").isoformat()))
+        digest = TDigest()
+        digest.extend([row[0] for row in cursor.fetchall()])
+        self.save(patient_id, start.isoformat(), test_type, digest)
+
+    def rebuild_all(self) -> None:
+        """Rebuild every digest from the readings table."""
+        cursor = self.connection.cursor()
+        cursor.execute("DELETE FROM reading_sketches")
+        cursor.execute("""
+            SELECT patient_id, strftime('%Y-%m-01', reading_date) AS month_start, test_type,
+                   iron_level
+            FROM iron_readings
+            ORDER BY patient_id, month_start, test_type
+        """)
+        rows = cursor.fetchall()
+        group_start = 0
+        for i in range(1, len(rows) + 1):
+            if i == len(rows) or tuple(rows[i][:3]) != tuple(rows[group_start][:3]):
+                digest = TDigest()
+                digest.extend([row[3] for row in rows[group_start:i]])
+                self.save(*rows[group_start][:3], digest)
+                group_start = i
+
+    def query(self, patient_id: int, start_date=None, end_date=None,
+              test_type: Optional[str] = None) -> TDigest:
+        """Merge the monthly digests overlapping [start_date, end_date], of one or all native test types."""
+        clauses = ["patient_id = ?"]
+        params = [patient_id]
+        if start_date is not None:
+            clauses.append("month_start >= ?")
+            params.append(as_date(start_date).replace(day=1).isoformat())
+        if end_date is not None:
+            clauses.append("month_start <= ?")
+            params.append(as_date(end_date).isoformat())
+        if test_type is not None:
+            clauses.append("test_type = ?")
+            params.append(test_type)
+        else:
+            clauses.append(native_sql())
+        cursor = self.connection.cursor()
+        cursor.execute(f"""
+            SELECT level_min, level_max, centroids FROM reading_sketches
+            WHERE {' AND '.join(clauses)}
+        """, params)
+
+        return TDigest.merge_all(
+            TDigest.from_bytes(row[2], row[0], row[1]) for row in cursor.fetchall()
+        )
@@ -0,0 +1,119 @@
+from dataclasses import dataclass, field
+from datetime import date, timedelta
+from typing import List, Optional, Sequence, Tuple
+
+
+# Default cap on rows returned for a filtered list
+DEFAULT_ROW_LIMIT = 1000
+
+
+def period_start(period: str, today: date = None) -> Optional[date]:
+    """Return the first date included by a named period filter ("all" has none)."""
+    today = today or date.today()
+    if period == "all":
+        return None
+    if period == "week":
+        return today - timedelta(days=7)
+    if period == "month":
+        return today.replace(day=1)
+    if period == "year":
+        return today.replace(month=1, day=1)
+    raise ValueError(f"Unknown period: {period}")
+
+
+@dataclass
+class ReadingFilter:
+    """Criteria for selecting readings, compiled into a single parameterized query.
+
+    Every reading index is led by patient_id, which DatabaseManager fills
+    in with the current patient. Date bounds are inclusive and hit the
+    (patient_id, reading_date, reading_time) index; test type selections hit
+    the (patient_id, test_type, reading_date, reading_time) index, level
+    class selections the (patient_id, level_class, reading_date,
+    reading_time) index and tag selections the reading_tags primary key.
+    """
+
+    patient_id: Optional[int] = None
+    start_date: Optional[date] = None
+    end_date: Optional[date] = None
+    min_level: Optional[float] = None
+    max_level: Optional[float] = None
+    test_types: Sequence[str] = field(default_factory=tuple)
+    level_classes: Sequence[str] = field(default_factory=tuple)  # "low", "normal", "high"
+    tags: Sequence[str] = field(default_factory=tuple)  # readings with any of these tags
+    limit: Optional[int] = DEFAULT_ROW_LIMIT
+    newest_first: bool = True
+
+    @classmethod
+    def for_period(cls, period: str, today: date = None, **kwargs) -> "ReadingFilter":
+        """Build a filter for one of the History screen's period buttons.
+
+        Period filters show every reading in the period, so they have no
+        row limit unless one is passed.
+        """
+        kwargs.setdefault('limit', None)
+        return cls(start_date=period_start(period, today), **kwargs)
+
+    def matches(self, reading) -> bool:
+        """Check a reading dict against the filter criteria, ignoring the row limit."""
+        reading_date = str(reading['reading_date'])
+        if self.patient_id is not None and reading.get('patient_id', self.patient_id) != self.patient_id:
+            return False
+        if self.start_date is not None and reading_date < str(self.start_date):
+            return False
+        if self.end_date is not None and reading_date > str(self.end_date):
+            return False
+        if self.min_level is not None and reading['iron_level'] < self.min_level:
+            return False
+        if self.max_level is not None and reading['iron_level'] > self.max_level:
+            return False
+        if self.test_types and reading['test_type'] not in self.test_types:
+            return False
+        if self.level_classes and reading.get('level_class') not in self.level_classes:
+            return False
+        if self.tags and set(self.tags).isdisjoint(reading.get('tags') or ()):
+            return False
+        return True
+
+    def to_sql(self, columns: str = "*") -> Tuple[str, List]:
+        """Compile the filter into a SELECT statement and its parameters."""
+        clauses = []
+        params = []
+
+        if self.patient_id is not None:
+            clauses.append("patient_id = ?")
+            params.append(self.patient_id)
+        if self.start_date is not None:
+            clauses.append("reading_date >= ?")
+            params.append(str(self.start_date))
+        if self.end_date is not None:
+            clauses.append("reading_date <= ?")
+            params.append(str(self.end_date))
+        if self.min_level is not None:
+            clauses.append("iron_level >= ?")
+            params.append(self.min_level)
+        if self.max_level is not None:
+            clauses.append("iron_level <= ?")
+            params.append(self.max_level)
+        if self.test_types:
+            clauses.append(f"test_type IN ({', '.join('?' for _ in self.test_types)})")
+            params.extend(self.test_types)
+        if self.level_classes:
+            clauses.append(f"level_class IN ({', '.join('?' for _ in self.level_classes)})")
+            params.extend(self.level_classes)
+        if self.tags:
+            clauses.append(
+                f"id IN (SELECT reading_id FROM reading_tags WHERE tag IN ({', '.join('?' for _ in self.tags)}))"
+            )
+            params.extend(self.tags)
+
+        direction = "DESC" if self.newest_first else "ASC"
+        query = f"SELECT {columns} FROM iron_readings"
+        if clauses:
+            query += " WHERE " + " AND ".join(clauses)
+        query += f" ORDER BY reading_date {direction}, reading_time {direction}"
+        if self.limit is not None:
+            query += " LIMIT ?"
+            params.append(self.limit)
+
+        return query, params
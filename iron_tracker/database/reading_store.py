@@ -0,0 +1,221 @@
+from datetime import date
+from typing import Dict, Iterable, List, Optional
+
+import numpy as np
+
+from database.reference_ranges import LEVEL_CLASSES, LEVEL_CLASS_CODES
+
+
+# Timestamps are float days since 1970-01-01, matching matplotlib's date numbers
+EPOCH_ORDINAL = date(1970, 1, 1).toordinal()
+
+_COLUMNS = (
+    ("ids", np.int64),
+    ("timestamps", np.float64),
+    ("levels", np.float64),
+    ("type_codes", np.int16),
+    ("note_codes", np.int32),
+    ("class_codes", np.int8),
+)
+
+
+class ReadingStore:
+    """Columnar in-memory copy of the iron_readings table.
+
+    Readings are kept oldest first in parallel NumPy columns (id, timestamp,
+    level, test-type code, note code, level-class code), about 30 bytes per
+    reading. Class codes index LEVEL_CLASSES. Test types
+    and notes are interned in small lookup tables, so repeated values are
+    stored once. Column properties return views, not copies.
+
+    DatabaseManager keeps the store in sync by calling add() and remove()
+    after each committed change.
+    """
+
+    def __init__(self):
+        self._size = 0
+        for name, dtype in _COLUMNS:
+            setattr(self, f"_{name}", np.empty(0, dtype=dtype))
+
+        self.test_types: List[str] = []
+        self._type_index: Dict[str, int] = {}
+        self.notes: List[str] = [""]
+        self._note_index: Dict[str, int] = {"": 0}
+
+    def __len__(self) -> int:
+        return self._size
+
+    @property
+    def ids(self) -> np.ndarray:
+        return self._ids[:self._size]
+
+    @property
+    def timestamps(self) -> np.ndarray:
+        return self._timestamps[:self._size]
+
+    @property
+    def levels(self) -> np.ndarray:
+        return self._levels[:self._size]
+
+    @property
+    def type_codes(self) -> np.ndarray:
+        return self._type_codes[:self._size]
+
+    @property
+    def note_codes(self) -> np.ndarray:
+        return self._note_codes[:self._size]
+
+    @property
+    def class_codes(self) -> np.ndarray:
+        return self._class_codes[:self._size]
+
+    @property
+    def nbytes(self) -> int:
+        """Memory used by the column data, excluding the interned tables."""
+        return sum(getattr(self, name).nbytes for name, _ in _COLUMNS)
+
+    def type_code(self, test_type: str) -> int:
+        """Get the code for a test type, interning it if it is new."""
+        code = self._type_index.get(test_type)
+        if code is None:
+            code = len(self.test_types)
+            self.test_types.append(test_type)
+            self._type_index[test_type] = code
+        return code
+
+    def note_code(self, note: Optional[str]) -> int:
+        """Get the code for a note, interning it if it is new."""
+        note = note or ""
+        code = self._note_index.get(note)
+        if code is None:
+            code = len(self.notes)
+            self.notes.append(note)
+            self._note_index[note] = code
+        return code
+
+    def load(self, rows: Iterable) -> None:
+        """Replace the contents with database rows.
+
+        Rows are (id, reading_date, reading_time, iron_level, test_type, notes, level_class).
+        """
+        rows = list(rows)
+        self.__init__()
+        if not rows:
+            return
+
+        ids, dates, times, levels, test_types, notes, classes = zip(*rows)
+        timestamps = series_timestamps(dates, times)
+
+        order = np.lexsort((np.asarray(ids), timestamps))
+        self._reserve(len(rows))
+        self._size = len(rows)
+        self._ids[:self._size] = np.asarray(ids, dtype=np.int64)[order]
+        self._timestamps[:self._size] = timestamps[order]
+        self._levels[:self._size] = np.asarray(levels, dtype=np.float64)[order]
+        self._type_codes[:self._size] = np.array([self.type_code(t) for t in test_types])[order]
+        self._note_codes[:self._size] = np.array([self.note_code(n) for n in notes])[order]
+        self._class_codes[:self._size] = np.array([class_code(c) for c in classes])[order]
+
+    def add(self, reading: Dict) -> int:
+        """Insert a reading dict in time order and return its position."""
+        timestamp = reading_timestamp(reading['reading_date'], reading['reading_time'])
+        position = int(np.searchsorted(self.timestamps, timestamp, "right"))
+
+        self._reserve(self._size + 1)
+        values = (
+            reading['id'], timestamp, reading['iron_level'],
+            self.type_code(reading.get('test_type') or ""), self.note_code(reading.get('notes')),
+            class_code(reading.get('level_class')),
+        )
+        for (name, _), value in zip(_COLUMNS, values):
+            column = getattr(self, f"_{name}")
+            # Shift later rows up by one; appends at the end move nothing
+            column[position + 1:self._size + 1] = column[position:self._size]
+            column[position] = value
+        self._size += 1
+        return position
+
+    def remove(self, reading_id: int) -> Optional[int]:
+        """Remove a reading by id and return the position it had, or None if absent."""
+        position = self.position(reading_id)
+        if position is None:
+            return None
+        for name, _ in _COLUMNS:
+            column = getattr(self, f"_{name}")
+            column[position:self._size - 1] = column[position + 1:self._size]
+        self._size -= 1
+        return position
+
+    def position(self, reading_id: int) -> Optional[int]:
+        """Find the position of a reading id."""
+        matches = np.flatnonzero(self.ids == reading_id)
+        return int(matches[0]) if len(matches) else None
+
+    def type_positions(self, test_type: str, positions: slice = slice(None)) -> np.ndarray:
+        """Positions of the readings of one test type, within a range of positions."""
+        code = self._type_index.get(test_type)
+        if code is None:
+            return np.empty(0, dtype=np.int64)
+        start = positions.start or 0
+        return start + np.flatnonzero(self.type_codes[positions] == code)
+
+    def between(self, start: float, end: float) -> slice:
+        """Positions of readings with timestamps in [start, end]."""
+        return slice(int(np.searchsorted(self.timestamps, start, "left")),
+                     int(np.searchsorted(self.timestamps, end, "right")))
+
+    def date_strings(self, positions=slice(None)) -> np.ndarray:
+        """ISO dates (YYYY-MM-DD) for the given positions."""
+        days = np.floor(self.timestamps[positions]).astype("datetime64[D]")
+        return np.datetime_as_string(days, unit="D")
+
+    def row(self, position: int) -> Dict:
+        """Materialize one reading as a dict shaped like a database row."""
+        timestamp = float(self._timestamps[position])
+        days = int(timestamp // 1)
+        minutes = int(round((timestamp - days) * 1440))
+        return {
+            'id': int(self._ids[position]),
+            'reading_date': date.fromordinal(EPOCH_ORDINAL + days).isoformat(),
+            'reading_time': f"{minutes // 60:02d}:{minutes % 60:02d}",
+            'iron_level': float(self._levels[position]),
+            'notes': self.notes[self._note_codes[position]],
+            'test_type': self.test_types[self._type_codes[position]],
+            'level_class': LEVEL_CLASSES[self._class_codes[position]],
+        }
+
+    def _reserve(self, capacity: int) -> None:
+        """Grow the columns geometrically so appends stay amortized O(1)."""
+        if capacity <= len(self._ids):
+            return
+        new_capacity = max(capacity, 2 * len(self._ids), 64)
+        for name, dtype in _COLUMNS:
+            old = getattr(self, f"_{name}")
+            grown = np.empty(new_capacity, dtype=dtype)
+            grown[:self._size] = old[:self._size]
+            setattr(self, f"_{name}", grown)
+
+
+def class_code(level_class: Optional[str]) -> int:
+    """Code of a level class; unclassified readings count as normal."""
+    return LEVEL_CLASS_CODES.get(level_class, LEVEL_CLASS_CODES["normal"])
+
+
+def _minutes(reading_time) -> int:
+    """Minutes since midnight for an HH:MM time string."""
+    reading_time = str(reading_time or "00:00")
+    return int(reading_time[:2]) * 60 + int(reading_time[3:5])
+
+
+def reading_timestamp(reading_date, reading_time="00:00") -> float:
+    """Float days since the epoch for a reading's date and HH:MM time."""
+    if not isinstance(reading_date, date):
+        reading_date = date.fromisoformat(str(reading_date)[:10])
+    return reading_date.toordinal() - EPOCH_ORDINAL + _minutes(reading_time) / 1440.0
+
+
+def series_timestamps(dates: Iterable, times: Iterable) -> np.ndarray:
+    """Vectorized reading_timestamp for parallel sequences of dates and times."""
+    days = np.array([str(d)[:10] for d in dates], dtype="datetime64[D]").astype(np.float64)
+    minutes = np.array([_minutes(t) for t in times], dtype=np.float64)
+    return days + minutes / 1440.0
@@ -0,0 +1,205 @@
+import bisect
+import sqlite3
+from typing import Dict, List, Optional, Tuple
+
+from database.derived import DERIVED_BY_TYPE
+
+
+# Classes precomputed into iron_readings.level_class; ReadingStore keeps
+# their position in this tuple as a small integer code
+LEVEL_CLASSES = ("low", "normal", "high")
+LEVEL_CLASS_CODES = {level_class: code for code, level_class in enumerate(LEVEL_CLASSES)}
+
+DEFAULT_TEST_TYPE = "Serum Iron"
+# Age used for the lookup when the profile has none
+DEFAULT_AGE = 30
+# Sex key of ranges that apply regardless of sex; the "other" gender uses these
+ANY_SEX = "any"
+# Range every profile starts with; test types without a reference range use
+# the profile's range
+DEFAULT_PROFILE_RANGE = (60, 170)
+# Test type the profile's own range is for; a range set explicitly in the
+# profile (range_override) replaces the table's for it
+PROFILE_RANGE_TEST_TYPE = DEFAULT_TEST_TYPE
+
+# (test_type, sex, age_min, age_max, normal_min, normal_max); ages are in
+# years, age_max is exclusive and None means no upper bound
+DEFAULT_REFERENCE_RANGES = [
+    ("Serum Iron", ANY_SEX, 0, 18, 50, 120),
+    ("Serum Iron", "male", 18, None, 65, 175),
+    ("Serum Iron", "female", 18, None, 50, 170),
+    ("Serum Iron", ANY_SEX, 18, None, 50, 175),
+    ("Transferrin Saturation", "male", 18, None, 20, 50),
+    ("Transferrin Saturation", "female", 18, None, 15, 50),
+    ("Transferrin Saturation", ANY_SEX, 0, None, 15, 50),
+    ("Ferritin", ANY_SEX, 0, 18, 7, 140),
+    ("Ferritin", "male", 18, None, 24, 336),
+    ("Ferritin", "female", 18, None, 11, 307),
+    ("Ferritin", ANY_SEX, 18, None, 11, 336),
+    ("TIBC (Total Iron Binding Capacity)", ANY_SEX, 0, None, 250, 450),
+    ("UIBC (Unsaturated Iron Binding Capacity)", ANY_SEX, 0, None, 111, 343),
+]
+
+
+def classify_level(level: float, normal_min: float, normal_max: float) -> str:
+    """Classify a level against the normal range."""
+    if level < normal_min:
+        return "low"
+    if level > normal_max:
+        return "high"
+    return "normal"
+
+
+def profile_range(profile: Dict) -> Tuple[float, float]:
+    """The (normal_min, normal_max) stored in a profile."""
+    return (profile.get('normal_range_min') or DEFAULT_PROFILE_RANGE[0],
+            profile.get('normal_range_max') or DEFAULT_PROFILE_RANGE[1])
+
+
+def overrides_table(profile: Dict) -> bool:
+    """Whether a profile's own range replaces the reference table's.
+
+    Profiles from before range_override count as overriding when their range
+    was changed from the default, since that range classified their readings.
+    """
+    if 'range_override' in profile:
+        return bool(profile['range_override'])
+    return bool(profile) and profile_range(profile) != DEFAULT_PROFILE_RANGE
+
+
+def resolve_range(index: "ReferenceRangeIndex", test_type: str,
+                  profile: Optional[Dict]) -> Tuple[float, float]:
+    """Normal range of a test type for a patient's profile.
+
+    A range set in the profile wins for PROFILE_RANGE_TEST_TYPE, then the
+    reference table applies, then the profile's range as the fallback.
+    """
+    profile = profile or {}
+    # Derived test types share the ranges of the native test they estimate
+    metric = DERIVED_BY_TYPE.get(test_type)
+    if metric is not None and metric.range_test_type:
+        test_type = metric.range_test_type
+    if test_type == PROFILE_RANGE_TEST_TYPE and overrides_table(profile):
+        return profile_range(profile)
+    return index.lookup(test_type, profile.get('gender'), profile.get('age')) or profile_range(profile)
+
+
+class ReferenceRangeIndex:
+    """In-memory interval lookup of reference ranges.
+
+    Ranges are grouped by (test_type, sex) and sorted by age_min. A lookup
+    bisects the age into its group, then falls back to the sex-independent
+    ranges.
+    """
+
+    def __init__(self, rows):
+        self.starts: Dict[Tuple[str, str], List[float]] = {}
+        self.ranges: Dict[Tuple[str, str], List[Tuple]] = {}
+        for test_type, sex, age_min, age_max, normal_min, normal_max in sorted(
+            rows, key=lambda row: (row[0], row[1], row[2])
+        ):
+            key = (test_type, sex)
+            self.starts.setdefault(key, []).append(age_min)
+            self.ranges.setdefault(key, []).append((age_max, normal_min, normal_max))
+
+    def lookup(self, test_type: str, sex: Optional[str], age: Optional[float]) -> Optional[Tuple[float, float]]:
+        """Return (normal_min, normal_max) for a test type, sex and age, or None if none applies."""
+        age = DEFAULT_AGE if age is None else age
+        for key in ((test_type, sex), (test_type, ANY_SEX)):
+            starts = self.starts.get(key)
+            if not starts:
+                continue
+            i = bisect.bisect_right(starts, age) - 1
+            if i < 0:
+                continue
+            age_max, normal_min, normal_max = self.ranges[key][i]
+            if age_max is None or age < age_max:
+                return normal_min, normal_max
+        return None
+
+
+class ReferenceRanges:
+    """Reference ranges per test type, sex and age interval.
+
+    The table is seeded with typical adult and pediatric ranges and can be
+    edited with set_range. Lookups go through a ReferenceRangeIndex that is
+    rebuilt after each edit.
+    """
+
+    def __init__(self, connection: sqlite3.Connection):
+        self.connection = connection
+        self.index = None
+
+    def create_tables(self) -> None:
+        """Create the reference range table and seed it with the defaults."""
+        cursor = self.connection.cursor()
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS reference_ranges (
+                test_type TEXT NOT NULL,
+                sex TEXT NOT NULL CHECK(sex IN ('male', 'female', 'any')),
+                age_min REAL NOT NULL DEFAULT 0,
+                age_max REAL,
+                normal_min REAL NOT NULL,
+                normal_max REAL NOT NULL,
+                PRIMARY KEY (test_type, sex, age_min)
+            ) WITHOUT ROWID
+        """)
+
+        cursor.execute("SELECT EXISTS (SELECT 1 FROM reference_ranges)")
+        if not cursor.fetchone()[0]:
+            cursor.executemany("""
+                INSERT INTO reference_ranges (test_type, sex, age_min, age_max,
+                                              normal_min, normal_max)
+                VALUES (?, ?, ?, ?, ?, ?)
+            """, DEFAULT_REFERENCE_RANGES)
+        self.index = None
+
+    def get_index(self) -> ReferenceRangeIndex:
+        if self.index is None:
+            cursor = self.connection.cursor()
+            cursor.execute("""
+                SELECT test_type, sex, age_min, age_max, normal_min, normal_max
+                FROM reference_ranges
+            """)
+            self.index = ReferenceRangeIndex(tuple(row) for row in cursor.fetchall())
+        return self.index
+
+    def resolve(self, test_type: str, profile: Optional[Dict]) -> Tuple[float, float]:
+        """Normal range of a test type for a patient's profile, see resolve_range."""
+        return resolve_range(self.get_index(), test_type, profile)
+
+    def set_range(self, test_type: str, sex: str, age_min: float, age_max: Optional[float],
+                  normal_min: float, normal_max: float) -> None:
+        """Add or replace the range starting at age_min for a test type and sex."""
+        self.connection.execute("""
+            INSERT OR REPLACE INTO reference_ranges (test_type, sex, age_min, age_max,
+                                                    normal_min, normal_max)
+            VALUES (?, ?, ?, ?, ?, ?)
+        """, (test_type, sex, age_min, age_max, normal_min, normal_max))
+        self.index = None
+
+    def all_ranges(self) -> List[Dict]:
+        cursor = self.connection.cursor()
+        cursor.execute("""
+            SELECT test_type, sex, age_min, age_max, normal_min, normal_max
+            FROM reference_ranges
+            ORDER BY test_type, sex, age_min
+        """)
+        return [dict(row) for row in cursor.fetchall()]
+
+    def classify_all(self, patient_id: int, profile: Optional[Dict]) -> None:
+        """Recompute level_class for every reading of a patient, one indexed UPDATE per test type."""
+        cursor = self.connection.cursor()
+        cursor.execute("SELECT DISTINCT test_type FROM iron_readings WHERE patient_id = ?",
+                       (patient_id,))
+        for (test_type,) in cursor.fetchall():
+            normal_min, normal_max = self.resolve(test_type, profile)
+            cursor.execute("""
+                UPDATE iron_readings
+                SET level_class = CASE
+                    WHEN iron_level < ? THEN 'low'
+                    WHEN iron_level > ? THEN 'high'
+                    ELSE 'normal'
+                END
+                WHERE patient_id = ? AND test_type IS ?
+            """, (normal_min, normal_max, patient_id, test_type))
@@ -0,0 +1,247 @@
+import sqlite3
+from datetime import date, datetime, timedelta
+from itertools import groupby
+from typing import List, Dict, Optional, Tuple
+
+from database.derived import native_sql
+from database.patients import drop_unscoped, has_column
+
+
+# Pyramid levels from finest to coarsest, with their approximate width in days
+RESOLUTIONS = ("day", "week", "month", "quarter")
+BUCKET_DAYS = {"day": 1.0, "week": 7.0, "month": 30.44, "quarter": 91.31}
+
+# SQL expressions mapping reading_date to the start of its bucket
+BUCKET_SQL = {
+    "day": "reading_date",
+    "week": "date(reading_date, '-6 days', 'weekday 1')",
+    "month": "strftime('%Y-%m-01', reading_date)",
+    "quarter": (
+        "printf('%s-%02d-01', strftime('%Y', reading_date), "
+        "((CAST(strftime('%m', reading_date) AS INTEGER) - 1) / 3) * 3 + 1)"
+    ),
+}
+
+
+def as_date(value) -> date:
+    """Convert a stored reading date (date or ISO string) to a date."""
+    if isinstance(value, datetime):
+        return value.date()
+    if isinstance(value, date):
+        return value
+    return date.fromisoformat(str(value)[:10])
+
+
+def bucket_start(day: date, resolution: str) -> date:
+    """Return the first day of the bucket containing the given day."""
+    if resolution == "day":
+        return day
+    if resolution == "week":
+        return day - timedelta(days=day.weekday())
+    if resolution == "month":
+        return day.replace(day=1)
+    if resolution == "quarter":
+        return day.replace(month=(day.month - 1) // 3 * 3 + 1, day=1)
+    raise ValueError(f"Unknown resolution: {resolution}")
+
+
+def bucket_end(start: date, resolution: str) -> date:
+    """Return the first day after the bucket starting at the given day."""
+    if resolution == "day":
+        return start + timedelta(days=1)
+    if resolution == "week":
+        return start + timedelta(days=7)
+    months = 1 if resolution == "month" else 3
+    month_index = start.month - 1 + months
+    return start.replace(year=start.year + month_index // 12, month=month_index % 12 + 1, day=1)
+
+
+def choose_resolution(start: date, end: date, max_points: int = 400) -> str:
+    """Pick the finest resolution that keeps a date range under max_points buckets."""
+    span_days = max((end - start).days, 1)
+    for resolution in RESOLUTIONS:
+        if span_days / BUCKET_DAYS[resolution] <= max_points:
+            return resolution
+    return RESOLUTIONS[-1]
+
+
+class RollupPyramid:
+    """Precomputed min/max/mean aggregates of iron readings at several time resolutions.
+
+    Every reading contributes to one bucket per patient, resolution and test type. Inserts
+    update the affected buckets in place; deletes rebuild only the buckets that
+    contained the removed reading. Buckets keep a Welford mean and m2 like
+    reading_stats, so their variance needs no subtraction of large sums.
+    """
+
+    def __init__(self, connection: sqlite3.Connection):
+        self.connection = connection
+
+    def create_tables(self) -> None:
+        """Create the rollup table and backfill it from existing readings."""
+        cursor = self.connection.cursor()
+        drop_unscoped(cursor, "reading_rollups")
+        # Buckets from before the Welford columns held raw sums; rebuild them
+        cursor.execute("SELECT EXISTS (SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?)",
+                       ("reading_rollups",))
+        if cursor.fetchone()[0] and not has_column(cursor, "reading_rollups", "m2"):
+            cursor.execute("DROP TABLE reading_rollups")
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS reading_rollups (
+                patient_id INTEGER NOT NULL,
+                resolution TEXT NOT NULL,
+                bucket_start DATE NOT NULL,
+                test_type TEXT NOT NULL,
+                reading_count INTEGER NOT NULL,
+                mean REAL NOT NULL,
+                m2 REAL NOT NULL,
+                level_min REAL NOT NULL,
+                level_max REAL NOT NULL,
+                PRIMARY KEY (patient_id, resolution, bucket_start, test_type)
+            ) WITHOUT ROWID
+        """)
+
+        cursor.execute("SELECT EXISTS (SELECT 1 FROM reading_rollups)")
+        has_rollups = cursor.fetchone()[0]
+        cursor.execute("SELECT EXISTS (SELECT 1 FROM iron_readings)")
+        has_readings = cursor.fetchone()[0]
+        if has_readings and not has_rollups:
+            self.rebuild_all()
+
+    def add(self, patient_id: int, reading_date, iron_level: float, test_type: str) -> None:
+        """Fold a single new reading into every resolution of the pyramid."""
+        day = as_date(reading_date)
+        rows = [
+            (patient_id, resolution, bucket_start(day, resolution).isoformat(), test_type,
+             iron_level, iron_level, iron_level)
+            for resolution in RESOLUTIONS
+        ]
+        # SET expressions see the old row, so this is one Welford step per bucket
+        self.connection.executemany("""
+            INSERT INTO reading_rollups (patient_id, resolution, bucket_start, test_type,
+                                         reading_count, mean, m2, level_min, level_max)
+            VALUES (?, ?, ?, ?, 1, ?, 0, ?, ?)
+            ON CONFLICT (patient_id, resolution, bucket_start, test_type) DO UPDATE SET
+                reading_count = reading_count + 1,
+                mean = mean + (excluded.mean - mean) / (reading_count + 1),
+                m2 = m2 + (excluded.mean - mean)
+                        * (excluded.mean - (mean + (excluded.mean - mean) / (reading_count + 1))),
+                level_min = MIN(level_min, excluded.level_min),
+                level_max = MAX(level_max, excluded.level_max)
+        """, rows)
+
+    def rebuild_buckets(self, patient_id: int, reading_date, test_type: str) -> None:
+        """Recompute the buckets containing a date with a two-pass variance, e.g. after a delete."""
+        day = as_date(reading_date)
+        cursor = self.connection.cursor()
+        for resolution in RESOLUTIONS:
+            start = bucket_start(day, resolution)
+            end = bucket_end(start, resolution)
+            cursor.execute("""
+                DELETE FROM reading_rollups
+                WHERE patient_id = ? AND resolution = ? AND bucket_start = ? AND test_type = ?
+            """, (patient_id, resolution, start.isoformat(), test_type))
+            cursor.execute("""
+                WITH bucket AS (
+                    SELECT iron_level FROM iron_readings
+                    WHERE patient_id = :patient_id AND test_type = :test_type
+                      AND reading_date >= :start AND reading_date < :end
+                )
+                INSERT INTO reading_rollups (patient_id, resolution, bucket_start, test_type,
+                                             reading_count, mean, m2, level_min, level_max)
+                SELECT :patient_id, :resolution, :start, :test_type, COUNT(*), g.mean,
+                       SUM((b.iron_level - g.mean) * (b.iron_level - g.mean)),
+                       MIN(b.iron_level), MAX(b.iron_level)
+                FROM bucket b, (SELECT AVG(iron_level) AS mean FROM bucket) g
+                HAVING COUNT(*) > 0
+            """, {'patient_id': patient_id, 'resolution': resolution, 'test_type': test_type,
+                  'start': start.isoformat(), 'end': end.isoformat()})
+
+    def rebuild_all(self) -> None:
+        """Recompute the whole pyramid from the readings table with a two-pass variance."""
+        cursor = self.connection.cursor()
+        cursor.execute("DELETE FROM reading_rollups")
+        for resolution in RESOLUTIONS:
+            bucket_sql = BUCKET_SQL[resolution]
+            cursor.execute(f"""
+                WITH groups AS (
+                    SELECT patient_id, {bucket_sql} AS bucket_start, test_type,
+                           COUNT(*) AS reading_count, AVG(iron_level) AS mean,
+                           MIN(iron_level) AS level_min, MAX(iron_level) AS level_max
+                    FROM iron_readings
+                    GROUP BY patient_id, 2, test_type
+                )
+                INSERT INTO reading_rollups (patient_id, resolution, bucket_start, test_type,
+                                             reading_count, mean, m2, level_min, level_max)
+                SELECT g.patient_id, ?, g.bucket_start, g.test_type, g.reading_count, g.mean,
+                       SUM((r.iron_level - g.mean) * (r.iron_level - g.mean)),
+                       g.level_min, g.level_max
+                FROM groups g
+                JOIN iron_readings r
+                    ON r.patient_id = g.patient_id AND r.test_type = g.test_type
+                   AND {bucket_sql.replace('reading_date', 'r.reading_date')} = g.bucket_start
+                GROUP BY g.patient_id, g.bucket_start, g.test_type
+            """, (resolution,))
+
+    def date_bounds(self, patient_id: int,
+                    test_type: str = None) -> Tuple[Optional[date], Optional[date]]:
+        """Return the first and last day that has any native reading, optionally of one test type."""
+        clause = f"AND {native_sql()}"
+        params = [patient_id]
+        if test_type is not None:
+            clause = "AND test_type = ?"
+            params.append(test_type)
+        cursor = self.connection.cursor()
+        cursor.execute(f"""
+            SELECT MIN(bucket_start), MAX(bucket_start) FROM reading_rollups
+            WHERE patient_id = ? AND resolution = 'day' {clause}
+        """, params)
+        first, last = cursor.fetchone()
+        if first is None:
+            return None, None
+        return as_date(first), as_date(last)
+
+    def query(self, patient_id: int, resolution: str, start, end,
+              test_type: str = None) -> List[Dict]:
+        """Get aggregates for buckets overlapping [start, end], merged across native test types.
+
+        start and end may be dates or ISO date strings. Test types are merged
+        with the parallel Welford formula; variance is the population
+        variance, as RunningStats.variance() gives by default.
+        """
+        # running_stats builds on this module's date helpers
+        from database.running_stats import RunningStats
+
+        if resolution not in RESOLUTIONS:
+            raise ValueError(f"Unknown resolution: {resolution}")
+
+        params = [patient_id, resolution, bucket_start(as_date(start), resolution).isoformat(),
+                  as_date(end).isoformat()]
+        test_type_clause = f"AND {native_sql()}"
+        if test_type is not None:
+            test_type_clause = "AND test_type = ?"
+            params.append(test_type)
+
+        cursor = self.connection.cursor()
+        cursor.execute(f"""
+            SELECT bucket_start, reading_count, mean, m2, level_min, level_max
+            FROM reading_rollups
+            WHERE patient_id = ? AND resolution = ? AND bucket_start BETWEEN ? AND ? {test_type_clause}
+            ORDER BY bucket_start ASC
+        """, params)
+
+        buckets = []
+        for start_key, rows in groupby(cursor.fetchall(), key=lambda row: row['bucket_start']):
+            stats = RunningStats()
+            for row in rows:
+                stats = stats.merge(RunningStats(row['reading_count'], row['mean'], row['m2'],
+                                                 row['level_min'], row['level_max']))
+            buckets.append({
+                'bucket_start': start_key,
+                'reading_count': stats.count,
+                'mean_level': stats.mean,
+                'min_level': stats.min,
+                'max_level': stats.max,
+                'variance': stats.variance(),
+            })
+        return buckets
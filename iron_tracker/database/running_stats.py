@@ -0,0 +1,237 @@
+import math
+import sqlite3
+from dataclasses import dataclass
+from typing import Dict, List, Optional
+
+from database.derived import native_sql
+from database.patients import drop_unscoped
+from database.rollups import as_date, bucket_end
+
+
+# Periods with their own accumulators; "all" covers the whole history
+STAT_PERIODS = ("all", "year", "month")
+
+
+def period_key(reading_date, period: str) -> str:
+    """Key of the accumulator a reading falls into for a period."""
+    if period == "all":
+        return ""
+    day = as_date(reading_date)
+    if period == "year":
+        return day.replace(month=1, day=1).isoformat()
+    if period == "month":
+        return day.replace(day=1).isoformat()
+    raise ValueError(f"Unknown period: {period}")
+
+
+# SQL expressions equivalent to period_key
+PERIOD_SQL = {
+    "all": "''",
+    "year": "strftime('%Y-01-01', reading_date)",
+    "month": "strftime('%Y-%m-01', reading_date)",
+}
+
+
+@dataclass
+class RunningStats:
+    """Welford accumulator: count, mean and sum of squared deviations, plus extremes."""
+
+    count: int = 0
+    mean: float = 0.0
+    m2: float = 0.0
+    min: Optional[float] = None
+    max: Optional[float] = None
+
+    def variance(self, ddof: int = 0) -> float:
+        """Population variance by default; ddof=1 gives the sample variance."""
+        if self.count <= ddof:
+            return 0.0
+        return max(self.m2, 0.0) / (self.count - ddof)
+
+    def std(self, ddof: int = 0) -> float:
+        return math.sqrt(self.variance(ddof))
+
+    def merge(self, other: "RunningStats") -> "RunningStats":
+        """Combine two disjoint accumulators (Chan et al.)."""
+        if not other.count:
+            return self
+        if not self.count:
+            return RunningStats(other.count, other.mean, other.m2, other.min, other.max)
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        return RunningStats(
+            count,
+            self.mean + delta * other.count / count,
+            self.m2 + other.m2 + delta * delta * self.count * other.count / count,
+            min(self.min, other.min),
+            max(self.max, other.max),
+        )
+
+
+class RunningStatsStore:
+    """Persisted Welford accumulators per patient and test type for the whole history, each year and each month.
+
+    Inserts update them in place. Deletes subtract the reading. Only when
+    the deleted level was the minimum or maximum is that extreme re-read,
+    through the (patient_id, test_type, reading_date, reading_time) index.
+    """
+
+    def __init__(self, connection: sqlite3.Connection):
+        self.connection = connection
+
+    def create_tables(self) -> None:
+        """Create the accumulator table and backfill it from existing readings."""
+        cursor = self.connection.cursor()
+        drop_unscoped(cursor, "reading_stats")
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS reading_stats (
+                patient_id INTEGER NOT NULL,
+                period TEXT NOT NULL,
+                period_start TEXT NOT NULL,
+                test_type TEXT NOT NULL,
+                reading_count INTEGER NOT NULL,
+                mean REAL NOT NULL,
+                m2 REAL NOT NULL,
+                level_min REAL NOT NULL,
+                level_max REAL NOT NULL,
+                PRIMARY KEY (patient_id, period, period_start, test_type)
+            ) WITHOUT ROWID
+        """)
+
+        cursor.execute("SELECT EXISTS (SELECT 1 FROM reading_stats)")
+        has_stats = cursor.fetchone()[0]
+        cursor.execute("SELECT EXISTS (SELECT 1 FROM iron_readings)")
+        has_readings = cursor.fetchone()[0]
+        if has_readings and not has_stats:
+            self.rebuild_all()
+
+    def add(self, patient_id: int, reading_date, iron_level: float, test_type: str) -> None:
+        """Fold a new reading into its accumulators."""
+        rows = [
+            (patient_id, period, period_key(reading_date, period), test_type, iron_level, iron_level, iron_level)
+            for period in STAT_PERIODS
+        ]
+        # SET expressions see the old row, so this is one Welford step per accumulator
+        self.connection.executemany("""
+            INSERT INTO reading_stats (patient_id, period, period_start, test_type,
+                                       reading_count, mean, m2, level_min, level_max)
+            VALUES (?, ?, ?, ?, 1, ?, 0, ?, ?)
+            ON CONFLICT (patient_id, period, period_start, test_type) DO UPDATE SET
+                reading_count = reading_count + 1,
+                mean = mean + (excluded.mean - mean) / (reading_count + 1),
+                m2 = m2 + (excluded.mean - mean)
+                        * (excluded.mean - (mean + (excluded.mean - mean) / (reading_count + 1))),
+                level_min = MIN(level_min, excluded.level_min),
+                level_max = MAX(level_max, excluded.level_max)
+        """, rows)
+
+    def remove(self, patient_id: int, reading_date, iron_level: float, test_type: str) -> None:
+        """Subtract a deleted reading from its accumulators."""
+        cursor = self.connection.cursor()
+        for period in STAT_PERIODS:
+            key = period_key(reading_date, period)
+            cursor.execute("""
+                SELECT reading_count, mean, m2, level_min, level_max FROM reading_stats
+                WHERE patient_id = ? AND period = ? AND period_start = ? AND test_type = ?
+            """, (patient_id, period, key, test_type))
+            row = cursor.fetchone()
+            if row is None:
+                continue
+
+            count, mean, m2, level_min, level_max = row
+            if count <= 1:
+                cursor.execute("""
+                    DELETE FROM reading_stats
+                    WHERE patient_id = ? AND period = ? AND period_start = ? AND test_type = ?
+                """, (patient_id, period, key, test_type))
+                continue
+
+            new_mean = (count * mean - iron_level) / (count - 1)
+            m2 = max(m2 - (iron_level - new_mean) * (iron_level - mean), 0.0)
+            if iron_level <= level_min or iron_level >= level_max:
+                level_min, level_max = self._extremes(patient_id, period, key, test_type)
+            cursor.execute("""
+                UPDATE reading_stats
+                SET reading_count = ?, mean = ?, m2 = ?, level_min = ?, level_max = ?
+                WHERE patient_id = ? AND period = ? AND period_start = ? AND test_type = ?
+            """, (count - 1, new_mean, m2, level_min, level_max, patient_id, period, key, test_type))
+
+    def _extremes(self, patient_id: int, period: str, key: str, test_type: str):
+        """Re-read min and max of the readings behind one accumulator."""
+        clause = ""
+        params = [patient_id, test_type]
+        if period != "all":
+            start = as_date(key)
+            end = start.replace(year=start.year + 1) if period == "year" else bucket_end(start, "month")
+            clause = "AND reading_date >= ? AND reading_date < ?"
+            params.extend([start.isoformat(), end.isoformat()])
+        cursor = self.connection.cursor()
+        cursor.execute(f"""
+            SELECT MIN(iron_level), MAX(iron_level) FROM iron_readings
+            WHERE patient_id = ? AND test_type = ? {clause}
+        """, params)
+        return cursor.fetchone()
+
+    def rebuild_all(self) -> None:
+        """Recompute every accumulator from the readings table with a two-pass variance."""
+        cursor = self.connection.cursor()
+        cursor.execute("DELETE FROM reading_stats")
+        for period in STAT_PERIODS:
+            key_sql = PERIOD_SQL[period]
+            cursor.execute(f"""
+                WITH groups AS (
+                    SELECT patient_id, {key_sql} AS period_start, test_type,
+                           COUNT(*) AS reading_count, AVG(iron_level) AS mean,
+                           MIN(iron_level) AS level_min, MAX(iron_level) AS level_max
+                    FROM iron_readings
+                    GROUP BY patient_id, 2, test_type
+                )
+                INSERT INTO reading_stats (patient_id, period, period_start, test_type,
+                                           reading_count, mean, m2, level_min, level_max)
+                SELECT g.patient_id, ?, g.period_start, g.test_type, g.reading_count, g.mean,
+                       SUM((r.iron_level - g.mean) * (r.iron_level - g.mean)),
+                       g.level_min, g.level_max
+                FROM groups g
+                JOIN iron_readings r
+                    ON r.patient_id = g.patient_id AND r.test_type = g.test_type
+                   AND {key_sql.replace('reading_date', 'r.reading_date')} = g.period_start
+                GROUP BY g.patient_id, g.period_start, g.test_type
+            """, (period,))
+
+    def query(self, patient_id: int, period: str = "all", start_date=None, end_date=None,
+              test_type: str = None) -> Dict[str, RunningStats]:
+        """Accumulators per period start, merged across native test types unless one is given."""
+        if period not in STAT_PERIODS:
+            raise ValueError(f"Unknown period: {period}")
+
+        clauses = ["patient_id = ?", "period = ?"]
+        params = [patient_id, period]
+        if start_date is not None and period != "all":
+            clauses.append("period_start >= ?")
+            params.append(period_key(start_date, period))
+        if end_date is not None and period != "all":
+            clauses.append("period_start <= ?")
+            params.append(period_key(end_date, period))
+        if test_type is not None:
+            clauses.append("test_type = ?")
+            params.append(test_type)
+        else:
+            clauses.append(native_sql())
+
+        cursor = self.connection.cursor()
+        cursor.execute(f"""
+            SELECT period_start, reading_count, mean, m2, level_min, level_max
+            FROM reading_stats
+            WHERE {' AND '.join(clauses)}
+            ORDER BY period_start
+        """, params)
+
+        merged: Dict[str, RunningStats] = {}
+        for period_start, count, mean, m2, level_min, level_max in cursor.fetchall():
+            stats = RunningStats(count, mean, m2, level_min, level_max)
+            merged[period_start] = merged.get(period_start, RunningStats()).merge(stats)
+        return merged
+
+    def total(self, patient_id: int, test_type: str = None) -> RunningStats:
+        """Whole-history accumulator, for one test type or all native ones."""
+        return self.query(patient_id, "all", test_type=test_type).get("", RunningStats())
@@ -0,0 +1,220 @@
+"""Delta sync of one patient's readings between two iron tracker databases.
+
+The client POSTs a batch of its change_log entries after the last seq the
+server acknowledged, together with the last server seq it has applied.
+The server applies the batch, then answers with its own changes after
+that seq. Both bodies are zlib-compressed JSON. Changes carry the
+reading's sync_id and fields, and applying them is idempotent, so a lost
+response only means the same batch is sent again. Each round trip moves
+at most batch_size changes each way, and the client loops until neither
+side has more.
+
+Applied changes are logged with the peer they came from as their origin,
+and neither side sends a peer the entries that came from it: the server
+knows the client by a random client_id kept in sync_peers, the client
+knows the server by its URL.
+
+The server keeps one database per patient key (the last part of the URL),
+whose default patient is the one synced. When both sides changed the same
+reading, the side that syncs last wins.
+"""
+import json
+import os
+import re
+import sqlite3
+import urllib.error
+import urllib.request
+import zlib
+from dataclasses import dataclass
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from typing import Dict, List, Optional
+
+from database.db_manager import DatabaseManager
+
+
+SYNC_BATCH_SIZE = 500
+PROTOCOL_VERSION = 1
+# Patient keys name database files on the server
+PATIENT_KEY_PATTERN = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
+
+
+def encode_payload(payload: Dict) -> bytes:
+    return zlib.compress(json.dumps(payload, separators=(",", ":")).encode("utf-8"))
+
+
+def decode_payload(data: bytes) -> Dict:
+    return json.loads(zlib.decompress(data).decode("utf-8"))
+
+
+def unseen_changes(changes: List[Dict], peer: Optional[str]) -> List[Dict]:
+    """Logged changes to send to a peer: all but the ones received from it, without their origin."""
+    return [{key: value for key, value in change.items() if key != 'origin'}
+            for change in changes if peer is None or change['origin'] != peer]
+
+
+def sync_response(db_manager: DatabaseManager, request: Dict) -> Dict:
+    """Apply a client's batch to the current patient and return the changes the client lacks."""
+    if request.get('version') != PROTOCOL_VERSION:
+        raise ValueError(f"unsupported protocol version: {request.get('version')}")
+    # Clients from before client ids are only spared the batch they sent
+    peer = request.get('client_id')
+    if db_manager.apply_changes(request['changes'], origin=peer) is None:
+        raise sqlite3.DatabaseError("could not apply changes")
+
+    limit = min(int(request.get('limit', SYNC_BATCH_SIZE)), SYNC_BATCH_SIZE)
+    changes = db_manager.get_changes_since(int(request['since']), limit + 1)
+    more = len(changes) > limit
+    changes = changes[:limit]
+    pushed = {change['sync_id'] for change in request['changes']}
+    return {
+        'version': PROTOCOL_VERSION,
+        'acked': request['through'],
+        'changes': [change for change in unseen_changes(changes, peer)
+                    if change['sync_id'] not in pushed],
+        'seq': changes[-1]['seq'] if changes else int(request['since']),
+        'more': more,
+    }
+
+
+@dataclass
+class SyncResult:
+    """Changes sent and received by one sync, and how many of the received ones were new."""
+
+    pushed: int = 0
+    pulled: int = 0
+    applied: int = 0
+    round_trips: int = 0
+
+
+class SyncClient:
+    """Syncs the current patient of a DatabaseManager with a sync server URL."""
+
+    def __init__(self, db_manager: DatabaseManager, url: str,
+                 batch_size: int = SYNC_BATCH_SIZE, timeout: float = 30.0):
+        self.db_manager = db_manager
+        self.url = url
+        self.batch_size = batch_size
+        self.timeout = timeout
+
+    def _post(self, payload: Dict) -> Dict:
+        request = urllib.request.Request(self.url, data=encode_payload(payload), method="POST", headers={
+            'Content-Type': "application/json",
+            'Content-Encoding': "deflate",
+            'Accept-Encoding': "deflate",
+        })
+        with urllib.request.urlopen(request, timeout=self.timeout) as response:
+            return decode_payload(response.read())
+
+    def sync(self) -> Optional[SyncResult]:
+        """Exchange changes until both sides are up to date; None if the sync failed.
+
+        Progress is saved after every round trip, so a failed sync resumes
+        where it stopped.
+        """
+        result = SyncResult()
+        pushed_seq, pulled_seq = self.db_manager.get_sync_state(self.url)
+        client_id = self.db_manager.get_sync_client_id(self.url)
+        try:
+            if client_id is None:
+                raise sqlite3.DatabaseError("could not create a client id")
+            while True:
+                logged = self.db_manager.get_changes_since(pushed_seq, self.batch_size)
+                through = logged[-1]['seq'] if logged else pushed_seq
+                # Entries pulled from the server are acknowledged without being sent back
+                outgoing = unseen_changes(logged, self.url)
+                response = self._post({
+                    'version': PROTOCOL_VERSION,
+                    'client_id': client_id,
+                    'since': pulled_seq,
+                    'through': through,
+                    'limit': self.batch_size,
+                    'changes': outgoing,
+                })
+                if response.get('acked') != through:
+                    raise ValueError("server did not acknowledge the batch")
+
+                last_seq = self.db_manager.get_last_change_seq()
+                applied = self.db_manager.apply_changes(response['changes'], origin=self.url)
+                if applied is None:
+                    raise sqlite3.DatabaseError("could not apply changes")
+                pushed_seq = through
+                if last_seq == through:
+                    # Nothing else is waiting to be sent, so the entries just
+                    # logged are the server's own changes and need not go back
+                    pushed_seq = self.db_manager.get_last_change_seq()
+                pulled_seq = response['seq']
+                if not self.db_manager.set_sync_state(self.url, pushed_seq, pulled_seq):
+                    raise sqlite3.DatabaseError("could not save sync state")
+
+                result.pushed += len(outgoing)
+                result.pulled += len(response['changes'])
+                result.applied += applied
+                result.round_trips += 1
+                if len(logged) < self.batch_size and not response['more']:
+                    return result
+        except (urllib.error.URLError, OSError, ValueError, KeyError, zlib.error,
+                sqlite3.Error) as e:
+            print(f"Error syncing with {self.url}: {e}")
+            return None
+
+
+class SyncRequestHandler(BaseHTTPRequestHandler):
+    """Answers POST /sync/<patient key> with the server's side of a sync."""
+
+    def do_POST(self):
+        parts = self.path.strip("/").split("/")
+        if len(parts) != 2 or parts[0] != "sync" or not PATIENT_KEY_PATTERN.match(parts[1]):
+            self.send_error(404, "expected /sync/<patient key>")
+            return
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            request = decode_payload(self.rfile.read(length))
+        except (ValueError, zlib.error) as e:
+            self.send_error(400, f"bad payload: {e}")
+            return
+
+        try:
+            response = sync_response(self.server.database(parts[1]), request)
+        except (ValueError, KeyError, TypeError) as e:
+            self.send_error(400, f"bad request: {e}")
+            return
+        except sqlite3.Error as e:
+            self.send_error(500, str(e))
+            return
+
+        body = encode_payload(response)
+        self.send_response(200)
+        self.send_header('Content-Type', "application/json")
+        self.send_header('Content-Encoding', "deflate")
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class SyncServer(HTTPServer):
+    """Reference sync server keeping one database per patient key in a directory.
+
+    Requests are handled one at a time, so each database is only used from
+    the serving thread.
+    """
+
+    def __init__(self, address, data_dir: str):
+        super().__init__(address, SyncRequestHandler)
+        self.data_dir = data_dir
+        self.databases: Dict[str, DatabaseManager] = {}
+        os.makedirs(data_dir, exist_ok=True)
+
+    def database(self, patient_key: str) -> DatabaseManager:
+        if patient_key not in self.databases:
+            db_manager = DatabaseManager(os.path.join(self.data_dir, f"{patient_key}.db"))
+            db_manager.init_db()
+            if db_manager.connection is None:
+                raise sqlite3.OperationalError(f"could not open database for {patient_key}")
+            self.databases[patient_key] = db_manager
+        return self.databases[patient_key]
+
+    def server_close(self) -> None:
+        super().server_close()
+        for db_manager in self.databases.values():
+            db_manager.close()
+        self.databases.clear()
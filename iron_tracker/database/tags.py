@@ -0,0 +1,303 @@
+import re
+import sqlite3
+from dataclasses import dataclass
+from typing import Dict, List, Optional
+
+from database.patients import DEFAULT_PATIENT_ID, has_column
+from database.running_stats import RunningStats
+
+
+# "#supplement" or "#post-donation" anywhere in a note
+HASHTAG_PATTERN = re.compile(r"#(\w[\w-]*)")
+
+# Phrase -> tag, seeded into tag_keywords; phrases match whole words, case-insensitively
+DEFAULT_TAG_KEYWORDS = {
+    "supplement": "supplement",
+    "supplements": "supplement",
+    "iron pill": "supplement",
+    "ferrous": "supplement",
+    "infusion": "infusion",
+    "donation": "donation",
+    "donated": "donation",
+    "gave blood": "donation",
+    "fasting": "fasting",
+    "menstrual": "menstruation",
+    "menstruation": "menstruation",
+    "pregnant": "pregnancy",
+    "pregnancy": "pregnancy",
+    "sick": "illness",
+    "infection": "illness",
+}
+
+# Ways to split a test type's readings around a tag
+TAG_COMPARISON_MODES = ("before_after", "with_without")
+
+
+def normalize_tag(tag: str) -> str:
+    return tag.strip().lstrip("#").lower()
+
+
+def keyword_pattern(keywords: Dict[str, str]) -> Optional[re.Pattern]:
+    """One alternation over all phrases, longest first so "iron pill" wins over "iron"."""
+    if not keywords:
+        return None
+    phrases = sorted(keywords, key=len, reverse=True)
+    return re.compile(r"\b(" + "|".join(re.escape(phrase) for phrase in phrases) + r")\b")
+
+
+def extract_tags(notes: Optional[str], keywords: Dict[str, str],
+                 pattern: Optional[re.Pattern] = None) -> List[str]:
+    """Tags of a note: its hashtags plus the tags of any keyword phrases it contains."""
+    if not notes:
+        return []
+    text = notes.lower()
+    tags = {normalize_tag(tag) for tag in HASHTAG_PATTERN.findall(text)}
+    if pattern is None:
+        pattern = keyword_pattern(keywords)
+    if pattern is not None:
+        tags.update(keywords[phrase] for phrase in pattern.findall(text))
+    return sorted(tags)
+
+
+@dataclass
+class TagComparison:
+    """Level statistics of one test type split around a tag.
+
+    In "before_after" mode the baseline is every reading dated before the
+    pivot (by default the first tagged reading) and tagged is every reading
+    from then on. In "with_without" mode tagged holds the readings carrying
+    the tag and baseline the rest.
+    """
+
+    tag: str
+    test_type: str
+    mode: str
+    pivot_date: Optional[str]
+    baseline: RunningStats
+    tagged: RunningStats
+
+    @property
+    def difference(self) -> Optional[float]:
+        """Change in mean level from baseline to tagged."""
+        if not self.baseline.count or not self.tagged.count:
+            return None
+        return self.tagged.mean - self.baseline.mean
+
+
+def _group_stats(row) -> RunningStats:
+    """Accumulator of a group aggregated by count, sum, sum of squares, min and max."""
+    count = row['reading_count']
+    mean = row['level_sum'] / count
+    m2 = max(row['level_sum_sq'] - row['level_sum'] * mean, 0.0)
+    return RunningStats(count, mean, m2, row['min_level'], row['max_level'])
+
+
+class ReadingTags:
+    """Tags extracted from reading notes when they are written.
+
+    Each (tag, reading) pair is a row of reading_tags, indexed by patient,
+    tag and date for lookups and comparisons and by reading for deletes. Keyword
+    phrases live in tag_keywords; changing them re-tags every reading.
+    """
+
+    def __init__(self, connection: sqlite3.Connection):
+        self.connection = connection
+        self.keywords = None
+        self.pattern = None
+
+    def create_tables(self) -> None:
+        """Create the tag tables, seeding the keywords and tagging existing readings."""
+        cursor = self.connection.cursor()
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS reading_tags (
+                tag TEXT NOT NULL,
+                reading_id INTEGER NOT NULL,
+                patient_id INTEGER NOT NULL,
+                reading_date DATE NOT NULL,
+                PRIMARY KEY (tag, reading_id)
+            ) WITHOUT ROWID
+        """)
+        # Tags from before patients were added belong to the default patient
+        if not has_column(cursor, "reading_tags", "patient_id"):
+            cursor.execute(f"""
+                ALTER TABLE reading_tags
+                ADD COLUMN patient_id INTEGER NOT NULL DEFAULT {DEFAULT_PATIENT_ID}
+            """)
+        cursor.execute("DROP INDEX IF EXISTS idx_reading_tags_date")
+        cursor.execute("""
+            CREATE INDEX IF NOT EXISTS idx_reading_tags_patient_date
+            ON reading_tags (patient_id, tag, reading_date)
+        """)
+        cursor.execute("""
+            CREATE INDEX IF NOT EXISTS idx_reading_tags_reading
+            ON reading_tags (reading_id)
+        """)
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS tag_keywords (
+                keyword TEXT PRIMARY KEY,
+                tag TEXT NOT NULL
+            ) WITHOUT ROWID
+        """)
+
+        # Seeding happens once per database, so it also marks the first open
+        # since tagging was added
+        cursor.execute("SELECT EXISTS (SELECT 1 FROM tag_keywords)")
+        if not cursor.fetchone()[0]:
+            cursor.executemany("INSERT INTO tag_keywords (keyword, tag) VALUES (?, ?)",
+                               DEFAULT_TAG_KEYWORDS.items())
+            self.rebuild_all()
+
+    def get_keywords(self) -> Dict[str, str]:
+        if self.keywords is None:
+            cursor = self.connection.cursor()
+            cursor.execute("SELECT keyword, tag FROM tag_keywords")
+            self.keywords = {row[0]: row[1] for row in cursor.fetchall()}
+            self.pattern = keyword_pattern(self.keywords)
+        return self.keywords
+
+    def set_keyword(self, keyword: str, tag: Optional[str]) -> None:
+        """Map a phrase to a tag, or stop recognizing it when tag is None."""
+        keyword = keyword.strip().lower()
+        if tag is None:
+            self.connection.execute("DELETE FROM tag_keywords WHERE keyword = ?", (keyword,))
+        else:
+            self.connection.execute("""
+                INSERT OR REPLACE INTO tag_keywords (keyword, tag) VALUES (?, ?)
+            """, (keyword, normalize_tag(tag)))
+        self.keywords = None
+
+    def extract(self, notes: Optional[str]) -> List[str]:
+        keywords = self.get_keywords()
+        return extract_tags(notes, keywords, self.pattern)
+
+    def add(self, patient_id: int, reading_id: int, reading_date,
+            notes: Optional[str]) -> List[str]:
+        """Tag a new reading from its notes and return its tags."""
+        tags = self.extract(notes)
+        if tags:
+            self.connection.executemany("""
+                INSERT OR IGNORE INTO reading_tags (tag, reading_id, patient_id, reading_date)
+                VALUES (?, ?, ?, ?)
+            """, [(tag, reading_id, patient_id, str(reading_date)) for tag in tags])
+        return tags
+
+    def remove(self, reading_id: int) -> None:
+        self.connection.execute("DELETE FROM reading_tags WHERE reading_id = ?", (reading_id,))
+
+    def rebuild_all(self) -> None:
+        """Re-tag every reading, e.g. after the keywords change."""
+        cursor = self.connection.cursor()
+        cursor.execute("DELETE FROM reading_tags")
+        cursor.execute("""
+            SELECT id, patient_id, reading_date, notes FROM iron_readings
+            WHERE notes IS NOT NULL AND notes != ''
+        """)
+        for row in cursor.fetchall():
+            self.add(row['patient_id'], row['id'], row['reading_date'], row['notes'])
+
+    def all_tags(self, patient_id: int) -> List[Dict]:
+        """Each of a patient's tags with its reading count and first and last dates, most used first."""
+        cursor = self.connection.cursor()
+        cursor.execute("""
+            SELECT tag, COUNT(*) AS reading_count,
+                   MIN(reading_date) AS first_date, MAX(reading_date) AS last_date
+            FROM reading_tags
+            WHERE patient_id = ?
+            GROUP BY tag
+            ORDER BY reading_count DESC, tag
+        """, (patient_id,))
+        return [dict(row) for row in cursor.fetchall()]
+
+    def compare(self, patient_id: int, tag: str, test_type: str, mode: str = "before_after",
+                pivot_date=None) -> Optional[TagComparison]:
+        """Split a patient's readings of a test type around a tag and aggregate each side in one query.
+
+        Returns None when the tag is unused and no pivot date is given.
+        """
+        if mode not in TAG_COMPARISON_MODES:
+            raise ValueError(f"Unknown comparison mode: {mode}")
+        tag = normalize_tag(tag)
+        cursor = self.connection.cursor()
+
+        if mode == "before_after":
+            if pivot_date is None:
+                cursor.execute("""
+                    SELECT MIN(reading_date) FROM reading_tags WHERE patient_id = ? AND tag = ?
+                """, (patient_id, tag))
+                pivot_date = cursor.fetchone()[0]
+                if pivot_date is None:
+                    return None
+            pivot_date = str(pivot_date)
+            group_sql = "r.reading_date >= :pivot"
+        else:
+            group_sql = """EXISTS (
+                SELECT 1 FROM reading_tags t WHERE t.tag = :tag AND t.reading_id = r.id
+            )"""
+
+        cursor.execute(f"""
+            SELECT {group_sql} AS tagged, COUNT(*) AS reading_count,
+                   SUM(r.iron_level) AS level_sum,
+                   SUM(r.iron_level * r.iron_level) AS level_sum_sq,
+                   MIN(r.iron_level) AS min_level, MAX(r.iron_level) AS max_level
+            FROM iron_readings r
+            WHERE r.patient_id = :patient_id AND r.test_type = :test_type
+            GROUP BY tagged
+        """, {'patient_id': patient_id, 'tag': tag, 'test_type': test_type, 'pivot': pivot_date})
+
+        groups = {0: RunningStats(), 1: RunningStats()}
+        for row in cursor.fetchall():
+            groups[row['tagged']] = _group_stats(row)
+
+        return TagComparison(
+            tag=tag,
+            test_type=test_type,
+            mode=mode,
+            pivot_date=pivot_date if mode == "before_after" else None,
+            baseline=groups[0],
+            tagged=groups[1],
+        )
+
+    def compare_most_used(self, patient_id: int, test_type: str, limit: int) -> List[TagComparison]:
+        """Before/after comparisons of a patient's most used tags, most used first, in one query.
+
+        Each tag is split at its first use, as compare does by default.
+        """
+        cursor = self.connection.cursor()
+        cursor.execute("""
+            WITH pivots AS (
+                SELECT tag, MIN(reading_date) AS pivot_date, COUNT(*) AS tag_count
+                FROM reading_tags
+                WHERE patient_id = :patient_id
+                GROUP BY tag
+                ORDER BY tag_count DESC, tag
+                LIMIT :limit
+            )
+            SELECT p.tag, p.pivot_date, p.tag_count, r.reading_date >= p.pivot_date AS tagged,
+                   COUNT(r.id) AS reading_count,
+                   SUM(r.iron_level) AS level_sum,
+                   SUM(r.iron_level * r.iron_level) AS level_sum_sq,
+                   MIN(r.iron_level) AS min_level, MAX(r.iron_level) AS max_level
+            FROM pivots p
+            LEFT JOIN iron_readings r ON r.patient_id = :patient_id AND r.test_type = :test_type
+            GROUP BY p.tag, tagged
+            ORDER BY p.tag_count DESC, p.tag
+        """, {'patient_id': patient_id, 'test_type': test_type, 'limit': limit})
+
+        comparisons: Dict[str, TagComparison] = {}
+        for row in cursor.fetchall():
+            comparison = comparisons.get(row['tag'])
+            if comparison is None:
+                comparison = comparisons[row['tag']] = TagComparison(
+                    tag=row['tag'],
+                    test_type=test_type,
+                    mode="before_after",
+                    pivot_date=str(row['pivot_date']),
+                    baseline=RunningStats(),
+                    tagged=RunningStats(),
+                )
+            if row['reading_count']:
+                if row['tagged']:
+                    comparison.tagged = _group_stats(row)
+                else:
+                    comparison.baseline = _group_stats(row)
+        return list(comparisons.values())
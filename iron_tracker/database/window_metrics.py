@@ -0,0 +1,104 @@
+import sqlite3
+from datetime import timedelta
+from typing import Dict, List, Optional
+
+from database.rollups import as_date
+
+
+# Trailing window of the rolling average, in days
+ROLLING_WINDOW_DAYS = 30
+
+# Fractional days since 1970-01-01, the same scale as reading_timestamp
+TIMESTAMP_SQL = "julianday(reading_date || ' ' || reading_time) - 2440587.5"
+
+
+class WindowMetrics:
+    """Per-reading metrics computed with SQLite window functions.
+
+    For each of a patient's readings, within its own test type: the average and count of
+    the readings in the trailing window_days (a RANGE frame over real
+    timestamps, so irregular spacing is handled), the change from the
+    previous reading and the days since it (LAG). A date window is
+    answered by one statement that reads only the rows it needs through
+    the date indexes: the window itself, plus enough history for the
+    first readings' frames and predecessors.
+    """
+
+    def __init__(self, connection: sqlite3.Connection):
+        self.connection = connection
+
+    def query(self, patient_id: int, start_date=None, end_date=None,
+              test_type: Optional[str] = None, window_days: float = ROLLING_WINDOW_DAYS,
+              limit: Optional[int] = None, newest_first: bool = False) -> List[Dict]:
+        """Metrics for the patient's readings dated within [start_date, end_date]."""
+        inner = ["patient_id = :patient_id"]
+        outer = []
+        params = {'patient_id': patient_id, 'window': float(window_days), 'test_type': test_type}
+        if test_type is not None:
+            inner.append("test_type = :test_type")
+        if end_date is not None:
+            inner.append("reading_date <= :end")
+            params['end'] = as_date(end_date).isoformat()
+        if start_date is not None:
+            start = as_date(start_date)
+            params['start'] = start.isoformat()
+            params['lookback'] = (start - timedelta(days=window_days)).isoformat()
+            # Go back far enough to cover the rolling frame and each test
+            # type's previous reading
+            inner.append("""reading_date >= MIN(:lookback, COALESCE((
+                SELECT MIN(previous_date) FROM (
+                    SELECT MAX(reading_date) AS previous_date FROM iron_readings
+                    WHERE patient_id = :patient_id AND reading_date < :start
+                      AND (:test_type IS NULL OR test_type = :test_type)
+                    GROUP BY test_type
+                )
+            ), :start))""")
+            outer.append("reading_date >= :start")
+
+        outer_where = f"WHERE {' AND '.join(outer)}" if outer else ""
+        direction = "DESC" if newest_first else "ASC"
+        limit_sql = ""
+        if limit is not None:
+            limit_sql = "LIMIT :limit"
+            params['limit'] = limit
+
+        cursor = self.connection.cursor()
+        cursor.execute(f"""
+            SELECT id, reading_date, reading_time, test_type, iron_level, timestamp,
+                   rolling_mean, rolling_count, delta, days_since_previous
+            FROM (
+                SELECT id, reading_date, reading_time, test_type, iron_level, timestamp,
+                       AVG(iron_level) OVER trailing AS rolling_mean,
+                       COUNT(*) OVER trailing AS rolling_count,
+                       iron_level - LAG(iron_level) OVER ordered AS delta,
+                       timestamp - LAG(timestamp) OVER ordered AS days_since_previous
+                FROM (
+                    SELECT id, reading_date, reading_time, test_type, iron_level,
+                           {TIMESTAMP_SQL} AS timestamp
+                    FROM iron_readings
+                    WHERE {' AND '.join(inner)}
+                )
+                WINDOW ordered AS (PARTITION BY test_type ORDER BY timestamp, id),
+                       trailing AS (PARTITION BY test_type ORDER BY timestamp
+                                    RANGE BETWEEN :window PRECEDING AND CURRENT ROW)
+            )
+            {outer_where}
+            ORDER BY timestamp {direction}, id {direction}
+            {limit_sql}
+        """, params)
+        return [dict(row) for row in cursor.fetchall()]
+
+    def recent(self, patient_id: int, limit: int,
+               window_days: float = ROLLING_WINDOW_DAYS) -> List[Dict]:
+        """Metrics for the patient's newest readings, newest first."""
+        cursor = self.connection.cursor()
+        cursor.execute("""
+            SELECT reading_date FROM iron_readings
+            WHERE patient_id = ?
+            ORDER BY reading_date DESC, reading_time DESC
+            LIMIT 1 OFFSET ?
+        """, (patient_id, max(limit - 1, 0)))
+        row = cursor.fetchone()
+        start_date = row[0] if row else None
+        return self.query(patient_id, start_date, window_days=window_days, limit=limit,
+                          newest_first=True)
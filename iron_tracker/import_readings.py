@@ -0,0 +1,118 @@
+"""Import readings from a CSV file into an iron tracker database.
+
+Usage:
+    python import_readings.py iron_tracker.db lab_results.csv
+    python import_readings.py iron_tracker.db lab_results.csv --patient 2 --source lab-2026
+
+The file needs reading_date (YYYY-MM-DD), reading_time (HH:MM) and
+iron_level columns, and may have test_type and notes. Rows that do not
+parse are reported with their line number and skipped. Readings are
+upserted on their natural key with the file name as source id, so
+importing a file again adds nothing and an interrupted import resumes
+where it stopped.
+"""
+import argparse
+import csv
+import math
+import os
+import sys
+import time
+from datetime import date, datetime
+from typing import Dict, Iterator, List, Sequence
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from database.db_manager import DatabaseManager
+from database.patients import DEFAULT_PATIENT_ID
+
+
+REQUIRED_COLUMNS = ("reading_date", "reading_time", "iron_level")
+
+
+def parse_row(row: Dict) -> Dict:
+    """Validate a CSV row and normalize it to a reading, e.g. 8:05 to 08:05.
+
+    Raises ValueError naming the first field that does not parse.
+    """
+    values = {column: (row.get(column) or "").strip() for column in REQUIRED_COLUMNS}
+    try:
+        reading_date = date.fromisoformat(values['reading_date'])
+    except ValueError:
+        raise ValueError(f"reading_date {values['reading_date']!r} is not YYYY-MM-DD") from None
+    try:
+        reading_time = datetime.strptime(values['reading_time'], "%H:%M")
+    except ValueError:
+        raise ValueError(f"reading_time {values['reading_time']!r} is not HH:MM") from None
+    try:
+        iron_level = float(values['iron_level'])
+    except ValueError:
+        iron_level = math.nan
+    if not math.isfinite(iron_level):
+        raise ValueError(f"iron_level {values['iron_level']!r} is not a number")
+    return {
+        'reading_date': reading_date.isoformat(),
+        'reading_time': reading_time.strftime("%H:%M"),
+        'iron_level': iron_level,
+        'test_type': (row.get('test_type') or "").strip() or None,
+        'notes': row.get('notes') or "",
+    }
+
+
+def read_csv(path: str, skipped: List[int] = None) -> Iterator[Dict]:
+    """Yield the readings of a CSV file one at a time.
+
+    Rows that do not parse are reported and skipped; their line numbers are
+    appended to skipped.
+    """
+    with open(path, newline="", encoding="utf-8-sig") as f:
+        reader = csv.DictReader(f)
+        missing = [column for column in REQUIRED_COLUMNS if column not in (reader.fieldnames or ())]
+        if missing:
+            raise ValueError(f"missing column(s): {', '.join(missing)}")
+        for row in reader:
+            try:
+                yield parse_row(row)
+            except ValueError as e:
+                print(f"{path}, line {reader.line_num}: skipped, {e}")
+                if skipped is not None:
+                    skipped.append(reader.line_num)
+
+
+def main(argv: Sequence[str] = None) -> int:
+    parser = argparse.ArgumentParser(description="Import readings from a CSV file.")
+    parser.add_argument("database", help="iron_tracker.db file to import into")
+    parser.add_argument("csv", help="CSV file of readings")
+    parser.add_argument("--patient", type=int, default=DEFAULT_PATIENT_ID, help="patient id")
+    parser.add_argument("--source", default=None, help="source id (default: the CSV file name)")
+    parser.add_argument("--batch-size", type=int, default=500, help="readings per transaction")
+    args = parser.parse_args(argv)
+
+    db_manager = DatabaseManager(args.database)
+    db_manager.init_db()
+    if db_manager.connection is None:
+        return 1
+    try:
+        if not db_manager.select_patient(args.patient):
+            print(f"No patient with id {args.patient}")
+            return 1
+        started = time.perf_counter()
+        source_id = args.source or os.path.basename(args.csv)
+        skipped = []
+        try:
+            counts = db_manager.upsert_readings(read_csv(args.csv, skipped), source_id,
+                                                args.batch_size)
+        except (OSError, ValueError, csv.Error) as e:
+            print(f"Error reading {args.csv}: {e}")
+            return 1
+        if counts is None:
+            return 1
+        print(f"{counts['added']} added, {counts['updated']} updated, "
+              f"{counts['unchanged']} unchanged, {len(skipped)} skipped "
+              f"in {time.perf_counter() - started:.2f}s")
+        return 0
+    finally:
+        db_manager.close()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
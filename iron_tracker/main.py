@@ -4,8 +4,12 @@ from kivymd.uix.screen import MDScreen
 from kivymd.uix.navigationbar import MDNavigationBar, MDNavigationItem
 from kivymd.uix.label import MDLabel
 from kivymd.uix.boxlayout import MDBoxLayout
+from kivymd.uix.floatlayout import MDFloatLayout
 from kivymd.icon_definitions import md_icons
 from kivy.clock import Clock
+from kivy.core.window import Window
+from kivy.metrics import dp
+from datetime import datetime
 import os
 import sys
 
@@ -16,13 +20,55 @@ from screens.input_screen import InputScreen
 from screens.history_screen import HistoryScreen
 from screens.charts_screen import ChartsScreen
 from screens.insights_screen import InsightsScreen
+from analytics.tracing import TRACER
 from database.db_manager import DatabaseManager
 
 
+# Seconds between debug overlay updates
+DEBUG_OVERLAY_INTERVAL = 1.0
+# Keycode of F12, which toggles the overlay on desktop
+DEBUG_OVERLAY_KEY = 293
+
+
+class DebugOverlay(MDLabel):
+    """Translucent panel listing the p50/p95/p99 of every traced span."""
+    
+    def __init__(self, **kwargs):
+        super().__init__(
+            text="No spans recorded yet",
+            font_style="Caption",
+            theme_text_color="Custom",
+            text_color=(1, 1, 1, 1),
+            md_bg_color=(0, 0, 0, 0.7),
+            valign="top",
+            padding=(dp(8), dp(8)),
+            size_hint=(1, None),
+            height=dp(160),
+            pos_hint={"top": 1},
+            **kwargs
+        )
+        self.update_event = None
+    
+    def start(self):
+        self.update()
+        self.update_event = Clock.schedule_interval(self.update, DEBUG_OVERLAY_INTERVAL)
+    
+    def stop(self):
+        if self.update_event is not None:
+            self.update_event.cancel()
+            self.update_event = None
+    
+    def update(self, *args):
+        summaries = TRACER.summaries()
+        if summaries:
+            self.text = "\n".join(str(summary) for summary in summaries)
+
+
 class MainApp(MDApp):
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
         self.db_manager = DatabaseManager()
+        self.debug_overlay = None
         
     def build(self):
         self.theme_cls.theme_style = "Light"
@@ -76,7 +122,36 @@ class MainApp(MDApp):
         main_layout.add_widget(self.screen_manager)
         main_layout.add_widget(self.navigation_bar)
         
-        return main_layout
+        # The debug overlay floats above the screens when shown
+        self.root_layout = MDFloatLayout()
+        self.root_layout.add_widget(main_layout)
+        Window.bind(on_keyboard=self.on_keyboard)
+        
+        return self.root_layout
+    
+    def on_keyboard(self, window, key, scancode, codepoint, modifiers):
+        """Toggle the debug overlay with F12 on desktop builds."""
+        if key == DEBUG_OVERLAY_KEY:
+            self.toggle_debug_overlay()
+            return True
+        return False
+    
+    def toggle_debug_overlay(self, *args):
+        """Show or hide the span timings overlay."""
+        if self.debug_overlay is None:
+            self.debug_overlay = DebugOverlay()
+            self.root_layout.add_widget(self.debug_overlay)
+            self.debug_overlay.start()
+        else:
+            self.debug_overlay.stop()
+            self.root_layout.remove_widget(self.debug_overlay)
+            self.debug_overlay = None
+    
+    def save_trace(self):
+        """Write the recorded span timings to a JSON file in the app's data directory."""
+        path = os.path.join(self.user_data_dir, f"trace-{datetime.now():%Y%m%d-%H%M%S}.json")
+        TRACER.dump(path)
+        return path
     
     def on_tab_switch(self, instance_navigation_bar, instance_navigation_item, instance_navigation_item_icon, instance_navigation_item_text):
         """Handle navigation bar item switches."""
@@ -0,0 +1,189 @@
+"""Headless report renderer for one or many iron tracker databases.
+
+Usage:
+    python report.py patient_a.db patient_b.db --output reports --format png pdf --jobs 8
+    python report.py patient_a.db --test-type "Transferrin Saturation (calculated)"
+    python report.py family.db --patient 2
+
+Each patient in each database gets its own report: one file per chart for
+PNG/SVG, and a single multi-page document for PDF. Databases holding more
+than one patient name their files after the patient id as well.
+
+Databases are opened read-only; ones written by an older version of the
+app have to be opened by it first. Databases are rendered in parallel
+worker processes and per-job timings are printed as they complete.
+"""
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Dict, Iterable, List, Sequence
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+import matplotlib
+matplotlib.use("Agg")
+from matplotlib.backends.backend_pdf import PdfPages
+
+from analytics.rolling import RollingOverlay
+from charts.figures import CHART_TYPES, NoChartData, build_figure
+from database.db_manager import DatabaseManager
+
+
+REPORT_FORMATS = ("png", "svg", "pdf")
+
+
+def render_report(db_path: str, output_dir: str, formats: Sequence[str] = ("pdf",),
+                  dpi: int = 100, test_type: str = None, patient_id: int = None) -> Dict:
+    """Render all charts for every patient in a single database.
+
+    test_type restricts the charts to one test type and patient_id the
+    report to one patient. Returns a dict with the database path, the files
+    written, the charts that were skipped for lack of data, the elapsed
+    seconds and any error message.
+    """
+    started = time.perf_counter()
+    result = {'db_path': db_path, 'files': [], 'skipped': [], 'seconds': 0.0, 'error': None}
+
+    db_manager = DatabaseManager(db_path)
+    try:
+        if not os.path.exists(db_path):
+            raise FileNotFoundError(f"no such database: {db_path}")
+        # Other people's files are only read, never created, migrated or committed to
+        db_manager.init_db(read_only=True)
+        if db_manager.connection is None:
+            raise RuntimeError("could not open database")
+        missing = db_manager.schema_problems()
+        if missing:
+            raise RuntimeError(f"needs migration, open it once in the app first "
+                               f"(missing {', '.join(missing)})")
+
+        patient_ids = [patient['id'] for patient in db_manager.get_patients()]
+        if patient_id is not None and patient_id not in patient_ids:
+            raise ValueError(f"no patient with id {patient_id}")
+        name = os.path.splitext(os.path.basename(db_path))[0]
+        os.makedirs(output_dir, exist_ok=True)
+
+        for current_id in sorted(patient_ids) if patient_id is None else [patient_id]:
+            db_manager.select_patient(current_id)
+            # Single-patient databases keep the file names reports always had
+            prefix = name if len(patient_ids) == 1 else f"{name}_patient{current_id}"
+            figures = []
+            for chart_type in CHART_TYPES:
+                try:
+                    figures.append((chart_type, _build_figure(db_manager, chart_type, test_type)))
+                except NoChartData:
+                    result['skipped'].append(chart_type if len(patient_ids) == 1
+                                             else f"{chart_type} (patient {current_id})")
+            result['files'].extend(_save_figures(figures, output_dir, prefix, formats, dpi))
+    except Exception as e:
+        result['error'] = str(e)
+    finally:
+        db_manager.close()
+        result['seconds'] = time.perf_counter() - started
+
+    return result
+
+
+def _build_figure(db_manager: DatabaseManager, chart_type: str, test_type: str = None):
+    """Build one chart for the selected patient."""
+    # A single test type gets its rolling average from the SQL window metrics
+    overlay = None
+    if chart_type == "trend" and not test_type:
+        overlay = RollingOverlay.from_series(db_manager.get_reading_series())
+    return build_figure(db_manager, chart_type, overlay, test_type)
+
+
+def _save_figures(figures: List, output_dir: str, prefix: str, formats: Sequence[str],
+                  dpi: int) -> List[str]:
+    """Write (chart_type, figure) pairs in every format and return the paths written."""
+    paths = []
+    for fmt in formats:
+        if not figures:
+            break
+        if fmt == "pdf":
+            path = os.path.join(output_dir, f"{prefix}.pdf")
+            with PdfPages(path) as pdf:
+                for chart_type, figure in figures:
+                    pdf.savefig(figure)
+            paths.append(path)
+        else:
+            for chart_type, figure in figures:
+                path = os.path.join(output_dir, f"{prefix}_{chart_type}.{fmt}")
+                figure.savefig(path, format=fmt, dpi=dpi)
+                paths.append(path)
+    return paths
+
+
+def render_reports(db_paths: Iterable[str], output_dir: str, formats: Sequence[str] = ("pdf",),
+                   dpi: int = 100, max_workers: int = None, on_result=None,
+                   test_type: str = None, patient_id: int = None) -> List[Dict]:
+    """Render reports for many databases across a pool of worker processes.
+
+    on_result, if given, is called with each result as soon as its job finishes.
+    Results are returned in the order the databases were given.
+    """
+    db_paths = list(db_paths)
+    results = [None] * len(db_paths)
+
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            executor.submit(render_report, db_path, output_dir, formats, dpi, test_type,
+                            patient_id): index
+            for index, db_path in enumerate(db_paths)
+        }
+        for future in as_completed(futures):
+            index = futures[future]
+            try:
+                result = future.result()
+            except Exception as e:
+                # The worker process itself failed, e.g. it was killed
+                result = {'db_path': db_paths[index], 'files': [], 'skipped': [],
+                          'seconds': 0.0, 'error': str(e)}
+            results[index] = result
+            if on_result is not None:
+                on_result(result)
+
+    return results
+
+
+def print_result(result: Dict) -> None:
+    """Print a one-line summary of a finished report job."""
+    if result['error']:
+        status = f"FAILED: {result['error']}"
+    else:
+        status = f"{len(result['files'])} file(s)"
+        if result['skipped']:
+            status += f", skipped {', '.join(result['skipped'])}"
+    print(f"{result['seconds']:7.2f}s  {result['db_path']}  {status}")
+
+
+def main(argv: Sequence[str] = None) -> int:
+    parser = argparse.ArgumentParser(description="Render iron level reports without the app UI.")
+    parser.add_argument("databases", nargs="+", help="iron_tracker.db files to report on")
+    parser.add_argument("-o", "--output", default="reports", help="output directory")
+    parser.add_argument("-f", "--format", nargs="+", choices=REPORT_FORMATS, default=["pdf"],
+                        help="output formats")
+    parser.add_argument("-j", "--jobs", type=int, default=None,
+                        help="worker processes (default: number of CPUs)")
+    parser.add_argument("--dpi", type=int, default=100, help="resolution for PNG output")
+    parser.add_argument("--test-type", default=None,
+                        help="chart only this test type, e.g. a derived one (default: all readings)")
+    parser.add_argument("--patient", type=int, default=None,
+                        help="report on this patient id only (default: every patient)")
+    args = parser.parse_args(argv)
+
+    started = time.perf_counter()
+    results = render_reports(args.databases, args.output, args.format, args.dpi,
+                             args.jobs, on_result=print_result, test_type=args.test_type,
+                             patient_id=args.patient)
+    failures = sum(1 for result in results if result['error'])
+
+    print(f"Rendered {len(results) - failures}/{len(results)} report(s) "
+          f"in {time.perf_counter() - started:.2f}s")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
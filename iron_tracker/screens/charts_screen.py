@@ -5,11 +5,81 @@ from kivymd.uix.label import MDLabel
 from kivymd.uix.button import MDFlatButton
 from kivy.garden.matplotlib.backend_kivyagg import FigureCanvasKivyAgg
 from kivy.metrics import dp
-import matplotlib.pyplot as plt
-import matplotlib.dates as mdates
-from datetime import datetime, date, timedelta
+from kivy.clock import Clock
+from kivy.core.window import Window
 import numpy as np
 
+from analytics.rolling import RollingOverlay
+from analytics.tracing import span, traced
+from charts.figures import (
+    CHART_TYPES, NoChartData, TrendChart, build_histogram_figure, build_monthly_figure
+)
+from charts.prefetch import ChartPrefetcher
+from database.derived import DERIVED_BY_TYPE
+from database.reading_store import reading_timestamp
+
+
+# Trend chart viewport limits
+TREND_MIN_SPAN_DAYS = 7
+TREND_ZOOM_STEP = 1.2
+
+
+class TrendChartCanvas(FigureCanvasKivyAgg):
+    """Figure canvas that turns scroll, drag and pinch gestures into viewport changes."""
+    
+    def __init__(self, figure, on_viewport_change, **kwargs):
+        super().__init__(figure, **kwargs)
+        self.on_viewport_change = on_viewport_change
+        self.active_touches = []
+    
+    def x_fraction(self, x):
+        """Convert a window x coordinate to a fraction of the axes width."""
+        bbox = self.figure.axes[0].bbox
+        return min(max((x - self.x - bbox.x0) / max(bbox.width, 1), 0.0), 1.0)
+    
+    def on_touch_down(self, touch):
+        if not self.collide_point(*touch.pos):
+            return super().on_touch_down(touch)
+        
+        if touch.is_mouse_scrolling:
+            zoom = TREND_ZOOM_STEP if touch.button == "scrollup" else 1 / TREND_ZOOM_STEP
+            self.on_viewport_change(zoom=zoom, anchor=self.x_fraction(touch.x))
+            return True
+        
+        touch.grab(self)
+        self.active_touches.append(touch)
+        return True
+    
+    def on_touch_move(self, touch):
+        if touch.grab_current is not self:
+            return super().on_touch_move(touch)
+        
+        axes_width = max(self.figure.axes[0].bbox.width, 1)
+        if len(self.active_touches) == 1:
+            # Drag pans the view
+            self.on_viewport_change(pan=-touch.dx / axes_width)
+        elif len(self.active_touches) >= 2:
+            # Pinch zooms around the midpoint between the two fingers
+            first, second = self.active_touches[:2]
+            other = second if touch is first else first
+            previous = np.hypot(touch.px - other.x, touch.py - other.y)
+            current = np.hypot(touch.x - other.x, touch.y - other.y)
+            if previous > 0 and current > 0:
+                self.on_viewport_change(
+                    zoom=previous / current,
+                    anchor=self.x_fraction((touch.x + other.x) / 2)
+                )
+        return True
+    
+    def on_touch_up(self, touch):
+        if touch.grab_current is not self:
+            return super().on_touch_up(touch)
+        
+        touch.ungrab(self)
+        if touch in self.active_touches:
+            self.active_touches.remove(touch)
+        return True
+
 
 class ChartsScreen(MDScreen):
     """Screen for displaying iron level charts and trends."""
@@ -18,6 +88,17 @@ class ChartsScreen(MDScreen):
         super().__init__(**kwargs)
         self.db_manager = db_manager
         self.current_chart = "trend"
+        self.trend_chart = None
+        self.trend_canvas = None
+        self.show_overlays = True
+        self.rolling_overlay = None
+        self.db_manager.add_change_listener(self.on_reading_change)
+        self._trend_reload_trigger = Clock.create_trigger(self.load_trend_viewport)
+        
+        # Build the chart types that are not visible while the app is idle
+        self.prefetcher = ChartPrefetcher(self.db_manager.db_path, self.build_chart)
+        Window.bind(on_touch_down=self.prefetcher.notify_interaction,
+                    on_touch_move=self.prefetcher.notify_interaction)
         self.build_ui()
     
     def build_ui(self):
@@ -75,7 +156,13 @@ class ChartsScreen(MDScreen):
         
         button_layout.add_widget(trend_button)
         button_layout.add_widget(histogram_button)
+        overlay_button = MDFlatButton(
+            text="Overlays",
+            on_release=lambda x: self.toggle_overlays()
+        )
+        
         button_layout.add_widget(monthly_button)
+        button_layout.add_widget(overlay_button)
         
         header_card.add_widget(title)
         header_card.add_widget(button_layout)
@@ -103,6 +190,7 @@ class ChartsScreen(MDScreen):
         # Initialize with trend chart
         self.create_trend_chart()
     
+    @traced("charts.refresh")
     def refresh_charts(self):
         """Refresh the current chart with latest data."""
         if self.current_chart == "trend":
@@ -111,218 +199,182 @@ class ChartsScreen(MDScreen):
             self.create_histogram_chart()
         elif self.current_chart == "monthly":
             self.create_monthly_chart()
+        self.prefetch_hidden_charts()
     
     def switch_chart(self, chart_type):
-        """Switch to a different chart type."""
+        """Switch to a different chart type, using a prefetched chart when one is ready."""
         self.current_chart = chart_type
-        self.refresh_charts()
+        prefetched = self.prefetcher.take(chart_type)
+        if prefetched is None:
+            self.refresh_charts()
+            return
+        
+        if chart_type == "trend":
+            self.create_trend_chart(prefetched)
+        elif chart_type == "histogram":
+            self.create_histogram_chart(prefetched)
+        elif chart_type == "monthly":
+            self.create_monthly_chart(prefetched)
+        self.prefetch_hidden_charts()
     
-    def create_trend_chart(self):
-        """Create a trend line chart showing iron levels over time."""
+    def prefetch_hidden_charts(self):
+        """Queue the chart types that are not on screen for idle-time building."""
+        self.prefetcher.request(
+            chart_type for chart_type in CHART_TYPES if chart_type != self.current_chart
+        )
+    
+    def build_chart(self, db_manager, chart_type):
+        """Build a chart off the UI thread; NoChartData is returned rather than raised."""
+        # The prefetch worker's own connection follows the selected patient
+        db_manager.select_patient(self.db_manager.patient_id)
+        try:
+            with span(f"charts.build.{chart_type}"):
+                if chart_type == "trend":
+                    overlay = None
+                    if self.show_overlays:
+                        overlay = RollingOverlay.from_series(db_manager.get_reading_series())
+                    return TrendChart(db_manager, overlay)
+                if chart_type == "histogram":
+                    return build_histogram_figure(db_manager)
+                if chart_type == "monthly":
+                    return build_monthly_figure(db_manager)
+        except NoChartData as e:
+            return e
+        raise ValueError(f"Unknown chart type: {chart_type}")
+    
+    def toggle_overlays(self):
+        """Show or hide the rolling-statistics overlays on the trend chart."""
+        self.show_overlays = not self.show_overlays
+        self.prefetcher.invalidate()
+        if self.current_chart == "trend":
+            self.create_trend_chart()
+    
+    def on_reading_change(self, event, reading):
+        """Keep the rolling overlay and prefetched charts in sync with database changes."""
+        self.prefetcher.invalidate()
+        if event == "patient":
+            self.rolling_overlay = None
+            return
+        if self.rolling_overlay is None or event not in ("add", "delete"):
+            return
+        # The overlay covers native readings only, like get_reading_series
+        if reading.get('test_type') in DERIVED_BY_TYPE:
+            return
+        
+        timestamp = reading_timestamp(reading['reading_date'], reading['reading_time'])
+        if event == "add" and timestamp >= self.rolling_overlay.last_time:
+            self.rolling_overlay.append(timestamp, reading['iron_level'])
+        else:
+            # Back-dated inserts and deletes change history; rebuild on next use
+            self.rolling_overlay = None
+    
+    def get_rolling_overlay(self):
+        """Get the cached rolling overlay, computing it from the reading series if needed.
+        
+        The series is the one prefetched charts and reports use, so the
+        overlay looks the same whichever path built the chart.
+        """
+        if self.rolling_overlay is None:
+            self.rolling_overlay = RollingOverlay.from_series(self.db_manager.get_reading_series())
+        return self.rolling_overlay
+    
+    def show_figure(self, figure):
+        """Show a matplotlib figure in the chart container."""
+        self.chart_container.add_widget(FigureCanvasKivyAgg(figure))
+    
+    @traced("charts.render.trend")
+    def create_trend_chart(self, prefetched=None):
+        """Create a zoomable trend chart backed by the rollup pyramid."""
         self.chart_container.clear_widgets()
+        self.trend_chart = None
+        self.trend_canvas = None
         
         try:
-            readings = self.db_manager.get_all_readings()
-            if not readings:
-                self.show_no_data_message()
-                return
-            
-            # Prepare data
-            dates = []
-            levels = []
-            
-            for reading in reversed(readings):  # Reverse to get chronological order
-                date_obj = datetime.strptime(reading['reading_date'], '%Y-%m-%d').date()
-                dates.append(date_obj)
-                levels.append(reading['iron_level'])
-            
-            # Get normal range
-            profile = self.db_manager.get_user_profile()
-            normal_min = profile.get('normal_range_min', 60)
-            normal_max = profile.get('normal_range_max', 170)
-            
-            # Create the plot
-            fig, ax = plt.subplots(figsize=(10, 6))
-            fig.patch.set_facecolor('#FAFAFA')
-            
-            # Plot the trend line
-            ax.plot(dates, levels, marker='o', linewidth=2, markersize=6, 
-                   color='#F44336', alpha=0.8, label='Iron Levels')
-            
-            # Add normal range bands
-            ax.axhspan(normal_min, normal_max, alpha=0.2, color='green', 
-                      label=f'Normal Range ({normal_min}-{normal_max} μg/dL)')
-            ax.axhline(y=normal_min, color='green', linestyle='--', alpha=0.5)
-            ax.axhline(y=normal_max, color='green', linestyle='--', alpha=0.5)
-            
-            # Formatting
-            ax.set_xlabel('Date', fontsize=12)
-            ax.set_ylabel('Iron Level (μg/dL)', fontsize=12)
-            ax.set_title('Iron Level Trend Over Time', fontsize=14, fontweight='bold')
-            ax.grid(True, alpha=0.3)
-            ax.legend()
-            
-            # Format dates on x-axis
-            if len(dates) > 10:
-                ax.xaxis.set_major_locator(mdates.WeekdayLocator(interval=1))
-                ax.xaxis.set_major_formatter(mdates.DateFormatter('%m/%d'))
+            if isinstance(prefetched, NoChartData):
+                raise prefetched
+            if prefetched is not None:
+                # Viewport reloads must use the UI thread's connection
+                prefetched.db_manager = self.db_manager
+                self.trend_chart = prefetched
             else:
-                ax.xaxis.set_major_formatter(mdates.DateFormatter('%m/%d'))
-            
-            plt.setp(ax.xaxis.get_majorticklabels(), rotation=45)
-            
-            # Adjust layout
-            fig.tight_layout()
+                overlay = self.get_rolling_overlay() if self.show_overlays else None
+                self.trend_chart = TrendChart(self.db_manager, overlay)
             
             # Add to Kivy
-            canvas = FigureCanvasKivyAgg(fig)
-            self.chart_container.add_widget(canvas)
+            self.trend_canvas = TrendChartCanvas(
+                self.trend_chart.figure, on_viewport_change=self.change_trend_viewport
+            )
+            self.chart_container.add_widget(self.trend_canvas)
             
+        except NoChartData as e:
+            self.show_no_data_message(e.message)
         except Exception as e:
             print(f"Error creating trend chart: {e}")
             self.show_error_message("Error creating trend chart")
     
-    def create_histogram_chart(self):
+    def change_trend_viewport(self, zoom=1.0, anchor=0.5, pan=0.0):
+        """Zoom around an anchor (fraction of the axis width) and pan by a fraction of the span."""
+        if self.trend_chart is None:
+            return
+        
+        axes = self.trend_chart.axes
+        left, right = axes.get_xlim()
+        span = right - left
+        extent_left, extent_right = self.trend_chart.extent
+        max_span = max(extent_right - extent_left, TREND_MIN_SPAN_DAYS)
+        
+        new_span = min(max(span * zoom, TREND_MIN_SPAN_DAYS), max_span)
+        center = left + span * anchor
+        new_left = center - new_span * anchor + pan * new_span
+        
+        # Keep the viewport inside the data extent
+        new_left = min(max(new_left, extent_left), extent_right - new_span)
+        new_left = max(new_left, extent_right - max_span)
+        axes.set_xlim(new_left, new_left + new_span)
+        
+        # Coalesce gesture events into at most one reload per frame
+        self._trend_reload_trigger()
+    
+    @traced("charts.viewport.trend")
+    def load_trend_viewport(self, *args):
+        """Reload rollups for the visible range and redraw the trend chart."""
+        if self.trend_chart is None:
+            return
+        
+        self.trend_chart.load_viewport()
+        if self.trend_canvas is not None:
+            self.trend_canvas.draw_idle()
+    
+    @traced("charts.render.histogram")
+    def create_histogram_chart(self, prefetched=None):
         """Create a histogram showing distribution of iron levels."""
         self.chart_container.clear_widgets()
         
         try:
-            readings = self.db_manager.get_all_readings()
-            if not readings:
-                self.show_no_data_message()
-                return
-            
-            # Prepare data
-            levels = [reading['iron_level'] for reading in readings]
-            
-            # Get normal range
-            profile = self.db_manager.get_user_profile()
-            normal_min = profile.get('normal_range_min', 60)
-            normal_max = profile.get('normal_range_max', 170)
-            
-            # Create the plot
-            fig, ax = plt.subplots(figsize=(10, 6))
-            fig.patch.set_facecolor('#FAFAFA')
-            
-            # Create histogram
-            n_bins = min(15, len(levels) // 2 + 1) if len(levels) > 10 else 5
-            counts, bins, patches = ax.hist(levels, bins=n_bins, alpha=0.7, 
-                                          color='#2196F3', edgecolor='black')
-            
-            # Color bars based on normal range
-            for i, patch in enumerate(patches):
-                bin_center = (bins[i] + bins[i+1]) / 2
-                if bin_center < normal_min:
-                    patch.set_facecolor('#F44336')  # Red for low
-                elif bin_center > normal_max:
-                    patch.set_facecolor('#FF9800')  # Orange for high
-                else:
-                    patch.set_facecolor('#4CAF50')  # Green for normal
-            
-            # Add normal range indicators
-            ax.axvline(x=normal_min, color='green', linestyle='--', alpha=0.7, 
-                      label=f'Normal Range ({normal_min}-{normal_max} μg/dL)')
-            ax.axvline(x=normal_max, color='green', linestyle='--', alpha=0.7)
-            
-            # Formatting
-            ax.set_xlabel('Iron Level (μg/dL)', fontsize=12)
-            ax.set_ylabel('Frequency', fontsize=12)
-            ax.set_title('Distribution of Iron Levels', fontsize=14, fontweight='bold')
-            ax.grid(True, alpha=0.3, axis='y')
-            ax.legend()
-            
-            # Add statistics text
-            mean_level = np.mean(levels)
-            std_level = np.std(levels)
-            ax.text(0.02, 0.98, f'Mean: {mean_level:.1f} μg/dL\nStd Dev: {std_level:.1f} μg/dL', 
-                   transform=ax.transAxes, verticalalignment='top',
-                   bbox=dict(boxstyle='round', facecolor='white', alpha=0.8))
-            
-            # Adjust layout
-            fig.tight_layout()
-            
-            # Add to Kivy
-            canvas = FigureCanvasKivyAgg(fig)
-            self.chart_container.add_widget(canvas)
-            
+            if isinstance(prefetched, NoChartData):
+                raise prefetched
+            if prefetched is None:
+                prefetched = build_histogram_figure(self.db_manager)
+            self.show_figure(prefetched)
+        except NoChartData as e:
+            self.show_no_data_message(e.message)
         except Exception as e:
             print(f"Error creating histogram chart: {e}")
             self.show_error_message("Error creating histogram chart")
     
-    def create_monthly_chart(self):
+    @traced("charts.render.monthly")
+    def create_monthly_chart(self, prefetched=None):
         """Create a chart showing monthly average iron levels."""
         self.chart_container.clear_widgets()
         
         try:
-            readings = self.db_manager.get_all_readings()
-            if not readings:
-                self.show_no_data_message()
-                return
-            
-            # Group readings by month
-            monthly_data = {}
-            for reading in readings:
-                date_obj = datetime.strptime(reading['reading_date'], '%Y-%m-%d').date()
-                month_key = date_obj.replace(day=1)  # First day of month as key
-                
-                if month_key not in monthly_data:
-                    monthly_data[month_key] = []
-                monthly_data[month_key].append(reading['iron_level'])
-            
-            # Calculate monthly averages
-            months = sorted(monthly_data.keys())
-            averages = [np.mean(monthly_data[month]) for month in months]
-            
-            if len(months) < 2:
-                self.show_no_data_message("Need at least 2 months of data for monthly chart")
-                return
-            
-            # Get normal range
-            profile = self.db_manager.get_user_profile()
-            normal_min = profile.get('normal_range_min', 60)
-            normal_max = profile.get('normal_range_max', 170)
-            
-            # Create the plot
-            fig, ax = plt.subplots(figsize=(10, 6))
-            fig.patch.set_facecolor('#FAFAFA')
-            
-            # Plot monthly averages
-            bars = ax.bar(months, averages, alpha=0.7, color='#9C27B0', 
-                         edgecolor='black', linewidth=1)
-            
-            # Color bars based on normal range
-            for i, (month, avg) in enumerate(zip(months, averages)):
-                if avg < normal_min:
-                    bars[i].set_facecolor('#F44336')  # Red for low
-                elif avg > normal_max:
-                    bars[i].set_facecolor('#FF9800')  # Orange for high
-                else:
-                    bars[i].set_facecolor('#4CAF50')  # Green for normal
-            
-            # Add normal range indicators
-            ax.axhspan(normal_min, normal_max, alpha=0.2, color='green', 
-                      label=f'Normal Range ({normal_min}-{normal_max} μg/dL)')
-            ax.axhline(y=normal_min, color='green', linestyle='--', alpha=0.5)
-            ax.axhline(y=normal_max, color='green', linestyle='--', alpha=0.5)
-            
-            # Formatting
-            ax.set_xlabel('Month', fontsize=12)
-            ax.set_ylabel('Average Iron Level (μg/dL)', fontsize=12)
-            ax.set_title('Monthly Average Iron Levels', fontsize=14, fontweight='bold')
-            ax.grid(True, alpha=0.3, axis='y')
-            ax.legend()
-            
-            # Format dates on x-axis
-            ax.xaxis.set_major_formatter(mdates.DateFormatter('%b %Y'))
-            plt.setp(ax.xaxis.get_majorticklabels(), rotation=45)
-            
-            # Adjust layout
-            fig.tight_layout()
-            
-            # Add to Kivy
-            canvas = FigureCanvasKivyAgg(fig)
-            self.chart_container.add_widget(canvas)
-            
+            if isinstance(prefetched, NoChartData):
+                raise prefetched
+            if prefetched is None:
+                prefetched = build_monthly_figure(self.db_manager)
+            self.show_figure(prefetched)
+        except NoChartData as e:
+            self.show_no_data_message(e.message)
         except Exception as e:
             print(f"Error creating monthly chart: {e}")
             self.show_error_message("Error creating monthly chart")
@@ -1,16 +1,70 @@
 from kivymd.uix.screen import MDScreen
 from kivymd.uix.boxlayout import MDBoxLayout
-from kivymd.uix.scrollview import MDScrollView
+from kivymd.uix.floatlayout import MDFloatLayout
 from kivymd.uix.card import MDCard
 from kivymd.uix.label import MDLabel
-from kivymd.uix.button import MDIconButton, MDFlatButton
+from kivymd.uix.button import MDFlatButton
 from kivymd.uix.textfield import MDTextField
-from kivymd.uix.list import MDList, TwoLineAvatarIconListItem, IconLeftWidget, IconRightWidget
+from kivymd.uix.list import TwoLineAvatarIconListItem, IconLeftWidget, IconRightWidget
 from kivymd.uix.dialog import MDDialog
 from kivymd.uix.snackbar import Snackbar
 from kivy.metrics import dp
-from datetime import datetime, date, timedelta
-import calendar
+from kivy.clock import Clock
+from kivy.properties import NumericProperty, StringProperty, ObjectProperty
+from kivy.uix.recycleview import RecycleView
+from kivy.uix.recycleboxlayout import RecycleBoxLayout
+
+from analytics.tracing import traced
+from database.anomalies import anomaly_label
+from database.derived import DERIVED_BY_TYPE, test_type_unit
+from database.reading_filter import ReadingFilter
+from database.reading_store import ReadingStore, reading_timestamp
+from database.tags import HASHTAG_PATTERN, normalize_tag
+import numpy as np
+from contextlib import contextmanager
+
+
+# Delay after the last keystroke before a search starts
+SEARCH_DEBOUNCE = 0.25
+# Readings scanned, and matches added to the list, per frame
+SEARCH_BATCH_SIZE = 500
+# Height of a row in the readings list
+ROW_HEIGHT = dp(72)
+# Status icon color for each level class
+CLASS_COLORS = {"low": "red", "normal": "green", "high": "orange"}
+
+
+class ReadingListItem(TwoLineAvatarIconListItem):
+    """Recycled list row for a single reading, configured from a RecycleView data dict."""
+    
+    reading_id = NumericProperty(0)
+    timestamp = NumericProperty(0)
+    status_color = StringProperty("green")
+    delete_callback = ObjectProperty(None, allownone=True)
+    
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.status_icon = IconLeftWidget(
+            icon="water",
+            theme_icon_color="Custom",
+            icon_color=self.status_color
+        )
+        self.delete_icon = IconRightWidget(
+            icon="delete",
+            theme_icon_color="Custom",
+            icon_color="red",
+            on_release=self.on_delete_release
+        )
+        self.add_widget(self.status_icon)
+        self.add_widget(self.delete_icon)
+    
+    def on_status_color(self, instance, value):
+        if hasattr(self, 'status_icon'):
+            self.status_icon.icon_color = value
+    
+    def on_delete_release(self, instance):
+        if self.delete_callback is not None:
+            self.delete_callback(self.reading_id)
 
 
 class HistoryScreen(MDScreen):
@@ -19,10 +73,22 @@ class HistoryScreen(MDScreen):
     def __init__(self, db_manager, **kwargs):
         super().__init__(**kwargs)
         self.db_manager = db_manager
-        self.all_readings = []
-        self.filtered_readings = []
+        self.store = ReadingStore()
+        self.anomaly_flags = {}  # reading id -> flags, for flagged readings only
+        self.data_loaded = False
+        self.active_filter = None  # ReadingFilter behind the displayed list, None for all
+        self.stats = None
         self.delete_dialog = None
+        self.pending_delete_id = None
+        
+        # Incremental search state
+        self.pending_query = ""
+        self.search_event = None
+        self.last_search = None  # (query, matching store positions) of the last completed search
+        self._search_trigger = Clock.create_trigger(self.start_search, SEARCH_DEBOUNCE)
+        
         self.build_ui()
+        self.db_manager.add_change_listener(self.on_reading_change)
     
     def build_ui(self):
         """Build the user interface for the history screen."""
@@ -77,7 +143,7 @@ class HistoryScreen(MDScreen):
         
         # Search field
         self.search_field = MDTextField(
-            hint_text="Search readings...",
+            hint_text="Search readings or #tag...",
             mode="outlined",
             size_hint_y=None,
             height=dp(56),
@@ -118,175 +184,382 @@ class HistoryScreen(MDScreen):
         filter_buttons_layout.add_widget(month_button)
         filter_buttons_layout.add_widget(year_button)
         
+        for level_class in ("low", "high"):
+            filter_buttons_layout.add_widget(MDFlatButton(
+                text=level_class.capitalize(),
+                on_release=lambda x, level_class=level_class: self.filter_by_class(level_class)
+            ))
+        
         filter_card.add_widget(self.search_field)
         filter_card.add_widget(filter_buttons_layout)
         
-        # Readings list
-        self.readings_scroll = MDScrollView()
-        self.readings_list = MDList()
-        self.readings_scroll.add_widget(self.readings_list)
+        # Readings list; only enough rows to fill the screen are ever created
+        readings_area = MDFloatLayout()
+        
+        self.readings_view = RecycleView(
+            viewclass=ReadingListItem,
+            pos_hint={"x": 0, "y": 0},
+            size_hint=(1, 1)
+        )
+        readings_layout = RecycleBoxLayout(
+            orientation="vertical",
+            default_size=(None, ROW_HEIGHT),
+            default_size_hint=(1, None),
+            size_hint_y=None
+        )
+        readings_layout.bind(minimum_height=readings_layout.setter('height'))
+        self.readings_view.add_widget(readings_layout)
+        
+        self.empty_label = MDLabel(
+            text="No readings found",
+            theme_text_color="Secondary",
+            halign="center",
+            pos_hint={"center_x": 0.5, "top": 1},
+            size_hint_y=None,
+            height=dp(100),
+            opacity=0
+        )
+        
+        readings_area.add_widget(self.readings_view)
+        readings_area.add_widget(self.empty_label)
         
         # Add widgets to main layout
         main_layout.add_widget(header_card)
         main_layout.add_widget(filter_card)
-        main_layout.add_widget(self.readings_scroll)
+        main_layout.add_widget(readings_area)
         
         self.add_widget(main_layout)
     
-    def refresh_data(self):
-        """Refresh the readings data and update the display."""
+    @traced("history.refresh")
+    def refresh_data(self, force=False):
+        """Refresh the readings data and update the display.
+        
+        Adds and deletes are applied incrementally as they happen, so a full
+        reload is only needed the first time or after the profile changed.
+        """
+        if self.data_loaded and not force:
+            return
         self.load_readings()
         self.update_statistics()
-        self.update_readings_list()
+        self.update_readings_list(self.newest_readings())
+        self.data_loaded = True
     
     def load_readings(self):
-        """Load all readings from the database."""
+        """Attach to the shared reading store, which DatabaseManager keeps in sync."""
         try:
-            self.all_readings = self.db_manager.get_all_readings()
-            self.filtered_readings = self.all_readings.copy()
+            self.store = self.db_manager.get_reading_store()
         except Exception as e:
             print(f"Error loading readings: {e}")
-            self.all_readings = []
-            self.filtered_readings = []
+            self.store = ReadingStore()
+        self.anomaly_flags = self.db_manager.get_anomaly_flags()
+        self.active_filter = None
+        self.cancel_search()
+        self.last_search = None
+    
+    def newest_readings(self, positions=None):
+        """Materialize store rows newest first, one at a time as the list is built."""
+        if positions is None:
+            positions = range(len(self.store) - 1, -1, -1)
+        return (self.store.row(position) for position in positions)
     
     def update_statistics(self):
         """Update the statistics display."""
         try:
-            if not self.all_readings:
+            if not len(self.store):
+                self.stats = None
                 self.stats_label.text = "No readings found"
                 return
             
             stats = self.db_manager.get_statistics()
-            total = stats.get('total_readings', 0)
-            avg = stats.get('average_level', 0)
             
-            if avg:
-                avg_text = f"{avg:.1f} μg/dL"
-            else:
-                avg_text = "N/A"
-            
-            normal_count = stats.get('normal_readings', 0)
-            low_count = stats.get('low_readings', 0)
-            high_count = stats.get('high_readings', 0)
-            
-            self.stats_label.text = (
-                f"Total Readings: {total}  •  Average: {avg_text}\n"
-                f"Normal: {normal_count}  •  Low: {low_count}  •  High: {high_count}"
-            )
+            # Keep running totals so single adds and deletes can adjust them;
+            # levels are summed per native test type, as their units differ
+            levels = {}
+            for test_type in self.store.test_types:
+                if test_type in DERIVED_BY_TYPE:
+                    continue
+                running = self.db_manager.get_running_stats(test_type)
+                if running.count:
+                    levels[test_type] = [running.count, running.mean * running.count]
+            self.stats = {
+                'total': stats.get('total_readings', 0),
+                'levels': levels,
+                'normal': stats.get('normal_readings') or 0,
+                'low': stats.get('low_readings') or 0,
+                'high': stats.get('high_readings') or 0,
+            }
+            self.render_statistics()
             
         except Exception as e:
             print(f"Error updating statistics: {e}")
             self.stats_label.text = "Error loading statistics"
     
-    def update_readings_list(self):
-        """Update the readings list display."""
-        self.readings_list.clear_widgets()
-        
-        if not self.filtered_readings:
-            no_data_label = MDLabel(
-                text="No readings found",
-                theme_text_color="Secondary",
-                halign="center",
-                size_hint_y=None,
-                height=dp(100)
-            )
-            self.readings_list.add_widget(no_data_label)
+    def render_statistics(self):
+        """Show the running statistics totals."""
+        stats = self.stats
+        if not stats or not stats['total']:
+            self.stats_label.text = "No readings found"
             return
         
-        # Get normal range for color coding
-        profile = self.db_manager.get_user_profile()
-        normal_min = profile.get('normal_range_min', 60)
-        normal_max = profile.get('normal_range_max', 170)
-        
-        for reading in self.filtered_readings:
-            # Determine color based on iron level
-            iron_level = reading['iron_level']
-            if iron_level < normal_min:
-                icon_color = "red"
-                status = "Low"
-            elif iron_level > normal_max:
-                icon_color = "orange"
-                status = "High"
-            else:
-                icon_color = "green"
-                status = "Normal"
-            
-            # Format the reading item
-            primary_text = f"{iron_level} μg/dL - {status}"
-            secondary_text = f"{reading['reading_date']} at {reading['reading_time']}"
-            
-            if reading.get('notes'):
-                secondary_text += f" • {reading['notes'][:30]}..."
-            
-            list_item = TwoLineAvatarIconListItem(
-                text=primary_text,
-                secondary_text=secondary_text,
-                IconLeftWidget(
-                    icon="water",
-                    theme_icon_color="Custom",
-                    icon_color=icon_color
-                ),
-                IconRightWidget(
-                    icon="delete",
-                    theme_icon_color="Custom",
-                    icon_color="red",
-                    on_release=lambda x, reading_id=reading['id']: self.confirm_delete(reading_id)
-                )
-            )
-            
-            self.readings_list.add_widget(list_item)
+        # Average the most tested type, naming it when there are others
+        levels = {test_type: totals for test_type, totals in stats['levels'].items() if totals[0]}
+        if levels:
+            test_type = max(levels, key=lambda name: levels[name][0])
+            count, level_sum = levels[test_type]
+            avg_text = f"{level_sum / count:.1f} {test_type_unit(test_type)}"
+            if len(levels) > 1:
+                avg_text += f" ({test_type})"
+        else:
+            avg_text = "N/A"
+        
+        self.stats_label.text = (
+            f"Total Readings: {stats['total']}  •  Average: {avg_text}\n"
+            f"Normal: {stats['normal']}  •  Low: {stats['low']}  •  High: {stats['high']}"
+        )
+    
+    def adjust_statistics(self, reading, sign):
+        """Add (sign=1) or remove (sign=-1) a reading from the running statistics."""
+        if self.stats is None:
+            self.update_statistics()
+            return
+        
+        # Derived readings are left out of the statistics
+        if reading.get('test_type') in DERIVED_BY_TYPE:
+            return
+        
+        stats = self.stats
+        stats['total'] += sign
+        totals = stats['levels'].setdefault(reading.get('test_type'), [0, 0.0])
+        totals[0] += sign
+        totals[1] += sign * reading['iron_level']
+        stats[reading.get('level_class') or "normal"] += sign
+        self.render_statistics()
+    
+    def update_readings_list(self, readings):
+        """Show the given readings, newest first, in the list."""
+        self.readings_view.data = [self.reading_row(reading) for reading in readings]
+        self.empty_label.opacity = 0 if self.readings_view.data else 1
+    
+    def reading_row(self, reading):
+        """Build the RecycleView data dict for a reading."""
+        # Determine color from the class stored with the reading
+        iron_level = reading['iron_level']
+        level_class = reading.get('level_class') or "normal"
+        icon_color = CLASS_COLORS[level_class]
+        status = level_class.capitalize()
+        
+        # Format the reading item
+        primary_text = f"{iron_level} {test_type_unit(reading.get('test_type'))} - {status}"
+        secondary_text = f"{reading['reading_date']} at {reading['reading_time']}"
+        
+        flags = self.anomaly_flags.get(reading['id'])
+        if flags:
+            secondary_text = f"⚠ {anomaly_label(flags)} • {secondary_text}"
+        
+        if reading.get('notes'):
+            secondary_text += f" • {reading['notes'][:30]}..."
+        
+        return {
+            'text': primary_text,
+            'secondary_text': secondary_text,
+            'status_color': icon_color,
+            'reading_id': reading['id'],
+            'timestamp': reading_timestamp(reading['reading_date'], reading['reading_time']),
+            'delete_callback': self.confirm_delete,
+        }
+    
+    def search_mask(self, query, positions):
+        """Vectorized match of a query against the readings at the given store positions.
+        
+        Level and date are matched as text; notes and test types are matched once
+        per distinct value in the store's interned tables and looked up by code.
+        """
+        store = self.store
+        level_date = np.char.add(
+            np.char.add(store.levels[positions].astype(str), " "),
+            store.date_strings(positions)
+        )
+        note_hits = np.array([query in note.lower() for note in store.notes], dtype=bool)
+        type_hits = np.array([query in test_type.lower() for test_type in store.test_types] or [False],
+                             dtype=bool)
+        return (
+            (np.char.find(level_date, query) >= 0)
+            | note_hits[store.note_codes[positions]]
+            | type_hits[store.type_codes[positions]]
+        )
     
     def on_search_text_change(self, instance, text):
-        """Handle search text changes."""
-        if not text.strip():
-            self.filtered_readings = self.all_readings.copy()
+        """Handle search text changes, restarting the debounce timer on every keystroke."""
+        self.pending_query = text.lower().strip()
+        self.cancel_search()
+        self._search_trigger.cancel()
+        self._search_trigger()
+    
+    def cancel_search(self):
+        """Stop a search that is still being applied in batches."""
+        if self.search_event is not None:
+            self.search_event.cancel()
+            self.search_event = None
+    
+    def start_search(self, *args):
+        """Start scanning for the pending query, refining the previous results when possible."""
+        self.cancel_search()
+        query = self.pending_query
+        
+        if not query:
+            self.last_search = None
+            self.active_filter = None
+            self.update_readings_list(self.newest_readings())
+            return
+        
+        # "#tag" looks the tag up in the tag index instead of scanning notes
+        if HASHTAG_PATTERN.fullmatch(query):
+            self.last_search = None
+            reading_filter = ReadingFilter(tags=(normalize_tag(query),))
+            self.active_filter = reading_filter
+            self.update_readings_list(self.db_manager.get_filtered_readings(reading_filter))
+            return
+        
+        # A longer query can only match a subset of what the shorter one matched
+        if self.last_search is not None and query.startswith(self.last_search[0]):
+            candidates = self.last_search[1]
         else:
-            search_term = text.lower().strip()
-            self.filtered_readings = []
-            
-            for reading in self.all_readings:
-                # Search in multiple fields
-                searchable_text = " ".join([
-                    str(reading.get('iron_level', '')),
-                    str(reading.get('reading_date', '')),
-                    str(reading.get('notes', '')),
-                    str(reading.get('test_type', ''))
-                ]).lower()
-                
-                if search_term in searchable_text:
-                    self.filtered_readings.append(reading)
-        
-        self.update_readings_list()
+            candidates = np.arange(len(self.store) - 1, -1, -1)
+        
+        self.active_filter = None
+        self.readings_view.data = []
+        self.empty_label.opacity = 0
+        
+        state = {'query': query, 'candidates': candidates, 'offset': 0, 'matches': []}
+        self.search_event = Clock.schedule_interval(lambda dt: self.search_step(state), 0)
+    
+    def search_step(self, state):
+        """Scan one batch of candidates and append its matches to the list."""
+        offset = state['offset']
+        batch = state['candidates'][offset:offset + SEARCH_BATCH_SIZE]
+        state['offset'] = offset + SEARCH_BATCH_SIZE
+        matches = batch[self.search_mask(state['query'], batch)] if len(batch) else batch
+        
+        if len(matches):
+            state['matches'].append(matches)
+            self.readings_view.data.extend(
+                self.reading_row(reading)
+                for reading in self.newest_readings(matches)
+            )
+        
+        if len(batch) < SEARCH_BATCH_SIZE:
+            # Finished; only complete results may seed the next refinement
+            self.search_event = None
+            matched = np.concatenate(state['matches']) if state['matches'] else batch
+            self.last_search = (state['query'], matched)
+            self.empty_label.opacity = 0 if self.readings_view.data else 1
+            return False
+        return True
     
     def filter_readings(self, filter_type):
-        """Filter readings by time period."""
-        today = date.today()
-        
-        if filter_type == "all":
-            self.filtered_readings = self.all_readings.copy()
-        elif filter_type == "week":
-            start_date = today - timedelta(days=7)
-            self.filtered_readings = [
-                reading for reading in self.all_readings
-                if datetime.strptime(reading['reading_date'], '%Y-%m-%d').date() >= start_date
-            ]
-        elif filter_type == "month":
-            start_date = today.replace(day=1)
-            self.filtered_readings = [
-                reading for reading in self.all_readings
-                if datetime.strptime(reading['reading_date'], '%Y-%m-%d').date() >= start_date
-            ]
-        elif filter_type == "year":
-            start_date = today.replace(month=1, day=1)
-            self.filtered_readings = [
-                reading for reading in self.all_readings
-                if datetime.strptime(reading['reading_date'], '%Y-%m-%d').date() >= start_date
-            ]
-        
-        self.update_readings_list()
+        """Filter readings by time period, taking the whole period from the reading store."""
+        self.cancel_search()
+        
+        try:
+            reading_filter = ReadingFilter.for_period(filter_type)
+        except ValueError as e:
+            print(f"Error filtering readings: {e}")
+            return
+        
+        first = 0
+        if reading_filter.start_date is not None:
+            first = self.store.between(reading_timestamp(reading_filter.start_date), np.inf).start
+        self.active_filter = reading_filter
+        self.update_readings_list(self.newest_readings(range(len(self.store) - 1, first - 1, -1)))
+    
+    def filter_by_class(self, level_class):
+        """Show only low or high readings, using the precomputed class index."""
+        self.cancel_search()
+        reading_filter = ReadingFilter(level_classes=(level_class,))
+        readings = self.db_manager.get_filtered_readings(reading_filter)
+        self.active_filter = reading_filter
+        self.update_readings_list(readings)
+    
+    def on_reading_change(self, event, reading):
+        """Apply a single added or deleted reading to the displayed data.
+        
+        The shared store has already been updated by DatabaseManager.
+        """
+        if not self.data_loaded:
+            return
+        if event in ("profile", "patient"):
+            # Readings were reclassified or belong to another patient; statistics
+            # and colors need a full refresh
+            self.data_loaded = False
+            return
+        
+        # A delete or backdated add can re-score other readings of the same test type
+        self.anomaly_flags = self.db_manager.get_anomaly_flags()
+        
+        # Store positions shift, so a running search has to start over
+        # and the previous one cannot be refined
+        search_running = self.search_event is not None
+        self.cancel_search()
+        self.last_search = None
+        
+        if event == "add":
+            if not search_running and self.matches_view(reading):
+                self.insert_row(reading)
+            self.adjust_statistics(reading, 1)
+        elif event == "delete":
+            if not search_running:
+                self.remove_row(reading['id'])
+            self.adjust_statistics(reading, -1)
+        
+        if search_running:
+            self.start_search()
+    
+    def matches_view(self, reading):
+        """Check whether a new reading belongs in the currently displayed list."""
+        if self.pending_query and self.active_filter is None:
+            position = self.store.position(reading['id'])
+            if position is None or not self.search_mask(self.pending_query, [position])[0]:
+                return False
+        elif self.active_filter is not None and not self.active_filter.matches(reading):
+            return False
+        return True
+    
+    def insert_row(self, reading):
+        """Insert one row into the list without rebuilding the others."""
+        row = self.reading_row(reading)
+        rows = self.readings_view.data
+        position = next(
+            (i for i, existing in enumerate(rows) if existing['timestamp'] <= row['timestamp']),
+            len(rows)
+        )
+        with self.preserved_scroll(1):
+            rows.insert(position, row)
+        self.empty_label.opacity = 0
+    
+    def remove_row(self, reading_id):
+        """Remove one row from the list without rebuilding the others."""
+        rows = self.readings_view.data
+        for position, existing in enumerate(rows):
+            if existing['reading_id'] == reading_id:
+                with self.preserved_scroll(-1):
+                    del rows[position]
+                break
+        self.empty_label.opacity = 0 if rows else 1
+    
+    @contextmanager
+    def preserved_scroll(self, row_delta):
+        """Keep the same content under the top of the list while rows are added or removed."""
+        view = self.readings_view
+        old_scrollable = view.children[0].height - view.height if view.children else 0
+        offset = (1 - view.scroll_y) * old_scrollable if old_scrollable > 0 else 0
+        yield
+        new_scrollable = old_scrollable + row_delta * ROW_HEIGHT
+        if new_scrollable > 0:
+            view.scroll_y = min(max(1 - offset / new_scrollable, 0), 1)
     
     def confirm_delete(self, reading_id):
         """Show confirmation dialog for deleting a reading."""
+        self.pending_delete_id = reading_id
         if not self.delete_dialog:
             self.delete_dialog = MDDialog(
                 title="Delete Reading",
@@ -300,13 +573,10 @@ class HistoryScreen(MDScreen):
                         text="DELETE",
                         theme_text_color="Custom",
                         text_color="red",
-                        on_release=lambda x: self.delete_reading(reading_id)
+                        on_release=lambda x: self.delete_reading(self.pending_delete_id)
                     ),
                 ],
             )
-        else:
-            # Update the dialog for the new reading ID
-            self.delete_dialog.buttons[1].on_release = lambda x: self.delete_reading(reading_id)
         
         self.delete_dialog.open()
     
@@ -316,12 +586,11 @@ class HistoryScreen(MDScreen):
             self.delete_dialog.dismiss()
     
     def delete_reading(self, reading_id):
-        """Delete the specified reading."""
+        """Delete the specified reading; the list is updated through on_reading_change."""
         try:
             success = self.db_manager.delete_reading(reading_id)
             if success:
                 self.show_snackbar("Reading deleted successfully")
-                self.refresh_data()
             else:
                 self.show_snackbar("Error deleting reading")
         except Exception as e:
@@ -10,6 +10,7 @@ from kivymd.uix.snackbar import Snackbar
 from kivymd.uix.pickers import MDDatePicker, MDTimePicker
 from kivy.metrics import dp
 from datetime import datetime, date
+from database.derived import test_type_unit
 import re
 
 
@@ -22,6 +23,7 @@ class InputScreen(MDScreen):
         self.selected_date = date.today()
         self.selected_time = datetime.now().strftime("%H:%M")
         self.build_ui()
+        self.db_manager.add_change_listener(self.on_reading_change)
     
     def build_ui(self):
         """Build the user interface for the input screen."""
@@ -214,6 +216,14 @@ class InputScreen(MDScreen):
         """Set the selected test type."""
         self.test_type_field.text = test_type
         self.test_type_menu.dismiss()
+        self.update_level_hint(test_type)
+    
+    def update_level_hint(self, test_type):
+        """Show the unit and normal range of the selected test type."""
+        unit = test_type_unit(test_type)
+        normal_min, normal_max = self.db_manager.get_normal_range(test_type)
+        self.iron_level_field.hint_text = f"Enter level ({unit})"
+        self.iron_level_field.helper_text = f"Normal range: {normal_min:g}-{normal_max:g} {unit}"
     
     def open_date_picker(self, instance):
         """Open date picker dialog."""
@@ -282,17 +292,24 @@ class InputScreen(MDScreen):
         self.date_field.text = self.selected_date.strftime("%Y-%m-%d")
         self.time_field.text = self.selected_time
         self.test_type_field.text = "Serum Iron"
+        self.update_level_hint("Serum Iron")
     
     def load_recent_readings(self):
         """Load and display recent readings."""
         try:
-            recent_readings = self.db_manager.get_recent_readings(3)
+            recent_readings = self.db_manager.get_recent_reading_metrics(3)
             if recent_readings:
                 readings_text = ""
                 for reading in recent_readings:
                     date_str = reading['reading_date']
                     level = reading['iron_level']
-                    readings_text += f"• {date_str}: {level} μg/dL\n"
+                    unit = test_type_unit(reading['test_type'])
+                    readings_text += f"• {date_str}: {level} {unit}"
+                    # Change since the previous test of the same type
+                    if reading['delta'] is not None:
+                        readings_text += (f" ({reading['delta']:+.1f} in "
+                                          f"{reading['days_since_previous']:.0f} days)")
+                    readings_text += "\n"
                 self.recent_readings_label.text = readings_text.strip()
             else:
                 self.recent_readings_label.text = "No recent readings found"
@@ -300,6 +317,11 @@ class InputScreen(MDScreen):
             self.recent_readings_label.text = "Error loading recent readings"
             print(f"Error loading recent readings: {e}")
     
+    def on_reading_change(self, event, reading):
+        """Reload the recent readings after a delete elsewhere or a patient switch."""
+        if event in ("delete", "patient"):
+            self.load_recent_readings()
+    
     def show_snackbar(self, message):
         """Show a snackbar with the given message."""
         snackbar = Snackbar(text=message, duration=3)
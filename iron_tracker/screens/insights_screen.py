@@ -6,10 +6,16 @@ from kivymd.uix.label import MDLabel
 from kivymd.uix.button import MDRaisedButton, MDFlatButton
 from kivymd.uix.textfield import MDTextField
 from kivymd.uix.dialog import MDDialog
+from kivymd.uix.list import MDList, OneLineListItem
 from kivymd.uix.snackbar import Snackbar
+from kivymd.app import MDApp
 from kivy.metrics import dp
-from datetime import datetime, date, timedelta
-import statistics
+from kivy.uix.scrollview import ScrollView
+
+from analytics.insights import InsightsEngine
+from analytics.tracing import traced
+from database.anomalies import ANOMALY_OUTLIER, anomaly_label
+from database.window_metrics import ROLLING_WINDOW_DAYS
 
 
 class InsightsScreen(MDScreen):
@@ -18,8 +24,12 @@ class InsightsScreen(MDScreen):
     def __init__(self, db_manager, **kwargs):
         super().__init__(**kwargs)
         self.db_manager = db_manager
+        self.engine = InsightsEngine(db_manager)
         self.profile_dialog = None
+        self.patient_dialog = None
+        self.range_dialog = None
         self.build_ui()
+        db_manager.add_change_listener(self.on_reading_change)
     
     def build_ui(self):
         """Build the user interface for the insights screen."""
@@ -76,16 +86,28 @@ class InsightsScreen(MDScreen):
             height=dp(40)
         )
         
-        update_profile_button = MDFlatButton(
-            text="Update Profile",
-            on_release=self.open_profile_dialog,
+        profile_buttons = MDBoxLayout(
+            orientation="horizontal",
+            spacing=dp(10),
             size_hint_y=None,
             height=dp(40)
         )
+        profile_buttons.add_widget(MDFlatButton(
+            text="Update Profile",
+            on_release=self.open_profile_dialog
+        ))
+        profile_buttons.add_widget(MDFlatButton(
+            text="Switch Patient",
+            on_release=self.open_patient_dialog
+        ))
+        profile_buttons.add_widget(MDFlatButton(
+            text="Reference Ranges",
+            on_release=self.open_range_dialog
+        ))
         
         self.profile_card.add_widget(profile_title)
         self.profile_card.add_widget(self.profile_info_label)
-        self.profile_card.add_widget(update_profile_button)
+        self.profile_card.add_widget(profile_buttons)
         
         # Current status section
         self.status_card = MDCard(
@@ -95,7 +117,7 @@ class InsightsScreen(MDScreen):
             elevation=2,
             radius=[10],
             size_hint_y=None,
-            height=dp(150)
+            height=dp(210)
         )
         
         status_title = MDLabel(
@@ -112,7 +134,7 @@ class InsightsScreen(MDScreen):
             font_style="Body2",
             text_size=(None, None),
             size_hint_y=None,
-            height=dp(100)
+            height=dp(160)
         )
         
         self.status_card.add_widget(status_title)
@@ -126,7 +148,7 @@ class InsightsScreen(MDScreen):
             elevation=2,
             radius=[10],
             size_hint_y=None,
-            height=dp(200)
+            height=dp(390)
         )
         
         trends_title = MDLabel(
@@ -143,7 +165,7 @@ class InsightsScreen(MDScreen):
             font_style="Body2",
             text_size=(None, None),
             size_hint_y=None,
-            height=dp(150)
+            height=dp(340)
         )
         
         self.trends_card.add_widget(trends_title)
@@ -211,6 +233,43 @@ class InsightsScreen(MDScreen):
         education_card.add_widget(education_title)
         education_card.add_widget(education_content)
         
+        # Diagnostics section, for timing reports from real devices
+        diagnostics_card = MDCard(
+            orientation="vertical",
+            padding=dp(15),
+            spacing=dp(10),
+            elevation=1,
+            radius=[10],
+            size_hint_y=None,
+            height=dp(100)
+        )
+        
+        diagnostics_title = MDLabel(
+            text="Diagnostics",
+            theme_text_color="Primary",
+            font_style="H6",
+            size_hint_y=None,
+            height=dp(30)
+        )
+        
+        diagnostics_buttons = MDBoxLayout(
+            orientation="horizontal",
+            spacing=dp(10),
+            size_hint_y=None,
+            height=dp(40)
+        )
+        diagnostics_buttons.add_widget(MDFlatButton(
+            text="Timing Overlay",
+            on_release=self.toggle_debug_overlay
+        ))
+        diagnostics_buttons.add_widget(MDFlatButton(
+            text="Save Timings",
+            on_release=self.save_trace
+        ))
+        
+        diagnostics_card.add_widget(diagnostics_title)
+        diagnostics_card.add_widget(diagnostics_buttons)
+        
         # Add all cards to content layout
         content_layout.add_widget(title)
         content_layout.add_widget(self.profile_card)
@@ -218,222 +277,187 @@ class InsightsScreen(MDScreen):
         content_layout.add_widget(self.trends_card)
         content_layout.add_widget(self.recommendations_card)
         content_layout.add_widget(education_card)
+        content_layout.add_widget(diagnostics_card)
         
         scroll.add_widget(content_layout)
         main_layout.add_widget(scroll)
         self.add_widget(main_layout)
     
+    @traced("insights.refresh")
     def refresh_insights(self):
-        """Refresh all insights and recommendations."""
-        self.update_profile_display()
-        self.analyze_current_status()
-        self.analyze_trends()
-        self.generate_recommendations()
-    
-    def update_profile_display(self):
-        """Update the profile information display."""
+        """Refresh all insights and recommendations from a single engine run."""
         try:
-            profile = self.db_manager.get_user_profile()
-            if profile:
-                age = profile.get('age', 'Not set')
-                gender = profile.get('gender', 'Not set').title()
-                normal_min = profile.get('normal_range_min', 60)
-                normal_max = profile.get('normal_range_max', 170)
-                
-                self.profile_info_label.text = (
-                    f"Age: {age}  •  Gender: {gender}\n"
-                    f"Normal Range: {normal_min}-{normal_max} μg/dL"
-                )
-            else:
-                self.profile_info_label.text = "Profile not set up"
+            result = self.engine.run()
         except Exception as e:
-            print(f"Error updating profile display: {e}")
+            print(f"Error computing insights: {e}")
             self.profile_info_label.text = "Error loading profile"
+            self.status_label.text = "Error analyzing current status"
+            self.trends_label.text = "Error analyzing trends"
+            self.recommendations_label.text = "Error generating recommendations"
+            return
+        
+        self.update_profile_display(result)
+        self.show_current_status(result)
+        self.show_trends(result)
+        self.show_recommendations(result)
     
-    def analyze_current_status(self):
-        """Analyze current iron level status."""
-        try:
-            recent_readings = self.db_manager.get_recent_readings(5)
-            if not recent_readings:
-                self.status_label.text = "No readings available for analysis"
-                return
-            
-            latest_reading = recent_readings[0]
-            iron_level = latest_reading['iron_level']
-            reading_date = latest_reading['reading_date']
-            
-            profile = self.db_manager.get_user_profile()
-            normal_min = profile.get('normal_range_min', 60)
-            normal_max = profile.get('normal_range_max', 170)
-            
-            # Determine status
-            if iron_level < normal_min:
-                status = "LOW"
-                status_color = "🔴"
-                interpretation = "Your iron level is below normal range"
-            elif iron_level > normal_max:
-                status = "HIGH"
-                status_color = "🟠"
-                interpretation = "Your iron level is above normal range"
-            else:
-                status = "NORMAL"
-                status_color = "🟢"
-                interpretation = "Your iron level is within normal range"
-            
-            # Calculate days since last reading
-            days_ago = (date.today() - datetime.strptime(reading_date, '%Y-%m-%d').date()).days
-            
-            if days_ago == 0:
-                time_text = "today"
-            elif days_ago == 1:
-                time_text = "yesterday"
-            else:
-                time_text = f"{days_ago} days ago"
-            
-            self.status_label.text = (
-                f"{status_color} Latest Reading: {iron_level} μg/dL ({time_text})\n"
-                f"Status: {status}\n"
-                f"{interpretation}\n"
-                f"Normal range: {normal_min}-{normal_max} μg/dL"
+    def update_profile_display(self, result):
+        """Update the profile information display."""
+        profile = result.profile
+        if profile:
+            age = profile.get('age', 'Not set')
+            gender = (profile.get('gender') or 'Not set').title()
+            name = self.db_manager.get_current_patient().get('name', '')
+            
+            self.profile_info_label.text = (
+                f"{name}  •  Age: {age}  •  Gender: {gender}\n"
+                f"Normal Range: {result.normal_min}-{result.normal_max} {result.unit}"
             )
-            
-        except Exception as e:
-            print(f"Error analyzing current status: {e}")
-            self.status_label.text = "Error analyzing current status"
+        else:
+            self.profile_info_label.text = "Profile not set up"
     
-    def analyze_trends(self):
-        """Analyze iron level trends and patterns."""
-        try:
-            # Get readings from last 3 months
-            three_months_ago = date.today() - timedelta(days=90)
-            recent_readings = self.db_manager.get_readings_by_date_range(three_months_ago, date.today())
-            
-            if len(recent_readings) < 3:
-                self.trends_label.text = "Need at least 3 readings for trend analysis"
-                return
-            
-            # Extract iron levels and dates
-            levels = [reading['iron_level'] for reading in recent_readings]
-            dates = [datetime.strptime(reading['reading_date'], '%Y-%m-%d').date() for reading in recent_readings]
-            
-            # Calculate trend
-            if len(levels) >= 3:
-                recent_levels = levels[-3:]
-                if recent_levels[-1] > recent_levels[0]:
-                    trend = "INCREASING 📈"
-                elif recent_levels[-1] < recent_levels[0]:
-                    trend = "DECREASING 📉"
-                else:
-                    trend = "STABLE ➡️"
-            else:
-                trend = "INSUFFICIENT DATA"
-            
-            # Calculate statistics
-            avg_level = statistics.mean(levels)
-            std_dev = statistics.stdev(levels) if len(levels) > 1 else 0
-            min_level = min(levels)
-            max_level = max(levels)
-            
-            # Calculate variability
-            if std_dev < 10:
-                variability = "Low variability (stable)"
-            elif std_dev < 20:
-                variability = "Moderate variability"
-            else:
-                variability = "High variability (fluctuating)"
-            
-            # Get normal range for comparison
-            profile = self.db_manager.get_user_profile()
-            normal_min = profile.get('normal_range_min', 60)
-            normal_max = profile.get('normal_range_max', 170)
-            
-            # Count readings in each range
-            low_count = sum(1 for level in levels if level < normal_min)
-            normal_count = sum(1 for level in levels if normal_min <= level <= normal_max)
-            high_count = sum(1 for level in levels if level > normal_max)
-            
-            self.trends_label.text = (
-                f"Trend (last 3 readings): {trend}\n"
-                f"Average: {avg_level:.1f} μg/dL\n"
-                f"Range: {min_level:.1f} - {max_level:.1f} μg/dL\n"
-                f"{variability}\n\n"
-                f"Reading distribution:\n"
-                f"• Normal: {normal_count}/{len(levels)} readings\n"
-                f"• Low: {low_count}/{len(levels)} readings\n"
-                f"• High: {high_count}/{len(levels)} readings"
+    def show_current_status(self, result):
+        """Show the latest reading's status."""
+        if result.status is None:
+            self.status_label.text = "No readings available for analysis"
+            return
+        
+        status_color, interpretation = {
+            "low": ("🔴", "Your iron level is below normal range"),
+            "high": ("🟠", "Your iron level is above normal range"),
+            "normal": ("🟢", "Your iron level is within normal range"),
+        }[result.status]
+        
+        days_ago = result.days_since_latest
+        if days_ago == 0:
+            time_text = "today"
+        elif days_ago == 1:
+            time_text = "yesterday"
+        else:
+            time_text = f"{days_ago} days ago"
+        
+        self.status_label.text = (
+            f"{status_color} Latest {result.test_type}: {result.latest_level} {result.unit} ({time_text})\n"
+            f"Status: {result.status.upper()}\n"
+            f"{interpretation}\n"
+            f"Normal range: {result.normal_min}-{result.normal_max} {result.unit}"
+            f"{self.change_text(result.change)}"
+            f"{self.forecast_text(result.forecast, result.unit)}"
+        )
+    
+    def change_text(self, change):
+        """Describe the change since the previous test and the usual spacing of tests."""
+        if change is None or change.delta is None:
+            return ""
+        text = (
+            f"\nChange: {change.delta:+.1f} since the previous test "
+            f"{change.days_since_previous:.0f} days earlier"
+        )
+        if change.rolling_count > 1:
+            text += f" ({ROLLING_WINDOW_DAYS}-day avg {change.rolling_mean:.1f})"
+        if change.median_interval_days is not None:
+            text += f"\nTypical time between tests: {change.median_interval_days:.0f} days"
+        return text
+    
+    def forecast_text(self, forecast, unit):
+        """Describe the predicted next reading."""
+        if forecast is None:
+            return ""
+        return (
+            f"\nForecast for {forecast.on_date.strftime('%b %d')}: {forecast.value:.0f} {unit} "
+            f"(95% range {max(forecast.lower, 0):.0f}-{forecast.upper:.0f})"
+        )
+    
+    def show_trends(self, result):
+        """Show trends and the reading distribution over the last three months."""
+        trend = result.trend
+        if trend is None:
+            self.trends_label.text = "Need at least 3 readings for trend analysis"
+            return
+        
+        direction = {
+            "increasing": "INCREASING 📈",
+            "decreasing": "DECREASING 📉",
+            "stable": "STABLE ➡️",
+        }[trend.direction]
+        variability = {
+            "low": "Low variability (stable)",
+            "moderate": "Moderate variability",
+            "high": "High variability (fluctuating)",
+        }[trend.variability]
+        
+        if trend.fit is not None:
+            ols = trend.fit.ols
+            theil_sen = trend.fit.theil_sen
+            slope_text = (
+                f"Slope: {theil_sen.slope:+.1f} {result.unit} per month "
+                f"(95% CI {theil_sen.lower:+.1f} to {theil_sen.upper:+.1f})\n"
+                f"Least squares: {ols.slope:+.1f} ({ols.lower:+.1f} to {ols.upper:+.1f})\n"
             )
-            
-        except Exception as e:
-            print(f"Error analyzing trends: {e}")
-            self.trends_label.text = "Error analyzing trends"
+        else:
+            slope_text = ""
+        
+        self.trends_label.text = (
+            f"{result.test_type} trend (last 90 days): {direction}\n"
+            f"{slope_text}"
+            f"Average: {trend.mean:.1f} {result.unit}"
+            f"{self.overall_text(result.overall)}\n"
+            f"Range: {trend.min:.1f} - {trend.max:.1f} {result.unit}\n"
+            f"{variability}\n\n"
+            f"Reading distribution:\n"
+            f"• Normal: {trend.normal_count}/{trend.count} readings\n"
+            f"• Low: {trend.low_count}/{trend.count} readings\n"
+            f"• High: {trend.high_count}/{trend.count} readings"
+            f"{self.distribution_text(result.distribution, result.unit)}"
+            f"{self.anomaly_text(result.anomalies)}"
+            f"{self.tag_text(result.tag_comparisons)}"
+        )
     
-    def generate_recommendations(self):
-        """Generate personalized recommendations based on iron levels."""
-        try:
-            recent_readings = self.db_manager.get_recent_readings(5)
-            if not recent_readings:
-                self.recommendations_label.text = "No data available for recommendations"
-                return
-            
-            latest_reading = recent_readings[0]
-            iron_level = latest_reading['iron_level']
-            
-            profile = self.db_manager.get_user_profile()
-            normal_min = profile.get('normal_range_min', 60)
-            normal_max = profile.get('normal_range_max', 170)
-            
-            recommendations = []
-            
-            if iron_level < normal_min:
-                # Low iron recommendations
-                recommendations.extend([
-                    "🍖 Increase iron-rich foods: red meat, poultry, fish",
-                    "🥬 Include iron-rich vegetables: spinach, lentils, beans",
-                    "🍊 Combine with Vitamin C sources to enhance absorption",
-                    "☕ Avoid tea and coffee with meals (they reduce absorption)",
-                    "💊 Consider iron supplements (consult your doctor first)",
-                    "👨‍⚕️ Schedule follow-up with healthcare provider"
-                ])
-            elif iron_level > normal_max:
-                # High iron recommendations
-                recommendations.extend([
-                    "🥗 Reduce iron-rich foods temporarily",
-                    "🫖 Drink tea with meals to reduce iron absorption",
-                    "🥛 Increase calcium-rich foods (they inhibit iron absorption)",
-                    "🚫 Avoid iron supplements unless prescribed",
-                    "👨‍⚕️ Consult doctor - high iron can indicate health issues",
-                    "💧 Stay well hydrated"
-                ])
-            else:
-                # Normal iron recommendations
-                recommendations.extend([
-                    "✅ Maintain your current diet and lifestyle",
-                    "🏃‍♂️ Continue regular exercise",
-                    "📊 Keep monitoring your iron levels regularly",
-                    "🥗 Maintain balanced diet with variety of nutrients",
-                    "💧 Stay well hydrated"
-                ])
-            
-            # General recommendations
-            recommendations.extend([
-                "",
-                "General Health Tips:",
-                "📱 Track your readings regularly in this app",
-                "📝 Note any symptoms or changes you experience",
-                "🏥 Bring your iron tracking data to doctor visits",
-                "📚 Stay informed about iron and health"
-            ])
-            
-            # Add timing recommendation
-            days_since_last = (date.today() - datetime.strptime(latest_reading['reading_date'], '%Y-%m-%d').date()).days
-            if days_since_last > 30:
-                recommendations.append("⏰ Consider getting a new iron level test soon")
-            
-            self.recommendations_label.text = "\n".join(recommendations)
-            
-        except Exception as e:
-            print(f"Error generating recommendations: {e}")
-            self.recommendations_label.text = "Error generating recommendations"
+    def overall_text(self, overall):
+        """Compare with the all-time average from the running accumulators."""
+        if overall.count < 2:
+            return ""
+        return f" (all-time {overall.mean:.1f} ± {overall.std(ddof=1):.1f})"
+    
+    def distribution_text(self, distribution, unit):
+        """All-time median, interquartile range and 5th-95th percentiles from the sketches."""
+        if distribution is None:
+            return ""
+        return (
+            f"\nAll-time median: {distribution.median:.1f} {unit} "
+            f"(IQR {distribution.q1:.1f}-{distribution.q3:.1f})\n"
+            f"P5-P95: {distribution.p5:.1f}-{distribution.p95:.1f} {unit}"
+        )
+    
+    def anomaly_text(self, anomalies):
+        """Summarize readings flagged by the anomaly detector in the trend window."""
+        if not anomalies:
+            return ""
+        outliers = sum(1 for a in anomalies if a['flags'] & ANOMALY_OUTLIER)
+        shifts = sum(1 for a in anomalies if a['flags'] & ~ANOMALY_OUTLIER)
+        latest = anomalies[-1]
+        return (
+            f"\nAnomalies: {outliers} outliers, {shifts} level shifts\n"
+            f"Latest: {anomaly_label(latest['flags'])} on {latest['reading_date']}"
+        )
+    
+    def tag_text(self, comparisons):
+        """Average level before and since the first use of the most used tags."""
+        if not comparisons:
+            return ""
+        lines = [
+            f"• #{c.tag} (from {c.pivot_date}): {c.baseline.mean:.1f} → {c.tagged.mean:.1f} "
+            f"({c.difference:+.1f}, {c.baseline.count} vs {c.tagged.count} readings)"
+            for c in comparisons
+        ]
+        return "\n\nBefore and after tags:\n" + "\n".join(lines)
+    
+    def show_recommendations(self, result):
+        """Show personalized recommendations."""
+        if not result.recommendations:
+            self.recommendations_label.text = "No data available for recommendations"
+            return
+        self.recommendations_label.text = "\n".join(result.recommendations)
     
     def get_educational_content(self):
         """Get educational content about iron levels."""
@@ -462,6 +486,81 @@ class InsightsScreen(MDScreen):
             "• Heart problems (severe cases)"
         )
     
+    def on_reading_change(self, event, reading):
+        """Rebuild the profile dialog for the newly selected patient."""
+        if event == "patient":
+            self.profile_dialog = None
+    
+    def open_patient_dialog(self, instance):
+        """List the patients to switch between, with a field to add a new one."""
+        patient_list = MDList()
+        for patient in self.db_manager.get_patients():
+            marker = "✓ " if patient['id'] == self.db_manager.patient_id else ""
+            patient_list.add_widget(OneLineListItem(
+                text=f"{marker}{patient['name']} ({patient['reading_count']} readings)",
+                on_release=lambda x, patient_id=patient['id']: self.select_patient(patient_id)
+            ))
+        scroll = ScrollView(size_hint_y=None, height=dp(240))
+        scroll.add_widget(patient_list)
+        
+        self.new_patient_field = MDTextField(
+            hint_text="New patient name",
+            mode="outlined"
+        )
+        
+        content = MDBoxLayout(
+            orientation="vertical",
+            spacing=dp(10),
+            size_hint_y=None,
+            height=dp(320)
+        )
+        content.add_widget(scroll)
+        content.add_widget(self.new_patient_field)
+        
+        self.patient_dialog = MDDialog(
+            title="Switch Patient",
+            type="custom",
+            content_cls=content,
+            buttons=[
+                MDFlatButton(
+                    text="CANCEL",
+                    on_release=self.close_patient_dialog
+                ),
+                MDFlatButton(
+                    text="ADD",
+                    on_release=self.add_patient
+                ),
+            ],
+        )
+        self.patient_dialog.open()
+    
+    def close_patient_dialog(self, instance):
+        """Close the patient dialog."""
+        if self.patient_dialog:
+            self.patient_dialog.dismiss()
+    
+    def select_patient(self, patient_id):
+        """Switch every screen to another patient's readings."""
+        self.close_patient_dialog(None)
+        if self.db_manager.select_patient(patient_id):
+            self.refresh_insights()
+        else:
+            self.show_snackbar("Error switching patient")
+    
+    def add_patient(self, instance):
+        """Add the named patient and switch to them."""
+        name = self.new_patient_field.text.strip()
+        if not name:
+            self.show_snackbar("Please enter a name")
+            return
+        patient_id = self.db_manager.add_patient(name)
+        if patient_id is None:
+            self.close_patient_dialog(None)
+            self.show_snackbar("Error adding patient")
+            return
+        self.select_patient(patient_id)
+        self.show_snackbar(f"Added {name}")
+    
     def open_profile_dialog(self, instance):
         """Open dialog to update user profile."""
         if not self.profile_dialog:
@@ -488,16 +587,18 @@ class InsightsScreen(MDScreen):
                 mode="outlined"
             )
             
+            # Left empty, Serum Iron uses the reference table for the age and gender
+            override = bool(profile.get('range_override'))
             self.normal_min_field = MDTextField(
-                hint_text="Normal Range Minimum (μg/dL)",
-                text=str(profile.get('normal_range_min', 60)),
+                hint_text="Serum Iron Range Minimum (μg/dL, empty for the reference range)",
+                text=str(profile.get('normal_range_min', '')) if override else "",
                 input_filter="float",
                 mode="outlined"
             )
             
             self.normal_max_field = MDTextField(
-                hint_text="Normal Range Maximum (μg/dL)",
-                text=str(profile.get('normal_range_max', 170)),
+                hint_text="Serum Iron Range Maximum (μg/dL, empty for the reference range)",
+                text=str(profile.get('normal_range_max', '')) if override else "",
                 input_filter="float",
                 mode="outlined"
             )
@@ -537,12 +638,16 @@ class InsightsScreen(MDScreen):
             gender = self.gender_field.text.strip().lower() if self.gender_field.text.strip() else None
             normal_min = float(self.normal_min_field.text) if self.normal_min_field.text.strip() else None
             normal_max = float(self.normal_max_field.text) if self.normal_max_field.text.strip() else None
+            if (normal_min is None) != (normal_max is None):
+                self.show_snackbar("Please enter both range values, or neither")
+                return
             
             success = self.db_manager.update_user_profile(
                 age=age, 
                 gender=gender, 
                 normal_range_min=normal_min, 
-                normal_range_max=normal_max
+                normal_range_max=normal_max,
+                range_override=normal_min is not None
             )
             
             if success:
@@ -559,6 +664,111 @@ class InsightsScreen(MDScreen):
         finally:
             self.close_profile_dialog(None)
     
+    def open_range_dialog(self, instance):
+        """List the reference ranges, with fields to add one or change the one tapped."""
+        range_list = MDList()
+        for reference in self.db_manager.get_reference_ranges():
+            ages = f"{reference['age_min']:g}-{reference['age_max']:g}" \
+                if reference['age_max'] is not None else f"{reference['age_min']:g}+"
+            range_list.add_widget(OneLineListItem(
+                text=(f"{reference['test_type']}, {reference['sex']} {ages}: "
+                      f"{reference['normal_min']:g}-{reference['normal_max']:g}"),
+                on_release=lambda x, reference=reference: self.edit_range(reference)
+            ))
+        scroll = ScrollView(size_hint_y=None, height=dp(200))
+        scroll.add_widget(range_list)
+        
+        self.range_fields = {
+            'test_type': MDTextField(hint_text="Test type", mode="outlined"),
+            'sex': MDTextField(hint_text="Sex (male/female/any)", mode="outlined"),
+            'age_min': MDTextField(hint_text="From age", input_filter="float", mode="outlined"),
+            'age_max': MDTextField(hint_text="Below age (empty for no limit)", input_filter="float",
+                                   mode="outlined"),
+            'normal_min': MDTextField(hint_text="Normal minimum", input_filter="float", mode="outlined"),
+            'normal_max': MDTextField(hint_text="Normal maximum", input_filter="float", mode="outlined"),
+        }
+        
+        content = MDBoxLayout(
+            orientation="vertical",
+            spacing=dp(10),
+            size_hint_y=None,
+            height=dp(620)
+        )
+        content.add_widget(scroll)
+        for field in self.range_fields.values():
+            content.add_widget(field)
+        
+        self.range_dialog = MDDialog(
+            title="Reference Ranges",
+            type="custom",
+            content_cls=content,
+            buttons=[
+                MDFlatButton(
+                    text="CANCEL",
+                    on_release=self.close_range_dialog
+                ),
+                MDFlatButton(
+                    text="SAVE",
+                    on_release=self.save_range
+                ),
+            ],
+        )
+        self.range_dialog.open()
+    
+    def edit_range(self, reference):
+        """Fill the range fields with a listed range to change it."""
+        for key, field in self.range_fields.items():
+            value = reference[key]
+            field.text = "" if value is None else (value if isinstance(value, str) else f"{value:g}")
+    
+    def close_range_dialog(self, instance):
+        """Close the reference range dialog."""
+        if self.range_dialog:
+            self.range_dialog.dismiss()
+    
+    def save_range(self, instance):
+        """Add or replace the range in the fields; every patient's readings are reclassified."""
+        fields = {key: field.text.strip() for key, field in self.range_fields.items()}
+        try:
+            sex = fields['sex'].lower()
+            if not fields['test_type'] or sex not in ("male", "female", "any"):
+                self.show_snackbar("Please enter a test type and male, female or any")
+                return
+            normal_min = float(fields['normal_min'])
+            normal_max = float(fields['normal_max'])
+            if normal_min > normal_max:
+                self.show_snackbar("The minimum must not exceed the maximum")
+                return
+            success = self.db_manager.set_reference_range(
+                fields['test_type'], sex,
+                float(fields['age_min']) if fields['age_min'] else 0,
+                float(fields['age_max']) if fields['age_max'] else None,
+                normal_min, normal_max
+            )
+        except ValueError:
+            self.show_snackbar("Please enter valid numeric values")
+            return
+        
+        self.close_range_dialog(None)
+        if success:
+            self.show_snackbar("Reference range saved")
+            self.refresh_insights()
+        else:
+            self.show_snackbar("Error saving reference range")
+    
+    def toggle_debug_overlay(self, instance):
+        """Show or hide the app's span timings overlay."""
+        MDApp.get_running_app().toggle_debug_overlay()
+    
+    def save_trace(self, instance):
+        """Save recorded span timings to a JSON file to attach to a report."""
+        try:
+            path = MDApp.get_running_app().save_trace()
+            self.show_snackbar(f"Timings saved to {path}")
+        except OSError as e:
+            print(f"Error saving timings: {e}")
+            self.show_snackbar("Error saving timings")
+    
     def show_snackbar(self, message):
         """Show a snackbar with the given message."""
         snackbar = Snackbar(text=message, duration=3)
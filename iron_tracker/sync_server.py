@@ -0,0 +1,39 @@
+"""Local reference server for syncing readings between devices.
+
+Usage:
+    python sync_server.py --data clinic --port 8765
+
+Each patient key gets its own database in the data directory; clients
+sync with http://<host>:8765/sync/<patient key>. The resulting files can
+be opened by the app, report.py and cohort.py like any other database.
+"""
+import argparse
+import os
+import sys
+from typing import Sequence
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from database.sync import SyncServer
+
+
+def main(argv: Sequence[str] = None) -> int:
+    parser = argparse.ArgumentParser(description="Serve iron tracker sync requests.")
+    parser.add_argument("-d", "--data", default="sync_data", help="directory of patient databases")
+    parser.add_argument("--host", default="127.0.0.1", help="address to listen on")
+    parser.add_argument("-p", "--port", type=int, default=8765, help="port to listen on")
+    args = parser.parse_args(argv)
+
+    server = SyncServer((args.host, args.port), args.data)
+    print(f"Serving {os.path.abspath(args.data)} on http://{args.host}:{args.port}/sync/<patient key>")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,18 @@
+"""Shared fixtures; the tests import the app's modules the way its scripts do."""
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from database.db_manager import DatabaseManager
+
+
+@pytest.fixture
+def db_manager():
+    """A DatabaseManager on a fresh in-memory database."""
+    db_manager = DatabaseManager(":memory:")
+    db_manager.init_db()
+    yield db_manager
+    db_manager.close()
@@ -0,0 +1,66 @@
+import numpy as np
+import pytest
+
+from database.forecasts import TrendState, forecast, noise_scale
+from database.reading_store import reading_timestamp
+
+
+def fitted(timestamps, levels, scale: float = 1.0) -> TrendState:
+    state = TrendState(noise_scale=scale)
+    for t, y in zip(timestamps, levels):
+        state.update(t, y)
+    return state
+
+
+def test_noise_scale_follows_reference_range_width():
+    assert noise_scale("Serum Iron") == 1.0
+    assert noise_scale("Ferritin") > 1.0 > noise_scale("Transferrin Saturation")
+    assert noise_scale("Transferrin Saturation (calculated)") == noise_scale("Transferrin Saturation")
+    assert noise_scale("Vitamin B12") == 1.0
+
+
+def test_forecast_scales_with_units():
+    rng = np.random.default_rng(7)
+    timestamps = np.cumsum(rng.uniform(10, 40, 20))
+    levels = 100 + rng.normal(0, 10, 20)
+    base = forecast(fitted(timestamps, levels), 60, 170)
+    scaled = forecast(fitted(timestamps, levels * 3, scale=3.0), 180, 510)
+    assert (scaled.value, scaled.lower, scaled.upper) == pytest.approx(
+        (3 * base.value, 3 * base.lower, 3 * base.upper))
+
+
+def test_falling_trend_predicts_crossing():
+    timestamps = np.arange(30) * 3.0
+    result = forecast(fitted(timestamps, 170 - 0.8 * timestamps), 60, 170)
+    assert result.lower < result.value < result.upper
+    assert result.slope_per_day == pytest.approx(-0.8, abs=0.05)
+    assert result.crossing is not None and result.crossing.bound == "min"
+    # 170 - 0.8 * 87 = 100.4 at the last reading, 60 about 50 days later
+    assert result.crossing.days == pytest.approx(50, abs=5)
+
+
+def test_flat_series_has_no_crossing():
+    result = forecast(fitted(np.arange(12) * 30.0, [100.0, 104.0] * 6), 60, 170)
+    assert result.crossing is None
+
+
+def test_model_matches_replay_after_out_of_order_insert_and_delete(db_manager):
+    days = [f"2026-0{month}-{day:02d}" for month in range(1, 4) for day in (3, 17)]
+    for reading_date, level in zip(days, [300, 280, 310, 260, 240, 250]):
+        db_manager.add_reading(level, reading_date, "08:00", test_type="Ferritin")
+    db_manager.add_reading(290, "2026-01-10", "08:00", test_type="Ferritin")
+    row = db_manager.connection.execute(
+        "SELECT id FROM iron_readings WHERE reading_date = '2026-02-17'").fetchone()
+    db_manager.delete_reading(row['id'])
+
+    rows = db_manager.connection.execute("""
+        SELECT reading_date, reading_time, iron_level FROM iron_readings
+        WHERE test_type = 'Ferritin' ORDER BY reading_date, reading_time
+    """).fetchall()
+    expected = fitted([reading_timestamp(row[0], row[1]) for row in rows], [row[2] for row in rows],
+                      scale=noise_scale("Ferritin"))
+    state = db_manager.get_forecast_state("Ferritin")
+    assert state.reading_count == len(rows) == 6
+    assert state.noise_scale == noise_scale("Ferritin")
+    for name in ("level", "slope", "p_level", "p_cross", "p_slope", "mean_interval"):
+        assert getattr(state, name) == pytest.approx(getattr(expected, name))
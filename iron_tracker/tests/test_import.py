@@ -0,0 +1,32 @@
+def rows(count, notes=""):
+    return [{'iron_level': 60 + i, 'reading_date': f"2026-06-{i % 28 + 1:02d}",
+             'reading_time': f"{i % 24:02d}:30", 'notes': notes}
+            for i in range(count)]
+
+
+def test_importing_twice_adds_nothing(db_manager):
+    assert db_manager.upsert_readings(rows(40), "export.csv", batch_size=7) == \
+        {'added': 40, 'updated': 0, 'unchanged': 0}
+    stored = db_manager.get_all_readings()
+    seq = db_manager.get_last_change_seq()
+
+    assert db_manager.upsert_readings(rows(40), "export.csv", batch_size=7) == \
+        {'added': 0, 'updated': 0, 'unchanged': 40}
+    assert db_manager.get_all_readings() == stored
+    assert db_manager.get_last_change_seq() == seq
+
+
+def test_changed_notes_are_updated(db_manager):
+    db_manager.upsert_readings(rows(10), "export.csv")
+    assert db_manager.upsert_readings(rows(10, notes="fasting"), "export.csv") == \
+        {'added': 0, 'updated': 10, 'unchanged': 0}
+    readings = db_manager.get_all_readings()
+    assert len(readings) == 10
+    assert {reading['notes'] for reading in readings} == {"fasting"}
+
+
+def test_resumed_import_adds_the_rest(db_manager):
+    db_manager.upsert_readings(rows(40)[:25], "export.csv")
+    assert db_manager.upsert_readings(rows(40), "export.csv") == \
+        {'added': 15, 'updated': 0, 'unchanged': 25}
+    assert len(db_manager.get_all_readings()) == 40
@@ -0,0 +1,73 @@
+import numpy as np
+import pytest
+
+from database.quantiles import QuantileSummary, TDigest
+
+QUANTILES = [0.05, 0.25, 0.5, 0.75, 0.95]
+
+
+def rank_error(values: np.ndarray, digest: TDigest) -> float:
+    """Largest distance, in quantiles, between the digest's estimates and the data."""
+    ordered = np.sort(values)
+    estimates = digest.quantile(QUANTILES)
+    ranks = np.searchsorted(ordered, estimates) / len(ordered)
+    return float(np.max(np.abs(ranks - QUANTILES)))
+
+
+@pytest.fixture
+def values():
+    return np.random.default_rng(4).lognormal(4.5, 0.4, 5000)
+
+
+def test_quantiles_match_batch(values):
+    digest = TDigest()
+    digest.extend(values)
+    assert digest.count == len(values)
+    assert (digest.min, digest.max) == (values.min(), values.max())
+    assert rank_error(values, digest) < 0.01
+
+
+def test_merge_matches_single_digest(values):
+    parts = []
+    for chunk in np.array_split(values, 12):
+        digest = TDigest()
+        for value in chunk[:50]:
+            digest.add(value)
+        digest.extend(chunk[50:])
+        parts.append(digest)
+
+    merged = parts[0]
+    for part in parts[1:]:
+        merged = merged.merge(part)
+    assert merged.count == len(values)
+    assert rank_error(values, merged) < 0.01
+    assert rank_error(values, TDigest.merge_all(parts)) < 0.01
+
+
+def test_bytes_round_trip(values):
+    digest = TDigest()
+    digest.extend(values)
+    restored = TDigest.from_bytes(digest.to_bytes(), digest.min, digest.max)
+    np.testing.assert_array_equal(restored.quantile(QUANTILES), digest.quantile(QUANTILES))
+
+
+def test_empty_digest():
+    assert TDigest().quantile(0.5) is None
+    assert QuantileSummary.from_digest(TDigest()) is None
+    assert len(TDigest.merge_all([TDigest(), TDigest()])) == 0
+
+
+def test_sketches_follow_inserts_and_deletes(db_manager):
+    levels = np.random.default_rng(5).normal(100, 30, 90).round(1)
+    for day, level in enumerate(levels):
+        db_manager.add_reading(float(level), f"2026-{day // 28 + 1:02d}-{day % 28 + 1:02d}", "08:00")
+    rows = db_manager.connection.execute("SELECT id FROM iron_readings ORDER BY id").fetchall()
+    for row in rows[::4]:
+        db_manager.delete_reading(row['id'])
+
+    kept = np.array([row[0] for row in db_manager.connection.execute(
+        "SELECT iron_level FROM iron_readings WHERE test_type = 'Serum Iron'")])
+    digest = db_manager.get_quantile_sketch(test_type="Serum Iron")
+    assert digest.count == len(kept)
+    assert (digest.min, digest.max) == (kept.min(), kept.max())
+    assert rank_error(kept, digest) < 0.03
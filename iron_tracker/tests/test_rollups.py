@@ -0,0 +1,83 @@
+from datetime import date
+
+import numpy as np
+import pytest
+
+from database.rollups import RESOLUTIONS, bucket_end, bucket_start
+
+
+def native_levels(db_manager):
+    return db_manager.connection.execute("""
+        SELECT reading_date, iron_level FROM iron_readings
+        WHERE test_type IN ('Serum Iron', 'Ferritin')
+    """).fetchall()
+
+
+def assert_matches_readings(db_manager):
+    rows = native_levels(db_manager)
+    for resolution in RESOLUTIONS:
+        groups = {}
+        for reading_date, level in rows:
+            key = bucket_start(date.fromisoformat(reading_date), resolution).isoformat()
+            groups.setdefault(key, []).append(level)
+
+        buckets = db_manager.rollups.query(1, resolution, "2025-01-01", "2025-12-31")
+        assert [bucket['bucket_start'] for bucket in buckets] == sorted(groups)
+        for bucket in buckets:
+            levels = np.array(groups[bucket['bucket_start']])
+            assert bucket['reading_count'] == len(levels)
+            assert bucket['mean_level'] == pytest.approx(levels.mean(), rel=1e-12)
+            assert bucket['variance'] == pytest.approx(levels.var(), rel=1e-6, abs=1e-9)
+            assert (bucket['min_level'], bucket['max_level']) == (levels.min(), levels.max())
+
+
+@pytest.fixture
+def filled(db_manager):
+    # Levels far from zero with a small spread, where E[x²] - mean² loses every digit
+    rng = np.random.default_rng(8)
+    for i in range(200):
+        day = date.fromordinal(date(2025, 1, 1).toordinal() + int(rng.integers(0, 300)))
+        test_type = "Serum Iron" if i % 3 else "Ferritin"
+        db_manager.add_reading(round(1e6 + rng.normal(0, 0.5), 3), day, f"{i % 24:02d}:{i % 60:02d}",
+                               test_type=test_type)
+    ids = [row[0] for row in db_manager.connection.execute("SELECT id FROM iron_readings")]
+    for reading_id in ids[::5]:
+        db_manager.delete_reading(reading_id)
+    return db_manager
+
+
+def test_buckets_follow_inserts_and_deletes(filled):
+    assert_matches_readings(filled)
+
+
+def test_rebuild_matches_incremental(filled):
+    before = {resolution: filled.rollups.query(1, resolution, date(2025, 1, 1), date(2025, 12, 31))
+              for resolution in RESOLUTIONS}
+    filled.rollups.rebuild_all()
+    for resolution in RESOLUTIONS:
+        after = filled.rollups.query(1, resolution, date(2025, 1, 1), date(2025, 12, 31))
+        assert len(after) == len(before[resolution])
+        for old, new in zip(before[resolution], after):
+            assert new['bucket_start'] == old['bucket_start']
+            assert new['reading_count'] == old['reading_count']
+            assert new['mean_level'] == pytest.approx(old['mean_level'], rel=1e-12)
+            assert new['variance'] == pytest.approx(old['variance'], rel=1e-6, abs=1e-9)
+    assert_matches_readings(filled)
+
+
+def test_period_std_uses_population_variance(db_manager):
+    for level in (80, 90, 100):
+        db_manager.add_reading(level, "2026-03-02", f"{level // 10:02d}:00")
+    [aggregate] = db_manager.get_period_aggregates("month")
+    assert aggregate['std'] == pytest.approx(db_manager.get_running_stats().std())
+    assert aggregate['std'] == pytest.approx(np.std([80, 90, 100]))
+
+
+@pytest.mark.parametrize("day, resolution, start, end", [
+    (date(2026, 3, 18), "week", date(2026, 3, 16), date(2026, 3, 23)),
+    (date(2026, 3, 18), "month", date(2026, 3, 1), date(2026, 4, 1)),
+    (date(2026, 12, 18), "quarter", date(2026, 10, 1), date(2027, 1, 1)),
+])
+def test_bucket_bounds(day, resolution, start, end):
+    assert bucket_start(day, resolution) == start
+    assert bucket_end(start, resolution) == end
@@ -0,0 +1,52 @@
+import numpy as np
+import pytest
+
+from database.running_stats import RunningStats
+
+
+def accumulate(values) -> RunningStats:
+    stats = RunningStats()
+    for value in values:
+        stats = stats.merge(RunningStats(1, float(value), 0.0, float(value), float(value)))
+    return stats
+
+
+@pytest.mark.parametrize("split", [0, 1, 17, 50])
+def test_merge_matches_batch(split):
+    values = np.random.default_rng(1).normal(100, 25, 50)
+    merged = accumulate(values[:split]).merge(accumulate(values[split:]))
+
+    assert merged.count == len(values)
+    assert merged.mean == pytest.approx(values.mean())
+    assert merged.variance() == pytest.approx(values.var())
+    assert merged.std(ddof=1) == pytest.approx(values.std(ddof=1))
+    assert (merged.min, merged.max) == (values.min(), values.max())
+
+
+def test_merge_keeps_precision_far_from_zero():
+    values = 1e9 + np.random.default_rng(2).normal(0, 0.5, 1000)
+    stats = accumulate(values[:400]).merge(accumulate(values[400:]))
+    assert stats.variance() == pytest.approx(values.var(), rel=1e-6)
+
+
+def test_variance_of_too_few_readings_is_zero():
+    assert RunningStats().variance() == 0.0
+    assert RunningStats(1, 80.0, 0.0, 80.0, 80.0).variance(ddof=1) == 0.0
+
+
+def test_store_follows_inserts_and_deletes(db_manager):
+    rng = np.random.default_rng(3)
+    for day, level in enumerate(rng.normal(90, 20, 40)):
+        db_manager.add_reading(round(float(level), 1), f"2026-01-{day % 28 + 1:02d}", f"{day % 24:02d}:00")
+    rows = db_manager.connection.execute("SELECT id FROM iron_readings ORDER BY id").fetchall()
+    for row in rows[::3]:
+        assert db_manager.delete_reading(row['id'])
+
+    levels = np.array([row[0] for row in db_manager.connection.execute(
+        "SELECT iron_level FROM iron_readings WHERE test_type = 'Serum Iron'")])
+    stats = db_manager.get_running_stats("Serum Iron")
+    assert stats.count == len(levels)
+    assert stats.mean == pytest.approx(levels.mean())
+    assert stats.variance() == pytest.approx(levels.var())
+    assert (stats.min, stats.max) == (levels.min(), levels.max())
+    assert db_manager.get_period_stats("month", test_type="Serum Iron")["2026-01-01"].count == len(levels)
@@ -0,0 +1,77 @@
+import pytest
+
+from database.db_manager import DatabaseManager
+from database.sync import PROTOCOL_VERSION, sync_response, unseen_changes
+
+
+@pytest.fixture
+def peer():
+    manager = DatabaseManager(":memory:")
+    manager.init_db()
+    yield manager
+    manager.close()
+
+
+def readings(db_manager):
+    return sorted((r['reading_date'], r['reading_time'], r['iron_level'], r['notes'], r['test_type'])
+                  for r in db_manager.get_all_readings())
+
+
+def fill(db_manager):
+    for day in range(1, 8):
+        db_manager.add_reading(70 + day, f"2026-05-{day:02d}", "08:00", notes=f"day {day}")
+        db_manager.add_reading(40 + day, f"2026-05-{day:02d}", "08:00", test_type="Ferritin")
+
+
+def test_applying_a_batch_twice_changes_nothing(db_manager, peer):
+    fill(db_manager)
+    changes = db_manager.get_changes_since(0)
+
+    assert peer.apply_changes(changes, origin="phone") == 14
+    assert readings(peer) == readings(db_manager)
+    seq = peer.get_last_change_seq()
+    assert peer.apply_changes(changes, origin="phone") == 0
+    assert peer.get_last_change_seq() == seq
+    assert readings(peer) == readings(db_manager)
+
+
+def test_deletes_apply_once(db_manager, peer):
+    fill(db_manager)
+    peer.apply_changes(db_manager.get_changes_since(0))
+    seq = db_manager.get_last_change_seq()
+    db_manager.delete_reading(db_manager.get_all_readings()[0]['id'])
+    deletes = db_manager.get_changes_since(seq)
+
+    assert peer.apply_changes(deletes) == 1
+    assert peer.apply_changes(deletes) == 0
+    assert readings(peer) == readings(db_manager)
+
+
+def test_received_changes_are_not_sent_back(db_manager, peer):
+    fill(db_manager)
+    peer.apply_changes(db_manager.get_changes_since(0), origin="phone")
+    peer.add_reading(95, "2026-05-20", "09:00")
+
+    logged = peer.get_changes_since(0)
+    assert [change['origin'] for change in logged].count("phone") == 14
+    [unseen] = unseen_changes(logged, "phone")
+    assert unseen['reading']['iron_level'] == 95
+    assert 'origin' not in unseen
+    assert len(unseen_changes(logged, "tablet")) == len(logged)
+
+
+def test_sync_response_returns_only_missing_changes(db_manager, peer):
+    fill(db_manager)
+    peer.add_reading(95, "2026-05-20", "09:00")
+    request = {'version': PROTOCOL_VERSION, 'client_id': "phone", 'since': 0,
+               'through': db_manager.get_last_change_seq(),
+               'changes': db_manager.get_changes_since(0)}
+
+    response = sync_response(peer, request)
+    assert response['acked'] == request['through']
+    assert not response['more']
+    assert db_manager.apply_changes(response['changes'], origin="server") == 1
+    assert readings(db_manager) == readings(peer)
+
+    request['since'] = response['seq']
+    assert sync_response(peer, request)['changes'] == []
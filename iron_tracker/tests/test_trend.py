@@ -0,0 +1,86 @@
+import numpy as np
+import pytest
+
+from analytics.trend import (
+    MONTH_DAYS, RegressionStats, TrendModel, fit_trend, pairwise_slopes, t_quantile
+)
+
+
+@pytest.fixture
+def series():
+    rng = np.random.default_rng(6)
+    timestamps = 20000 + np.sort(rng.uniform(0, 180, 60))
+    levels = 90 + 0.2 * (timestamps - 20000) + rng.normal(0, 8, 60)
+    return timestamps, levels
+
+
+def assert_same_fit(fit, expected):
+    for name in ("ols", "theil_sen"):
+        got, want = getattr(fit, name), getattr(expected, name)
+        assert got.count == want.count
+        assert (got.slope, got.lower, got.upper) == pytest.approx((want.slope, want.lower, want.upper))
+
+
+@pytest.mark.parametrize("p, df, expected", [(0.975, 1, 12.706), (0.975, 2, 4.303),
+                                             (0.975, 10, 2.228), (0.95, 30, 1.697)])
+def test_t_quantile(p, df, expected):
+    assert t_quantile(p, df) == pytest.approx(expected, abs=2e-3)
+
+
+def test_regression_updates_match_batch(series):
+    timestamps, levels = series
+    stats = RegressionStats()
+    for t, y in zip(timestamps, levels):
+        stats.add(t, y)
+    for t, y in zip(timestamps[:20], levels[:20]):
+        stats.remove(t, y)
+
+    batch = RegressionStats.from_arrays(timestamps[20:], levels[20:])
+    assert stats.count == batch.count
+    for name in ("mean_t", "mean_y", "s_tt", "s_ty", "s_yy"):
+        assert getattr(stats, name) == pytest.approx(getattr(batch, name), rel=1e-9)
+
+
+def test_exact_line():
+    timestamps = np.arange(10.0) * 7
+    fit = fit_trend(timestamps, 80 + 0.5 * timestamps)
+    assert fit.ols.slope == pytest.approx(0.5 * MONTH_DAYS)
+    assert fit.theil_sen.slope == pytest.approx(0.5 * MONTH_DAYS)
+    assert fit.direction == "increasing"
+
+
+def test_theil_sen_is_median_of_pairwise_slopes(series):
+    timestamps, levels = series
+    slopes = [(levels[j] - levels[i]) / (timestamps[j] - timestamps[i])
+              for i in range(len(timestamps)) for j in range(i + 1, len(timestamps))]
+    assert fit_trend(timestamps, levels).theil_sen.slope == pytest.approx(np.median(slopes) * MONTH_DAYS)
+    assert len(pairwise_slopes([1.0, 1.0, 2.0], [5.0, 6.0, 7.0])) == 2
+
+
+def test_model_updates_match_batch(series):
+    timestamps, levels = series
+    model = TrendModel(window_days=90)
+    model.extend(timestamps[:10], levels[:10])
+    for t, y in zip(timestamps[10:], levels[10:]):
+        model.add(t, y)
+    assert model.remove(timestamps[-5], levels[-5])
+    assert not model.remove(timestamps[0], levels[0])  # already out of the window
+
+    in_window = timestamps >= timestamps[-1] - 90
+    in_window[len(timestamps) - 5] = False
+    assert len(model) == in_window.sum()
+    assert_same_fit(model.fit(), fit_trend(timestamps[in_window], levels[in_window]))
+
+
+def test_model_keeps_at_most_max_points(series):
+    timestamps, levels = series
+    model = TrendModel(window_days=365, max_points=25)
+    for t, y in zip(timestamps, levels):
+        model.add(t, y)
+    assert len(model) == 25
+    assert_same_fit(model.fit(), fit_trend(timestamps[-25:], levels[-25:]))
+
+
+def test_too_few_readings():
+    assert fit_trend([1.0, 2.0], [80.0, 90.0]) is None
+    assert TrendModel().fit() is None